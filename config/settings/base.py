@@ -49,6 +49,71 @@ ACCEPTABLE_CONTENT = [
 
 CELERY_BROKER_URL = "amqp://localhost"
 
+# a batch upload is a chord of parse tasks, which needs somewhere to keep
+# their results until the finalising task runs
+CELERY_RESULT_BACKEND = "django-db"
+
+# seconds the returns of a quarter must go unchanged before its built master
+# workbooks, made stale by the changes, are rebuilt in the background
+MASTER_REBUILD_DELAY = 30
+
+# seconds after which a batch upload that has not finished is no longer shown,
+# or polled, as in progress on the returns list
+INGEST_BATCH_TIMEOUT = 60 * 60
+
+# number of compiled Datamap extraction plans each process keeps in memory
+EXTRACTION_PLAN_CACHE_SIZE = 32
+
+# how parsed ReturnItems are written: "create", "bulk_create", "copy" (PostgreSQL
+# only) or "auto", which uses COPY on PostgreSQL and bulk_create elsewhere
+RETURNITEM_WRITE_STRATEGY = "auto"
+RETURNITEM_BULK_CREATE_BATCH_SIZE = 500
+
+# engine used to read populated templates: "openpyxl" or "native"
+PARSER_DEFAULT_ENGINE = "openpyxl"
+
+# memory used parsing a template: the address space a parse may add, in bytes,
+# before it is aborted with ParserMemoryError (None for no budget); the file size
+# above which openpyxl always reads in streaming read-only mode; how often RSS is
+# sampled, in seconds; and whether to trace allocations with tracemalloc too
+PARSER_MEMORY_BUDGET = None
+PARSER_STREAMING_THRESHOLD = 20 * 1024 * 1024
+PARSER_MEMORY_SAMPLE_INTERVAL = 0.05
+PARSER_TRACEMALLOC = False
+
+# parallel ingest (excelparser.helpers.ingest): number of worker processes
+# (None uses every CPU), the address space each may use in bytes (None for no
+# limit) and the number of files a worker parses before it is replaced
+INGEST_WORKERS = None
+INGEST_WORKER_MEMORY_LIMIT = None
+INGEST_WORKER_MAX_TASKS = 10
+
+# re-ingesting a file for a project and quarter which already has a Return:
+# "upsert" writes only the ReturnItems which changed, "replace" deletes the
+# Return and creates it again
+REINGEST_MODE = "upsert"
+
+# extracted values of parsed templates, keyed by file hash and datamap version,
+# so byte-identical re-uploads are not parsed again. None disables the cache.
+PARSE_CACHE_DIR = BASE_DIR / "cache" / "parse"
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# uploads are hashed as they are received, so that ContentAddressedStorage
+# (core.storage) can recognise a duplicate without writing it again
+FILE_UPLOAD_HANDLERS = [
+    "core.uploadhandler.HashingMemoryFileUploadHandler",
+    "core.uploadhandler.HashingTemporaryFileUploadHandler",
+]
+
+# seconds a stored upload must have had no references before collect_blobs
+# removes it
+BLOB_GC_GRACE = 24 * 60 * 60
+
+# keep a copy of each single template upload in upload storage, saved by
+# background threads after the upload has been parsed from the request
+ARCHIVE_UPLOADS = True
+UPLOAD_ARCHIVE_WORKERS = 2
+
 # SECRETS
 with open("secrets.json") as f:
     secrets = json.loads(f.read())
@@ -85,6 +150,7 @@ INSTALLED_APPS = [
     "excelparser.apps.ExcelparserConfig",
     "returns.apps.ReturnsConfig",
     "crispy_forms",
+    "django_celery_results",
 ]
 
 MIDDLEWARE = [
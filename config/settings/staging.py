@@ -52,6 +52,12 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        # the JSON timings of each ingested file and batch
+        'excelparser.helpers.instrumentation': {
+            'handlers': ['file', 'console'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     }
 }
 
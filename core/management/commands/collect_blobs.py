@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.storage import collect_garbage
+
+
+class Command(BaseCommand):
+    help = """
+    Removes stored uploads that nothing has referred to for longer than
+    --grace seconds (by default the BLOB_GC_GRACE setting), along with
+    any stray files in the store such as interrupted writes.
+
+    python manage.py collect_blobs --grace 3600
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=int, default=None)
+
+    def handle(self, *args, **options):
+        removed = collect_garbage(grace=options["grace"])
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} files"))
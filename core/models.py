@@ -1,3 +1,22 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class StoredBlob(models.Model):
+    """
+    A file kept once in ContentAddressedStorage, whatever it was uploaded
+    as, and the number of references to it. A blob no longer referenced is
+    removed by the collect_blobs command.
+    """
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+    released = models.DateTimeField(
+        null=True, blank=True, help_text="When the last reference was dropped"
+    )
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
@@ -0,0 +1,168 @@
+"""
+Content-addressed storage for uploaded files.
+
+ContentAddressedStorage keeps each distinct file once, under a name made
+from the SHA-256 of its content, so uploading the same bytes again (under
+any name) writes nothing new. A StoredBlob row counts the references made
+by save() and dropped by delete(). Files are only removed, once nothing
+refers to them, by collect_garbage() (the collect_blobs command).
+
+Uploads handled by core.uploadhandler already carry their hash, so a
+duplicate is recognised without touching the disk. Other content is
+hashed while it is written to a temporary file, in a single pass.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+from core.models import StoredBlob
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GC_GRACE = 24 * 60 * 60
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def __init__(self, location=None, base_url=None, prefix: str = "blobs", **kwargs):
+        super().__init__(location, base_url, **kwargs)
+        self.prefix = prefix
+
+    def blob_name(self, sha256: str, name: str) -> str:
+        extension = os.path.splitext(name)[1].lower()
+        return f"{self.prefix}/{sha256[:2]}/{sha256}{extension}"
+
+    def get_available_name(self, name, max_length=None):
+        # the name is replaced by the content's address in _save
+        return name
+
+    def _save(self, name, content):
+        sha256: Optional[str] = getattr(content, "sha256", None)
+        partial = None
+        if sha256 is None or not self._has_blob(sha256):
+            partial, sha256 = self._write_partial(content)
+        try:
+            with transaction.atomic():
+                defaults = {"name": self.blob_name(sha256, name), "size": content.size}
+                blob, created = StoredBlob.objects.select_for_update().get_or_create(
+                    sha256=sha256, defaults=defaults
+                )
+                if not self.exists(blob.name):
+                    if partial is None:
+                        partial, _ = self._write_partial(content)
+                    os.replace(partial, self.path(blob.name))
+                    partial = None
+                StoredBlob.objects.filter(pk=sha256).update(
+                    refcount=F("refcount") + 1, released=None
+                )
+        finally:
+            if partial is not None:
+                os.remove(partial)
+        if not created:
+            logger.debug(f"{name} is a duplicate of {blob.name}")
+        return blob.name
+
+    def delete(self, name):
+        """
+        Drop a reference to the blob called name. The file stays until
+        collect_garbage() finds nothing refers to it. A file saved before
+        storage was content-addressed is deleted straight away.
+        """
+        with transaction.atomic():
+            released = StoredBlob.objects.filter(name=name, refcount__gt=0).update(
+                refcount=F("refcount") - 1
+            )
+            StoredBlob.objects.filter(name=name, refcount=0, released=None).update(
+                released=timezone.now()
+            )
+        if not released and not StoredBlob.objects.filter(name=name).exists():
+            super().delete(name)
+
+    def _has_blob(self, sha256: str) -> bool:
+        name = (
+            StoredBlob.objects.filter(pk=sha256).values_list("name", flat=True).first()
+        )
+        return name is not None and self.exists(name)
+
+    def _write_partial(self, content):
+        """
+        Write content to a temporary file beside the blobs, hashing it on
+        the way, and return the file's path and the hash.
+        """
+        directory = self.path(self.prefix)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, partial = tempfile.mkstemp(dir=directory, suffix=".partial")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(partial)
+            raise
+        sha256 = digest.hexdigest()
+        blob_directory = os.path.dirname(self.path(self.blob_name(sha256, "")))
+        os.makedirs(blob_directory, exist_ok=True)
+        return partial, sha256
+
+
+upload_storage = ContentAddressedStorage()
+
+
+def collect_garbage(
+    storage: ContentAddressedStorage = upload_storage, grace: Optional[int] = None
+) -> int:
+    """
+    Remove the blobs which have had no references for more than grace
+    seconds (BLOB_GC_GRACE), and any files left under the storage's prefix
+    that no blob accounts for, such as partial writes. Returns the number
+    of files removed.
+    """
+    if grace is None:
+        grace = getattr(settings, "BLOB_GC_GRACE", DEFAULT_GC_GRACE)
+    cutoff = timezone.now() - datetime.timedelta(seconds=grace)
+    removed = 0
+    for sha256 in StoredBlob.objects.filter(
+        refcount=0, released__lt=cutoff
+    ).values_list("sha256", flat=True):
+        with transaction.atomic():
+            # a save() since the query above may have taken a reference
+            blob = (
+                StoredBlob.objects.select_for_update()
+                .filter(pk=sha256, refcount=0)
+                .first()
+            )
+            if blob is None:
+                continue
+            if storage.exists(blob.name):
+                os.remove(storage.path(blob.name))
+                removed += 1
+            blob.delete()
+    known = set(StoredBlob.objects.values_list("name", flat=True))
+    root = storage.path(storage.prefix)
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, storage.location).replace(os.sep, "/")
+            if name in known:
+                continue
+            try:
+                modified = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if modified < cutoff.timestamp():
+                os.remove(path)
+                removed += 1
+    logger.info(f"Removed {removed} unreferenced files from {root}")
+    return removed
@@ -1,3 +1,66 @@
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 
-# Create your tests here.
+from core.models import StoredBlob
+from core.storage import ContentAddressedStorage, collect_garbage
+
+
+class TestContentAddressedStorage(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = ContentAddressedStorage(location=self.location)
+
+    def _files(self):
+        return sorted(
+            os.path.relpath(os.path.join(d, f), self.location)
+            for d, _, files in os.walk(self.location)
+            for f in files
+        )
+
+    def test_same_content_is_stored_once(self):
+        first = self.storage.save("uploads/A.xlsm", ContentFile(b"template"))
+        second = self.storage.save("uploads/B.xlsm", ContentFile(b"template"))
+        self.assertEqual(first, second)
+        self.assertTrue(first.startswith("blobs/") and first.endswith(".xlsm"))
+        self.assertEqual(self._files(), [first])
+        self.assertEqual(StoredBlob.objects.get(name=first).refcount, 2)
+        with self.storage.open(first) as f:
+            self.assertEqual(f.read(), b"template")
+
+    def test_known_hash_skips_writing(self):
+        name = self.storage.save("A.xlsm", ContentFile(b"template"))
+        upload = SimpleUploadedFile("B.xlsm", b"template")
+        upload.sha256 = StoredBlob.objects.get(name=name).sha256
+        upload.chunks = None  # reading it would fail
+        self.assertEqual(self.storage.save("B.xlsm", upload), name)
+
+    def test_unreferenced_blobs_are_collected(self):
+        kept = self.storage.save("A.xlsm", ContentFile(b"kept"))
+        dropped = self.storage.save("B.xlsm", ContentFile(b"dropped"))
+        self.storage.save("C.xlsm", ContentFile(b"kept"))
+        self.storage.delete(kept)
+        self.storage.delete(dropped)
+        self.assertEqual(collect_garbage(self.storage, grace=60), 0)
+        self.assertEqual(collect_garbage(self.storage, grace=-1), 1)
+        self.assertEqual(self._files(), [kept])
+        self.assertEqual(
+            list(
+                StoredBlob.objects.filter(name__in=[kept, dropped]).values_list(
+                    "name", "refcount"
+                )
+            ),
+            [(kept, 1)],
+        )
+
+    def test_legacy_file_is_deleted(self):
+        os.makedirs(os.path.join(self.location, "uploads"))
+        with open(os.path.join(self.location, "uploads", "old.xlsm"), "wb") as f:
+            f.write(b"old")
+        self.storage.delete("uploads/old.xlsm")
+        self.assertEqual(self._files(), [])
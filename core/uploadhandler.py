@@ -0,0 +1,40 @@
+"""
+Upload handlers which hash each uploaded file as it is received.
+
+They behave as Django's own handlers but set sha256 on the UploadedFile,
+so ContentAddressedStorage can recognise a duplicate without reading the
+file again. Enabled by FILE_UPLOAD_HANDLERS.
+"""
+import hashlib
+
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+
+
+class HashingMixin:
+    def new_file(self, *args, **kwargs):
+        # before super(), which may raise StopFutureHandlers
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # a MemoryFileUploadHandler which is not activated passes the file on
+        if getattr(self, "activated", True):
+            self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self.digest.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingMixin, TemporaryFileUploadHandler):
+    pass
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ExcelparserConfig(AppConfig):
     name = 'excelparser'
+
+    def ready(self):
+        # connect the signal receivers that invalidate cached extraction plans
+        # and release the uploads of deleted Returns
+        from excelparser.helpers import extraction_plan, uploads  # noqa: F401
@@ -0,0 +1,220 @@
+import logging
+import os
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+from django.conf import settings
+from openpyxl import load_workbook
+
+from excelparser.helpers.extraction_plan import ExtractionPlan, PlannedCell
+from excelparser.helpers.extractors import extract_values
+from excelparser.helpers.memory import exceeds_streaming_threshold
+from excelparser.helpers.xlsx_reader import NativeWorkbook
+
+logger = logging.getLogger(__name__)
+
+OPENPYXL = "openpyxl"
+NATIVE = "native"
+
+ENGINES = [OPENPYXL, NATIVE]
+
+DEFAULT_ENGINE = OPENPYXL
+
+
+class UnknownEngineError(Exception):
+    pass
+
+
+class ExtractionMismatchError(Exception):
+    pass
+
+
+class ExtractedSheet:
+    """
+    The values extracted from one sheet, standing in for a worksheet so
+    that WorkSheetFromDatamap can convert them.
+    """
+
+    def __init__(self, title: str, values: List[Any]) -> None:
+        self.title = title
+        self._values = values
+
+    def extract_cells(self, cells: List[PlannedCell]) -> List[Any]:
+        if len(cells) != len(self._values):
+            raise ExtractionMismatchError(
+                f"{self.title} was extracted using a different extraction plan."
+            )
+        return list(self._values)
+
+
+class ExtractedWorkbook:
+    """
+    The raw values extracted from a populated template using an
+    ExtractionPlan, with no reference to the database or the file it came
+    from, so it can be pickled and passed between processes.
+
+    It stands in for an open workbook: it has sheetnames, supports
+    wb[sheet_name] and close().
+
+    peak_memory is how far the RSS of the process which extracted it rose,
+    in bytes, and timings the excelparser.helpers.instrumentation record of the
+    extraction, if they were measured.
+    """
+
+    peak_memory: Optional[int] = None
+    timings: Optional[Dict[str, Any]] = None
+
+    def __init__(
+        self,
+        filename: str,
+        sheetnames: List[str],
+        values: Dict[str, List[Any]],
+        plan_version: str,
+    ) -> None:
+        self.filename = filename
+        self.sheetnames = sheetnames
+        self.values = values
+        self.plan_version = plan_version
+
+    def __getitem__(self, sheet_name: str) -> ExtractedSheet:
+        if sheet_name not in self.sheetnames:
+            raise KeyError(f"Worksheet {sheet_name} does not exist.")
+        return ExtractedSheet(sheet_name, self.values.get(sheet_name, []))
+
+    def __eq__(self, other):
+        if not isinstance(other, ExtractedWorkbook):
+            return NotImplemented
+        return (self.sheetnames, self.values, self.plan_version) == (
+            other.sheetnames,
+            other.values,
+            other.plan_version,
+        )
+
+    def __repr__(self):
+        return f"ExtractedWorkbook({self.filename}, cells={self.cell_count})"
+
+    @property
+    def cell_count(self) -> int:
+        return sum(len(values) for values in self.values.values())
+
+    def close(self) -> None:
+        pass
+
+
+def resolve_engine(engine: Optional[str] = None) -> str:
+    """
+    The extraction engine to use. If engine is not given, the
+    PARSER_DEFAULT_ENGINE setting is used.
+    """
+    if engine is None:
+        engine = getattr(settings, "PARSER_DEFAULT_ENGINE", DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        raise UnknownEngineError(
+            f"{engine} is not an extraction engine. Use one of: {', '.join(ENGINES)}."
+        )
+    return engine
+
+
+def open_workbook(
+    source: Union[str, IO[bytes]], engine: Optional[str] = None, read_only: bool = False
+):
+    """
+    Open a populated template with the given engine. Whichever engine is
+    used, the result has sheetnames, supports wb[sheet_name] and must be
+    released with close().
+
+    The openpyxl engine loads cached values rather than formulae, in
+    read-only mode if read_only is True or the file is larger than the
+    PARSER_STREAMING_THRESHOLD setting. The native engine is always
+    streaming, so read_only makes no difference to it.
+    """
+    if resolve_engine(engine) == NATIVE:
+        return NativeWorkbook(source)
+    if not read_only and exceeds_streaming_threshold(source):
+        logger.info(f"Opening {source} in read-only mode because of its size")
+        read_only = True
+    return load_workbook(source, read_only=read_only, data_only=True)
+
+
+def extract_workbook(
+    source: Union[str, IO[bytes]],
+    plan: ExtractionPlan,
+    engine: Optional[str] = None,
+    read_only: bool = False,
+    filename: Optional[str] = None,
+) -> ExtractedWorkbook:
+    """
+    Extract the raw values of every cell in plan from a populated template
+    without touching the database. For each sheet in the plan that is
+    present in the workbook, the values are in the same order as
+    plan.cells_for(sheet).
+    """
+    if filename is None:
+        filename = os.path.basename(getattr(source, "name", None) or str(source))
+    wb = open_workbook(source, engine, read_only)
+    try:
+        values = {
+            sheet_name: extract_values(wb[sheet_name], plan.cells_for(sheet_name))
+            for sheet_name in plan.sheetnames
+            if sheet_name in wb.sheetnames
+        }
+        return ExtractedWorkbook(filename, list(wb.sheetnames), values, plan.version)
+    finally:
+        wb.close()
+
+
+def _union_cells(plans: List[ExtractionPlan], sheet_name: str) -> List[PlannedCell]:
+    cells: Dict[Tuple[int, int], PlannedCell] = {}
+    for plan in plans:
+        for cell in plan.cells_for(sheet_name):
+            cells.setdefault((cell.row, cell.col), cell)
+    return sorted(cells.values(), key=lambda c: (c.row, c.col))
+
+
+def extract_workbook_multi(
+    source: Union[str, IO[bytes]],
+    plans: List[ExtractionPlan],
+    engine: Optional[str] = None,
+    read_only: bool = False,
+    filename: Optional[str] = None,
+) -> List[ExtractedWorkbook]:
+    """
+    Extract the cells of several plans, e.g. for successive versions of a
+    Datamap, opening the workbook once and reading each cell once however
+    many plans refer to it. Returns an ExtractedWorkbook for each plan, in
+    the same order, equal to what extract_workbook would give for it.
+    """
+    if filename is None:
+        filename = os.path.basename(getattr(source, "name", None) or str(source))
+    sheet_names = []
+    for plan in plans:
+        sheet_names.extend(s for s in plan.sheetnames if s not in sheet_names)
+    wb = open_workbook(source, engine, read_only)
+    try:
+        values: Dict[str, Dict[Tuple[int, int], Any]] = {}
+        for sheet_name in sheet_names:
+            if sheet_name not in wb.sheetnames:
+                continue
+            cells = _union_cells(plans, sheet_name)
+            extracted = extract_values(wb[sheet_name], cells)
+            values[sheet_name] = {
+                (cell.row, cell.col): value for cell, value in zip(cells, extracted)
+            }
+        sheetnames = list(wb.sheetnames)
+    finally:
+        wb.close()
+    return [
+        ExtractedWorkbook(
+            filename,
+            sheetnames,
+            {
+                sheet_name: [
+                    values[sheet_name][(cell.row, cell.col)]
+                    for cell in plan.cells_for(sheet_name)
+                ]
+                for sheet_name in plan.sheetnames
+                if sheet_name in values
+            },
+            plan.version,
+        )
+        for plan in plans
+    ]
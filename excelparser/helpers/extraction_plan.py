@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from openpyxl.utils import column_index_from_string, coordinate_from_string
+
+from datamap.models import Datamap, DatamapLine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAN_CACHE_SIZE = 32
+
+_GENERATION_CACHE_KEY = "excelparser:extraction-plan-generation:{}"
+
+
+class PlannedCell(NamedTuple):
+    """
+    A single cell the Datamap wants extracted from a sheet.
+    """
+
+    row: int
+    col: int
+    key: str
+    datamapline_id: int
+    data_type: str
+    cell_ref: str
+    required: bool = True
+    max_length: Optional[int] = None
+
+
+class ExtractionPlan:
+    """
+    A compiled, read-only view of a Datamap: for each sheet, the cells
+    to extract sorted by (row, col). Building one costs a single query;
+    ParsedSpreadsheet and WorkSheetFromDatamap then work from the plan
+    rather than going back to the database for each sheet.
+    """
+
+    def __init__(
+        self, datamap_id: int, sheets: Dict[str, List[PlannedCell]], generation=None
+    ) -> None:
+        self.datamap_id = datamap_id
+        self.generation = generation
+        self._sheets = sheets
+        self.version = self._fingerprint()
+
+    def __len__(self):
+        return sum(len(cells) for cells in self._sheets.values())
+
+    def __contains__(self, sheet_name):
+        return sheet_name in self._sheets
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return list(self._sheets.keys())
+
+    def cells_for(self, sheet_name: str) -> List[PlannedCell]:
+        """
+        The cells to extract from sheet_name, in (row, col) order. Sheets
+        not referenced by the Datamap have no cells.
+        """
+        return self._sheets.get(sheet_name, [])
+
+    def _fingerprint(self) -> str:
+        h = hashlib.sha1()
+        for sheet_name in sorted(self._sheets):
+            for cell in self._sheets[sheet_name]:
+                _line = [sheet_name, cell.cell_ref, cell.key, str(cell.datamapline_id)]
+                _line += [cell.data_type, str(cell.required), str(cell.max_length)]
+                h.update("|".join(_line).encode("utf-8"))
+        return h.hexdigest()
+
+    def __repr__(self):
+        return f"ExtractionPlan(datamap={self.datamap_id}, cells={len(self)})"
+
+
+def cell_ref_to_row_col(cell_ref: str) -> Tuple[int, int]:
+    """
+    Convert an Excel cell reference, e.g. 'B10', into a (row, col) tuple of
+    1-based indices.
+    """
+    column_letter, row = coordinate_from_string(cell_ref.upper())
+    return row, column_index_from_string(column_letter)
+
+
+def compile_extraction_plan(datamap: Datamap, generation=None) -> ExtractionPlan:
+    """
+    Build an ExtractionPlan for datamap using one query.
+    """
+    lines = DatamapLine.objects.filter(datamap=datamap).values_list(
+        "id", "key", "sheet", "cell_ref", "data_type", "required", "max_length"
+    )
+    sheets: Dict[str, List[PlannedCell]] = OrderedDict()
+    for dml_id, key, sheet, cell_ref, data_type, required, max_length in lines:
+        row, col = cell_ref_to_row_col(cell_ref)
+        sheets.setdefault(sheet, []).append(
+            PlannedCell(
+                row, col, key, dml_id, data_type, cell_ref, required, max_length
+            )
+        )
+    for cells in sheets.values():
+        cells.sort(key=lambda c: (c.row, c.col))
+    return ExtractionPlan(datamap.pk, sheets, generation)
+
+
+class _PlanCache:
+    """
+    In-process LRU cache of compiled ExtractionPlan objects, keyed by
+    Datamap id.
+
+    Each process keeps its own plans, so invalidation is also published
+    as a generation token through Django's cache framework: a plan is
+    only reused while the token it was compiled under is still current,
+    which lets a DatamapLine edited in the web process invalidate the
+    plans held by the Celery workers. A token which is missing, because
+    it was never set or has been culled, is replaced by a new one rather
+    than matched, so a plan is never reused without a token.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._plans: "OrderedDict[int, ExtractionPlan]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _generation(self, datamap_id: int) -> Optional[str]:
+        key = _GENERATION_CACHE_KEY.format(datamap_id)
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            generation = cache.get(key)
+        return generation
+
+    def get(self, datamap: Datamap) -> ExtractionPlan:
+        generation = self._generation(datamap.pk)
+        with self._lock:
+            plan = self._plans.get(datamap.pk)
+            if (
+                plan is not None
+                and generation is not None
+                and plan.generation == generation
+            ):
+                self._plans.move_to_end(datamap.pk)
+                return plan
+        plan = compile_extraction_plan(datamap, generation)
+        logger.debug(f"Compiled {plan}")
+        with self._lock:
+            self._plans[datamap.pk] = plan
+            self._plans.move_to_end(datamap.pk)
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+        return plan
+
+    def invalidate(self, datamap_id: int) -> None:
+        with self._lock:
+            self._plans.pop(datamap_id, None)
+        cache.set(_GENERATION_CACHE_KEY.format(datamap_id), uuid.uuid4().hex, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+
+
+_plan_cache = _PlanCache(
+    getattr(settings, "EXTRACTION_PLAN_CACHE_SIZE", DEFAULT_PLAN_CACHE_SIZE)
+)
+
+
+def get_extraction_plan(datamap: Datamap) -> ExtractionPlan:
+    """
+    Return the compiled ExtractionPlan for datamap, compiling it only if
+    there is no current plan cached for it.
+    """
+    return _plan_cache.get(datamap)
+
+
+def invalidate_extraction_plan(datamap_id: Optional[int]) -> None:
+    if datamap_id is not None:
+        _plan_cache.invalidate(datamap_id)
+
+
+@receiver(post_save, sender=DatamapLine)
+@receiver(post_delete, sender=DatamapLine)
+def invalidate_plan_on_datamapline_change(sender, instance, **kwargs):
+    invalidate_extraction_plan(instance.datamap_id)
@@ -0,0 +1,63 @@
+from typing import Any, List
+
+from openpyxl.worksheet import Worksheet as OpenpyxlWorksheet
+from openpyxl.worksheet.read_only import ReadOnlyWorksheet
+
+from excelparser.helpers.extraction_plan import PlannedCell
+
+
+def random_access_extract(
+    worksheet: OpenpyxlWorksheet, cells: List[PlannedCell]
+) -> List[Any]:
+    """
+    Look up each cell in turn. Cheap for a fully loaded worksheet, where
+    the cells are already in memory, but every lookup rescans the sheet
+    XML when the worksheet is read-only.
+    """
+    return [worksheet[cell.cell_ref].value for cell in cells]
+
+
+def sweep_extract(worksheet: OpenpyxlWorksheet, cells: List[PlannedCell]) -> List[Any]:
+    """
+    Read the values of cells, which must be sorted by (row, col), in a
+    single pass over the worksheet. Only the rectangle bounding the cells
+    is iterated, and iteration stops once the row holding the last cell
+    has been read, so memory use does not depend on the size of the sheet.
+
+    Returns the values in the same order as cells.
+    """
+    if not cells:
+        return []
+    min_row, max_row = cells[0].row, cells[-1].row
+    min_col = min(cell.col for cell in cells)
+    max_col = max(cell.col for cell in cells)
+    values: List[Any] = [None] * len(cells)
+    position = 0
+    rows = worksheet.iter_rows(
+        min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col
+    )
+    try:
+        for row_idx, row in enumerate(rows, start=min_row):
+            while position < len(cells) and cells[position].row == row_idx:
+                col_offset = cells[position].col - min_col
+                if col_offset < len(row):
+                    values[position] = row[col_offset].value
+                position += 1
+            if position == len(cells):
+                break
+    finally:
+        rows.close()
+    return values
+
+
+def extract_values(worksheet: OpenpyxlWorksheet, cells: List[PlannedCell]) -> List[Any]:
+    """
+    Extract the values of cells from worksheet using whichever strategy
+    suits the way the worksheet was loaded.
+    """
+    if hasattr(worksheet, "extract_cells"):
+        # excelparser.helpers.xlsx_reader.NativeWorksheet
+        return worksheet.extract_cells(cells)
+    if isinstance(worksheet, ReadOnlyWorksheet):
+        return sweep_extract(worksheet, cells)
+    return random_access_extract(worksheet, cells)
@@ -0,0 +1,343 @@
+"""
+Parallel ingest of populated templates.
+
+Parsing a workbook is CPU bound while writing its ReturnItems is not, so
+the two are split: a pool of worker processes extracts the raw cell values
+of each file against a compiled ExtractionPlan, without touching the
+database, and hands back a compact ExtractedWorkbook (from the parse cache
+if the file has been seen before). The parent process
+is the single writer, persisting each result as it arrives. A replaced
+Return is written as a staging Return and swapped in at the end, so
+readers never see it half written.
+"""
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import resource
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from datamap.models import Datamap
+from excelparser.helpers.engines import ExtractedWorkbook
+from excelparser.helpers.extraction_plan import ExtractionPlan, get_extraction_plan
+from excelparser.helpers.instrumentation import (
+    BYTES_READ,
+    CACHE_HITS,
+    EXTRACT,
+    Instrumentation,
+    emit_batch,
+)
+from excelparser.helpers.memory import MemoryMonitor, ParserMemoryError, file_size
+from excelparser.helpers.parse_cache import cached_extract_workbook
+from excelparser.helpers.parser import ParsedSpreadsheet
+from register.models import FinancialQuarter, Project
+from returns.models import Return
+from returns.signals import returns_changed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_TASKS_PER_WORKER = 10
+
+# how a file is ingested when its project already has a Return for the quarter
+REPLACE = "replace"
+UPSERT = "upsert"
+
+REINGEST_MODES = [REPLACE, UPSERT]
+
+
+class ReingestModeError(Exception):
+    pass
+
+
+class IngestJob(NamedTuple):
+    """A populated template to ingest, and the project it belongs to."""
+
+    path: str
+    project_name: str
+
+
+class IngestResult(NamedTuple):
+    path: str
+    project_name: str
+    return_id: Optional[int]
+    cell_count: int
+    error: Optional[str]
+    timings: Optional[Dict[str, Any]] = None
+
+
+class _WorkerResult(NamedTuple):
+    job: IngestJob
+    extracted: Optional[ExtractedWorkbook]
+    error: Optional[str]
+
+
+def resolve_reingest_mode(mode: Optional[str] = None) -> str:
+    """
+    The re-ingest mode to use. If mode is not given, the REINGEST_MODE
+    setting is used.
+    """
+    if mode is None:
+        mode = getattr(settings, "REINGEST_MODE", UPSERT)
+    if mode not in REINGEST_MODES:
+        raise ReingestModeError(
+            f"{mode} is not a re-ingest mode. Use one of: {', '.join(REINGEST_MODES)}."
+        )
+    return mode
+
+
+def stage_return(project: Project, financial_quarter: FinancialQuarter) -> Return:
+    """
+    A new, empty staging Return for project and financial_quarter, which
+    readers do not see (Return.objects leaves it out) until it is promoted.
+    """
+    return Return.all_objects.create(
+        project=project,
+        financial_quarter=financial_quarter,
+        staging_key=uuid.uuid4().hex,
+    )
+
+
+def promote_return(staged: Return) -> Return:
+    """
+    Swap a fully written staging Return in for the live one, in one short
+    transaction: the live Return and its ReturnItems are deleted and staged
+    becomes live. Readers see either the old Return or the new one, never
+    a partly written one.
+    """
+    with transaction.atomic():
+        Return.objects.filter(
+            project_id=staged.project_id,
+            financial_quarter_id=staged.financial_quarter_id,
+        ).delete()
+        Return.all_objects.filter(pk=staged.pk).update(staging_key="")
+        returns_changed.send(
+            sender=Return, financial_quarter_id=staged.financial_quarter_id
+        )
+    staged.staging_key = ""
+    return staged
+
+
+def return_for_ingest(
+    project: Project, financial_quarter: FinancialQuarter, mode: Optional[str] = None
+) -> Return:
+    """
+    The Return to ingest a file into. In "replace" mode this is a new
+    staging Return, to be promote_return()ed in place of any existing one
+    once its ReturnItems are written. In "upsert" mode the existing Return
+    is kept, so its pk and URLs are stable, and ParsedSpreadsheet(...,
+    upsert=True) diffs the new values against its ReturnItems in a single
+    transaction.
+    """
+    if resolve_reingest_mode(mode) == REPLACE:
+        return stage_return(project, financial_quarter)
+    return_obj, _ = Return.objects.get_or_create(
+        project=project, financial_quarter=financial_quarter
+    )
+    return return_obj
+
+
+@contextmanager
+def ingesting(
+    project: Project, financial_quarter: FinancialQuarter, mode: Optional[str] = None
+) -> Iterator[Return]:
+    """
+    The return_for_ingest() to write into inside the block. A staging
+    Return is promoted when the block completes, or deleted if it raises.
+    """
+    return_obj = return_for_ingest(project, financial_quarter, mode)
+    try:
+        yield return_obj
+    except BaseException:
+        if return_obj.staging:
+            Return.all_objects.filter(pk=return_obj.pk).delete()
+        raise
+    if return_obj.staging:
+        promote_return(return_obj)
+
+
+def source_key(sha256: str, plan: ExtractionPlan) -> str:
+    """
+    Identifies a file by its hash and the version of the Datamap it is
+    ingested against, as recorded on Return.source_key.
+    """
+    return f"{sha256}:{plan.datamap_id}:{plan.version}"
+
+
+def unchanged_return(
+    project: Project, financial_quarter: FinancialQuarter, key: str
+) -> Optional[Return]:
+    """
+    The Return for project and financial_quarter if it was last ingested
+    from the file identified by key, in which case ingesting it again
+    would change nothing.
+    """
+    return Return.objects.filter(
+        project=project, financial_quarter=financial_quarter, source_key=key
+    ).first()
+
+
+def _init_worker(memory_limit: Optional[int]) -> None:
+    """
+    Cap the address space of a worker so that a pathological workbook
+    raises MemoryError in that worker rather than exhausting the host.
+    """
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def worker_pool(
+    job_count: int, workers: Optional[int] = None, memory_limit: Optional[int] = None
+) -> multiprocessing.pool.Pool:
+    """
+    A pool of at most workers processes (INGEST_WORKERS, or one per CPU, by
+    default) for job_count jobs, each capped at memory_limit bytes of
+    address space (INGEST_WORKER_MEMORY_LIMIT) and replaced after
+    INGEST_WORKER_MAX_TASKS jobs.
+
+    The workers are forked, and would share this process's database
+    connections, so those are closed first and reopened by this process
+    when it next queries. A connection inside a transaction is left open,
+    as closing it would lose the transaction; the workers never use it.
+    """
+    if workers is None:
+        workers = getattr(settings, "INGEST_WORKERS", None) or os.cpu_count()
+    if memory_limit is None:
+        memory_limit = getattr(settings, "INGEST_WORKER_MEMORY_LIMIT", None)
+    max_tasks = getattr(
+        settings, "INGEST_WORKER_MAX_TASKS", DEFAULT_MAX_TASKS_PER_WORKER
+    )
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+    return multiprocessing.Pool(
+        processes=min(workers, job_count) or 1,
+        initializer=_init_worker,
+        initargs=(memory_limit,),
+        maxtasksperchild=max_tasks,
+    )
+
+
+def extract_for_ingest(
+    path: str,
+    plan: ExtractionPlan,
+    engine: Optional[str] = None,
+    read_only: bool = True,
+    sha256: Optional[str] = None,
+) -> ExtractedWorkbook:
+    """
+    Extract the values in plan from the template at path, or fetch them
+    from the parse cache, measuring the memory and time taken. The results
+    are kept on the ExtractedWorkbook as peak_memory and timings, where
+    ParsedSpreadsheet picks them up.
+    """
+    filename = os.path.basename(path)
+    timer = Instrumentation(filename)
+    with MemoryMonitor(label=filename) as memory, timer.stage(EXTRACT):
+        extracted, hit = cached_extract_workbook(
+            path, plan, engine=engine, read_only=read_only, sha256=sha256
+        )
+    timer.count(BYTES_READ, file_size(path) or 0)
+    timer.count(CACHE_HITS, int(hit))
+    extracted.peak_memory = memory.peak_increase
+    extracted.timings = timer.record()
+    return extracted
+
+
+def _extract_in_worker(args) -> _WorkerResult:
+    job, plan, engine, read_only = args
+    try:
+        extracted = extract_for_ingest(job.path, plan, engine, read_only)
+    except ParserMemoryError as e:
+        return _WorkerResult(job, None, str(e))
+    except Exception as e:
+        return _WorkerResult(job, None, f"{type(e).__name__}: {e}")
+    return _WorkerResult(job, extracted, None)
+
+
+def _persist(
+    worker_result: _WorkerResult,
+    financial_quarter: FinancialQuarter,
+    datamap: Datamap,
+    write_strategy: Optional[str],
+    mode: str,
+) -> IngestResult:
+    job = worker_result.job
+    if worker_result.error is not None:
+        return IngestResult(job.path, job.project_name, None, 0, worker_result.error)
+    extracted = worker_result.extracted
+    try:
+        project = Project.objects.get(name=job.project_name)
+        with ingesting(project, financial_quarter, mode) as return_obj:
+            parsed = ParsedSpreadsheet(
+                job.path,
+                project,
+                return_obj,
+                datamap,
+                write_strategy=write_strategy,
+                extracted=extracted,
+                upsert=mode == UPSERT,
+            )
+            parsed.process()
+    except Exception as e:
+        return IngestResult(
+            job.path, job.project_name, None, 0, f"{type(e).__name__}: {e}"
+        )
+    return IngestResult(
+        job.path,
+        job.project_name,
+        return_obj.pk,
+        extracted.cell_count,
+        None,
+        parsed.timings,
+    )
+
+
+def parallel_ingest(
+    jobs: Iterable[IngestJob],
+    financial_quarter: FinancialQuarter,
+    datamap: Datamap,
+    workers: Optional[int] = None,
+    memory_limit: Optional[int] = None,
+    engine: Optional[str] = None,
+    read_only: bool = True,
+    write_strategy: Optional[str] = None,
+    mode: Optional[str] = None,
+) -> List[IngestResult]:
+    """
+    Ingest populated templates in parallel, creating a Return for each one.
+
+    Extraction runs in a worker_pool() of workers processes, each capped
+    at memory_limit bytes of address space. Results are written
+    one at a time by this process, so a file that fails to extract or
+    persist is reported in its IngestResult and does not affect the others.
+    Each IngestResult carries the timings of its file, and their aggregate
+    is logged for the batch (see excelparser.helpers.instrumentation).
+    An existing Return for a project is replaced or updated according to
+    mode (see return_for_ingest).
+    """
+    jobs = list(jobs)
+    mode = resolve_reingest_mode(mode)
+    plan: ExtractionPlan = get_extraction_plan(datamap)
+    work = [(job, plan, engine, read_only) for job in jobs]
+    results: List[IngestResult] = []
+    # the plan is compiled before the pool forks: workers never query the database
+    with worker_pool(len(jobs), workers, memory_limit) as pool:
+        for worker_result in pool.imap_unordered(_extract_in_worker, work):
+            result = _persist(
+                worker_result, financial_quarter, datamap, write_strategy, mode
+            )
+            if result.error:
+                logger.error(f"Failed to ingest {result.path}: {result.error}")
+            else:
+                logger.info(f"Ingested {result.path} ({result.cell_count} cells)")
+            results.append(result)
+    emit_batch(
+        (result.timings for result in results if result.timings),
+        failed=sum(1 for result in results if result.error),
+    )
+    return results
@@ -0,0 +1,140 @@
+"""
+Per-stage timings and counters for the ingest pipeline.
+
+An Instrumentation records how long each stage of ingesting one file took
+(opening the workbook, extracting cells, detecting types, building and
+writing ReturnItems) along with counters such as cells read, bytes read,
+rows written and queries issued. record() gives a JSON-serialisable dict
+for the file, and emit() logs it as a single JSON line to this module's
+logger, "excelparser.helpers.instrumentation". aggregate() combines the
+records of a batch.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# stages, in pipeline order
+OPEN = "open"
+EXTRACT = "extract"
+DETECT_TYPES = "detect_types"
+BUILD_ITEMS = "build_items"
+WRITE = "write"
+
+# counters
+BYTES_READ = "bytes_read"
+CELLS_READ = "cells_read"
+SHEETS_READ = "sheets_read"
+ROWS_WRITTEN = "rows_written"
+QUERIES = "queries"
+CACHE_HITS = "cache_hits"
+
+
+class Instrumentation:
+    def __init__(self, label: str, record: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Start timing the file called label, carrying on from an earlier
+        record for it (e.g. one made in an ingest worker) if given.
+        """
+        self.label = label
+        self.stages: Dict[str, float] = OrderedDict()
+        self.counters: Dict[str, int] = OrderedDict()
+        self._elapsed = 0.0
+        self._started = time.perf_counter()
+        if record is not None:
+            self.merge(record)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the enclosed block, adding it to any time already spent in the
+        stage called name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Count the database queries issued by the enclosed block.
+        """
+
+        def _counter(execute, sql, params, many, context):
+            self.count(QUERIES)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(_counter):
+            yield
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, record: Dict[str, Any]) -> None:
+        for name, seconds in record.get("stages", {}).items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for name, n in record.get("counters", {}).items():
+            self.count(name, n)
+        self._elapsed += record.get("total", 0.0)
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "file": self.label,
+            "total": round(self._elapsed + time.perf_counter() - self._started, 6),
+            "stages": {name: round(s, 6) for name, s in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def emit(self) -> Dict[str, Any]:
+        """
+        Log the record for this file as JSON, and return it.
+        """
+        record = self.record()
+        logger.info(json.dumps(record))
+        return record
+
+
+def aggregate(records: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine the records for the files in a batch: stage times, totals and
+    counters are summed, and the slowest file is named.
+    """
+    stages: Dict[str, float] = OrderedDict()
+    counters: Dict[str, int] = OrderedDict()
+    total = 0.0
+    files = 0
+    slowest = None
+    for record in records:
+        files += 1
+        total += record["total"]
+        if slowest is None or record["total"] > slowest["total"]:
+            slowest = record
+        for name, seconds in record["stages"].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+        for name, n in record["counters"].items():
+            counters[name] = counters.get(name, 0) + n
+    return {
+        "files": files,
+        "total": round(total, 6),
+        "stages": {name: round(s, 6) for name, s in stages.items()},
+        "counters": counters,
+        "slowest": slowest["file"] if slowest else None,
+    }
+
+
+def emit_batch(records: Iterable[Dict[str, Any]], **extra) -> Dict[str, Any]:
+    """
+    Log the aggregate of a batch's records as JSON, and return it.
+    """
+    summary = aggregate(records)
+    summary.update(extra)
+    logger.info(json.dumps({"batch": summary}))
+    return summary
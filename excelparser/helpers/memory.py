@@ -0,0 +1,263 @@
+"""
+Measuring and bounding the memory used to parse a populated template.
+
+A MemoryMonitor samples the resident set size of the process on a
+background thread while a template is parsed, optionally tracing Python
+allocations with tracemalloc as well. Given a budget, it also lowers the
+process's address space limit for the duration, so a workbook too big to
+parse raises MemoryError, reported as a ParserMemoryError, rather than
+growing until the kernel kills the worker.
+"""
+import logging
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+from typing import IO, Dict, Optional, Union
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.05
+
+MB = 1024 * 1024
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ParserMemoryError(Exception):
+    pass
+
+
+def _statm() -> Optional[tuple]:
+    try:
+        with open("/proc/self/statm") as f:
+            size, resident = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    return int(size) * _PAGE_SIZE, int(resident) * _PAGE_SIZE
+
+
+def current_rss() -> int:
+    """
+    The resident set size of this process in bytes. Where /proc is not
+    available this is the peak RSS of the process so far.
+    """
+    statm = _statm()
+    if statm is not None:
+        return statm[1]
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def file_size(source: Union[str, IO[bytes]]) -> Optional[int]:
+    """
+    The size in bytes of a file given its path or a file object, or None
+    if it cannot be found without reading the file.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            return None
+    size = getattr(source, "size", None)
+    if size is not None:
+        return size
+    try:
+        position = source.tell()
+        size = source.seek(0, os.SEEK_END)
+        source.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return None
+
+
+def exceeds_streaming_threshold(source: Union[str, IO[bytes]]) -> bool:
+    """
+    Whether a template is big enough, by the PARSER_STREAMING_THRESHOLD
+    setting, that it should only be read in streaming mode.
+    """
+    threshold = getattr(settings, "PARSER_STREAMING_THRESHOLD", None)
+    if threshold is None:
+        return False
+    size = file_size(source)
+    return size is not None and size > threshold
+
+
+class _AddressSpaceLimit:
+    """
+    RLIMIT_AS is shared by every thread in the process, so the limits of
+    the MemoryMonitors running at once are combined: the lowest applies,
+    and the limit the process had before the first is restored when the
+    last is released, in whatever order they stop.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._limits: Dict[int, int] = {}
+        self._saved: Optional[tuple] = None
+
+    def acquire(self, owner: int, limit: int) -> None:
+        with self._lock:
+            if not self._limits:
+                self._saved = resource.getrlimit(resource.RLIMIT_AS)
+            self._limits[owner] = limit
+            self._apply()
+
+    def release(self, owner: int) -> None:
+        with self._lock:
+            if self._limits.pop(owner, None) is None:
+                return
+            if self._limits:
+                self._apply()
+            else:
+                resource.setrlimit(resource.RLIMIT_AS, self._saved)
+                self._saved = None
+
+    def _apply(self) -> None:
+        soft, hard = self._saved
+        limit = min(self._limits.values())
+        if soft != resource.RLIM_INFINITY:
+            limit = min(limit, soft)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+_address_space_limit = _AddressSpaceLimit()
+
+
+class MemoryMonitor:
+    """
+    Tracks the peak memory used between start() and stop(). It may be
+    started again, for the next stage of the same parse, and keeps
+    measuring from its first start().
+
+    peak_rss is the highest resident set size of the process sampled every
+    interval seconds, and peak_increase how far that is above the RSS at
+    the first start(); with trace=True, peak_traced is the peak of Python
+    allocations as reported by tracemalloc, which is precise but slows
+    parsing down.
+
+    With a budget in bytes, the process may allocate no more than budget
+    bytes of address space beyond what it had at the first start();
+    monitors may overlap (see _AddressSpaceLimit). Used as a context
+    manager, a MemoryError raised inside is turned into a
+    ParserMemoryError.
+    """
+
+    def __init__(
+        self,
+        budget: Optional[int] = None,
+        interval: Optional[float] = None,
+        trace: Optional[bool] = None,
+        label: str = "the template",
+    ) -> None:
+        if budget is None:
+            budget = getattr(settings, "PARSER_MEMORY_BUDGET", None)
+        if interval is None:
+            interval = getattr(
+                settings, "PARSER_MEMORY_SAMPLE_INTERVAL", DEFAULT_SAMPLE_INTERVAL
+            )
+        if trace is None:
+            trace = getattr(settings, "PARSER_TRACEMALLOC", False)
+        self.budget = budget
+        self.interval = interval
+        self.trace = trace
+        self.label = label
+        self.baseline_rss: Optional[int] = None
+        self.peak_rss: Optional[int] = None
+        self.peak_traced: Optional[int] = None
+        self._address_space_base: Optional[int] = None
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_tracing = False
+
+    @property
+    def running(self) -> bool:
+        return self._sampler is not None
+
+    @property
+    def peak_increase(self) -> Optional[int]:
+        if self.peak_rss is None:
+            return None
+        return max(self.peak_rss - self.baseline_rss, 0)
+
+    def start(self) -> "MemoryMonitor":
+        if self.running:
+            return self
+        if self.baseline_rss is None:
+            self.baseline_rss = current_rss()
+        self._record_rss()
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._stop.clear()
+        self._sampler = threading.Thread(
+            target=self._sample, name="parser-memory-monitor", daemon=True
+        )
+        self._sampler.start()
+        # after starting the sampler, whose stack counts against the limit
+        if self.budget is not None:
+            self._limit_address_space()
+        return self
+
+    def stop(self) -> Optional[int]:
+        """
+        Stop monitoring, lift the budget and return peak_rss.
+        """
+        if not self.running:
+            return self.peak_rss
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+        self._record_rss()
+        _address_space_limit.release(id(self))
+        if self.trace and tracemalloc.is_tracing():
+            self.peak_traced = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        logger.debug(
+            f"Peak memory parsing {self.label}: RSS {self.peak_rss / MB:.1f} MB, "
+            f"{self.peak_increase / MB:.1f} MB above the start"
+        )
+        return self.peak_rss
+
+    def budget_exceeded(self) -> ParserMemoryError:
+        if self.budget is None:
+            return ParserMemoryError(f"Ran out of memory parsing {self.label}.")
+        return ParserMemoryError(
+            f"Parsing {self.label} needed more than the memory budget of "
+            f"{self.budget / MB:.0f} MB. Remove any large images or pivot caches "
+            f"from the workbook and try again."
+        )
+
+    def __enter__(self) -> "MemoryMonitor":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        if exc_type is not None and issubclass(exc_type, MemoryError):
+            raise self.budget_exceeded() from exc
+
+    def _limit_address_space(self) -> None:
+        statm = _statm()
+        if statm is None:
+            logger.warning("Cannot enforce a memory budget without /proc/self/statm")
+            return
+        if self._address_space_base is None:
+            self._address_space_base = statm[0]
+        _address_space_limit.acquire(id(self), self._address_space_base + self.budget)
+
+    def _record_rss(self) -> None:
+        rss = current_rss()
+        if self.peak_rss is None or rss > self.peak_rss:
+            self.peak_rss = rss
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._record_rss()
@@ -0,0 +1,192 @@
+"""
+A cache of extracted cell values, so that a template which is uploaded
+again byte for byte is not parsed again.
+
+Entries are keyed by the SHA-256 of the file, the Datamap id, the version
+of its ExtractionPlan and the extraction engine, so editing the Datamap or
+switching engine misses the cache.
+Each entry is a zlib-compressed pickle of an ExtractedWorkbook in
+PARSE_CACHE_DIR. When the directory grows beyond PARSE_CACHE_MAX_BYTES the
+least recently used entries are removed.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import zlib
+from pathlib import Path
+from typing import IO, NamedTuple, Optional, Tuple, Union
+
+from django.conf import settings
+
+from excelparser.helpers.engines import (
+    ExtractedWorkbook,
+    extract_workbook,
+    resolve_engine,
+)
+from excelparser.helpers.extraction_plan import ExtractionPlan
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+_SUFFIX = ".pickle.z"
+
+
+class CacheKey(NamedTuple):
+    sha256: str
+    datamap_id: int
+    plan_version: str
+    engine: str
+
+    @property
+    def filename(self) -> str:
+        return (
+            f"{self.sha256}-{self.datamap_id}-{self.plan_version}-{self.engine}"
+            f"{_SUFFIX}"
+        )
+
+
+def hash_file(source: Union[str, IO[bytes]]) -> str:
+    """
+    The SHA-256 hex digest of a file, given its path or a binary file
+    object, which is hashed from the start and rewound afterwards.
+    """
+    digest = hashlib.sha256()
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    else:
+        source.seek(0)
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        source.seek(0)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    def __init__(self, directory: Union[str, Path], max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, key: CacheKey) -> Path:
+        return self.directory / key.sha256[:2] / key.filename
+
+    def get(self, key: CacheKey) -> Optional[ExtractedWorkbook]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                extracted = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Discarding unreadable parse cache entry {path}: {e}")
+            self._remove(path)
+            return None
+        try:
+            # mark as recently used for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return extracted
+
+    def set(self, key: CacheKey, extracted: ExtractedWorkbook) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = zlib.compress(pickle.dumps(extracted, pickle.HIGHEST_PROTOCOL))
+        # write to a temporary file and rename it so that concurrent readers
+        # never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries until the cache is no larger
+        than max_bytes. Returns the number of entries removed.
+        """
+        entries = []
+        total = 0
+        for path in self.directory.glob(f"*/*{_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self) -> None:
+        for path in self.directory.glob(f"*/*{_SUFFIX}"):
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: Union[str, Path]) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_parse_cache() -> Optional[ParseCache]:
+    """
+    The cache configured by PARSE_CACHE_DIR, or None if it is not set.
+    """
+    directory = getattr(settings, "PARSE_CACHE_DIR", None)
+    if not directory:
+        return None
+    max_bytes = getattr(settings, "PARSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)
+    return ParseCache(directory, max_bytes)
+
+
+def cached_extract_workbook(
+    source: Union[str, IO[bytes]],
+    plan: ExtractionPlan,
+    engine: Optional[str] = None,
+    read_only: bool = False,
+    filename: Optional[str] = None,
+    cache: Optional[ParseCache] = None,
+    sha256: Optional[str] = None,
+) -> Tuple[ExtractedWorkbook, bool]:
+    """
+    Extract the values in plan from source, or fetch them from the parse
+    cache if this file has been extracted with the same plan before. Pass
+    the file's sha256, if already known, to save hashing it again.
+
+    Returns the ExtractedWorkbook and whether it came from the cache.
+    """
+    if cache is None:
+        cache = get_parse_cache()
+    if cache is None:
+        return extract_workbook(source, plan, engine, read_only, filename), False
+    if filename is None:
+        filename = os.path.basename(getattr(source, "name", None) or str(source))
+    engine = resolve_engine(engine)
+    key = CacheKey(sha256 or hash_file(source), plan.datamap_id, plan.version, engine)
+    extracted = cache.get(key)
+    if extracted is not None:
+        # the same bytes may have been uploaded under another name
+        extracted.filename = filename
+        return extracted, True
+    extracted = extract_workbook(source, plan, engine, read_only, filename)
+    try:
+        cache.set(key, extracted)
+    except OSError as e:
+        logger.warning(f"Could not write to the parse cache: {e}")
+    return extracted, False
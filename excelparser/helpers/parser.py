@@ -2,16 +2,44 @@ import logging
 import datetime
 import numbers
 import os
+from array import array
+from contextlib import contextmanager
 from enum import Enum, auto
-from typing import Any, Dict, List, NamedTuple, Iterable
+from typing import IO, Any, Dict, Iterable, List, NamedTuple, Optional, Union
 
-from openpyxl import Workbook as OpenpyxlWorkbook
-from openpyxl import load_workbook
 from openpyxl.worksheet import Worksheet as OpenpyxlWorksheet
 
-from datamap.models import Datamap, DatamapLine
+from datamap.models import Datamap
+from excelparser.helpers.engines import (
+    ExtractedWorkbook,
+    ExtractionMismatchError,
+    extract_workbook_multi,
+    open_workbook,
+    resolve_engine,
+)
+from excelparser.helpers.extraction_plan import (
+    ExtractionPlan,
+    PlannedCell,
+    get_extraction_plan,
+)
+from excelparser.helpers.extractors import extract_values
+from excelparser.helpers.instrumentation import (
+    BUILD_ITEMS,
+    BYTES_READ,
+    CELLS_READ,
+    DETECT_TYPES,
+    EXTRACT,
+    OPEN,
+    ROWS_WRITTEN,
+    SHEETS_READ,
+    WRITE,
+    Instrumentation,
+)
+from excelparser.helpers.memory import MemoryMonitor, file_size
+from excelparser.helpers.persistence import sync_return_items, write_return_items
 from register.models import Project
 from returns.models import Return, ReturnItem
+from returns.signals import returns_changed
 
 SheetData = Dict[str, "WorkSheetFromDatamap"]
 
@@ -26,12 +54,66 @@ class MissingSheetError(Exception):
 class ParsedSpreadsheet:
     """
     A single spreadsheet whose data can be extracted using a Datamap upon
-    calling the process() method. Data per sheet is then available via
-    a processed_spreadsheet['sheet_name'] basis.
+    calling the process() method, which converts only the sheets referenced
+    by the Datamap. Data per sheet is available via
+    processed_spreadsheet['sheet_name']: a sheet is converted the first
+    time it is asked for and then cached, so a caller that needs one sheet
+    only pays for that sheet, with or without calling process().
+
+    template_path is the path of the template or a binary file object open
+    on it, such as a Django UploadedFile, so an upload can be parsed
+    without first being saved to storage.
+
+    The workbook is opened once only, and stays open until process() or
+    close() is called. Pass read_only=True to open it in openpyxl's
+    read-only mode, which streams cells from the file rather than building
+    the whole workbook in memory.
+
+    engine selects how cell values are read: "openpyxl", or "native", which
+    streams the cached values straight out of the .xlsm package without
+    openpyxl (see excelparser.helpers.xlsx_reader). Defaults to the
+    PARSER_DEFAULT_ENGINE setting.
+
+    Memory is measured while the workbook is opened and while process()
+    converts the sheets, and the peak increase is recorded on return_obj.
+    With a memory_budget in bytes (by default the PARSER_MEMORY_BUDGET
+    setting), which covers both, running out raises a ParserMemoryError;
+    see excelparser.helpers.memory.MemoryMonitor.
+
+    Each stage is timed by instrumentation (see
+    excelparser.helpers.instrumentation), and process() logs the JSON
+    record for the file and keeps it as timings.
+
+    If the cell values have already been extracted, e.g. in a worker
+    process by excelparser.helpers.ingest, pass the ExtractedWorkbook as
+    extracted and the file itself is not opened again. for_datamaps()
+    parses a spreadsheet against several Datamaps this way in one pass.
+
+    ReturnItems for the whole spreadsheet are written in one transaction
+    using write_strategy ("create", "bulk_create", "copy" or "auto"); see
+    excelparser.helpers.persistence. If upsert is True, return_obj may
+    already have ReturnItems: they are diffed against the parsed values and
+    only those which have changed are written (see sync_return_items).
+
+    source_key identifies the file and Datamap version parsed (see
+    excelparser.helpers.ingest.source_key) and is recorded on return_obj,
+    so that uploading the same file again can be skipped.
     """
 
     def __init__(
-        self, template_path: str, project: Project, return_obj: Return, datamap: Datamap
+        self,
+        template_path: Union[str, IO[bytes]],
+        project: Project,
+        return_obj: Return,
+        datamap: Datamap,
+        read_only: bool = False,
+        write_strategy: Optional[str] = None,
+        engine: Optional[str] = None,
+        extracted: Optional[ExtractedWorkbook] = None,
+        upsert: bool = False,
+        memory_budget: Optional[int] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        source_key: str = "",
     ) -> None:
         self.sheetnames: List[str]
         self.filename: str
@@ -39,30 +121,76 @@ class ParsedSpreadsheet:
         self._template_path = template_path
         self._return_obj = return_obj
         self._datamap = datamap
+        self._plan: ExtractionPlan = get_extraction_plan(datamap)
+        self._read_only = read_only
+        self._engine = resolve_engine(engine)
+        self._write_strategy = write_strategy
+        self._extracted = extracted
+        self._upsert = upsert
+        self._source_key = source_key
+        if extracted is not None and extracted.plan_version != self._plan.version:
+            raise ExtractionMismatchError(
+                f"{extracted.filename} was extracted using an out of date version of {datamap}."
+            )
+        self._workbook = None
         self._sheet_data: SheetData = {}
-        self._get_sheets()
         self._get_filename()
+        if instrumentation is None:
+            # carry on from the timings of an extraction done elsewhere
+            previous = extracted.timings if extracted is not None else None
+            instrumentation = Instrumentation(self.filename, record=previous)
+        self.instrumentation = instrumentation
+        self.timings: Optional[Dict[str, Any]] = None
+        self._memory = MemoryMonitor(memory_budget, label=self.filename)
         self._dml_sheets: List[str]
         self._dml_sheets_missing_from_spreadsheet: List[str]
-        self._check_sheets_present()
+        try:
+            # a full load reads the whole workbook here
+            with self._memory, self._memory_guard():
+                self._get_sheets()
+                self._check_sheets_present()
+        except MissingSheetError:
+            self.close()
+            raise
 
-        self._return_params = set(
-            ["value_str", "value_int", "value_float", "value_date"]
-        )
+    @classmethod
+    def for_datamaps(
+        cls,
+        template_path: Union[str, IO[bytes]],
+        project: Project,
+        return_obj: Return,
+        datamaps: Iterable[Datamap],
+        read_only: bool = False,
+        engine: Optional[str] = None,
+        memory_budget: Optional[int] = None,
+        **kwargs,
+    ) -> Dict[Datamap, "ParsedSpreadsheet"]:
+        """
+        Parse one spreadsheet against several Datamaps, e.g. last quarter's
+        and this quarter's, to compare them. The workbook is opened once and
+        each cell is read once, however many of the Datamaps refer to it.
+
+        Returns a ParsedSpreadsheet for each Datamap; any other keyword
+        arguments are passed to all of them.
+        """
+        datamaps = list(datamaps)
+        plans = [get_extraction_plan(datamap) for datamap in datamaps]
+        name = getattr(template_path, "name", None) or template_path
+        with MemoryMonitor(memory_budget, label=os.path.basename(name)) as memory:
+            extracted = extract_workbook_multi(
+                template_path, plans, engine=engine, read_only=read_only
+            )
+        parsed = {}
+        for datamap, values in zip(datamaps, extracted):
+            values.peak_memory = memory.peak_increase
+            parsed[datamap] = cls(
+                template_path, project, return_obj, datamap, extracted=values, **kwargs
+            )
+        return parsed
 
     def _map_to_keyword_param(self, cell_data: "CellData") -> str:
-        _map = {
-            CellValueType.STRING: "value_str",
-            CellValueType.INTEGER: "value_int",
-            CellValueType.FLOAT: "value_float",
-            CellValueType.DATE: "value_date",
-        }
-        try:
-            return _map[cell_data.type]
-        except KeyError:
-            return (
-                "value_str"
-            )  # return str type for now if map gets CellValueType.UNKNOWN
+        # return str type for now if map gets CellValueType.UNKNOWN
+        return _KEYWORD_PARAMS.get(cell_data.type.value, "value_str")
 
     def __getitem__(self, item):
         cls = type(self)
@@ -72,30 +200,77 @@ class ParsedSpreadsheet:
         try:
             return self._sheet_data[item]
         except KeyError:
-            msg = f"There is no sheet in the spreadsheet with title {item}."
-            raise MissingSheetError(msg.format(item=item))
+            if item not in self.sheetnames:
+                msg = f"There is no sheet in the spreadsheet with title {item}."
+                raise MissingSheetError(msg.format(item=item))
+        with self._memory_guard():
+            self._sheet_data[item] = self._convert_sheet(item)
+        return self._sheet_data[item]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the workbook and stop measuring memory. Sheets already
+        converted remain available.
+        """
+        self._close_workbook()
+        self._memory.stop()
+
+    @contextmanager
+    def _memory_guard(self):
+        try:
+            yield
+        except MemoryError as e:
+            self.close()
+            raise self._memory.budget_exceeded() from e
+
+    @property
+    def peak_memory(self) -> Optional[int]:
+        """
+        How far the RSS rose, in bytes, while parsing, measured in the
+        worker process if the values were extracted there.
+        """
+        if self._extracted is not None and self._extracted.peak_memory is not None:
+            return self._extracted.peak_memory
+        return self._memory.peak_increase
 
     def _get_filename(self):
-        self.filename = os.path.split(self._template_path)[1]
+        self.filename = os.path.basename(
+            getattr(self._template_path, "name", None) or self._template_path
+        )
 
     def _check_sheets_present(self) -> None:
-        dmls = self._datamap.datamaplines.all()
-        self._dml_sheets = list({dml.sheet for dml in dmls})
+        self._dml_sheets = self._plan.sheetnames
         _extra_sheet = list(set(self._dml_sheets) - set(self.sheetnames))
         if _extra_sheet:
             raise MissingSheetError(
                 f"There is a worksheet in the spreadsheet not in the Datamap - {_extra_sheet[0]}"
             )
 
+    def _sheets_to_process(self) -> List[str]:
+        return [ws for ws in self.sheetnames if ws in self._plan]
+
+    def _convert_sheet(self, sheet_name: str) -> "WorkSheetFromDatamap":
+        wb = self._open_workbook()
+        logger.debug(f"Converting {sheet_name} using wb {wb}")
+        return WorkSheetFromDatamap(
+            openpyxl_worksheet=wb[sheet_name],
+            datamap=self._datamap,
+            plan=self._plan,
+            instrumentation=self.instrumentation,
+        )
+
     def _process_sheets(self) -> None:
-        wb: OpenpyxlWorkbook = load_workbook(self._template_path, data_only=True)
-        logger.debug("Opening wb {}".format(wb))
-        for ws in self.sheetnames:
-            ws_from_dm = WorkSheetFromDatamap(
-                openpyxl_worksheet=wb[ws], datamap=self._datamap
-            )
-            ws_from_dm._convert()
-            self._sheet_data[ws] = ws_from_dm
+        try:
+            for ws in self._sheets_to_process():
+                self[ws]
+        finally:
+            self._close_workbook()
 
     def process(self) -> None:
         """
@@ -103,36 +278,93 @@ class ParsedSpreadsheet:
         :return: None
         :rtype: None
         """
-        self._process_sheets()
-        for sd in self._sheet_data.values():
-            self._process_sheet_to_return(sd)
+        timer = self.instrumentation
+        with self._memory, self._memory_guard():
+            self._process_sheets()
+            return_items: List[ReturnItem] = []
+            with timer.stage(BUILD_ITEMS):
+                for ws in self._sheets_to_process():
+                    return_items.extend(self._process_sheet_to_return(self[ws]))
+        self.close()
+        self.return_obj.parse_peak_memory = self.peak_memory
+        self.return_obj.source_key = self._source_key
+        with timer.stage(WRITE), timer.count_queries():
+            # all_objects, as this may be a staging Return
+            Return.all_objects.filter(pk=self.return_obj.pk).update(
+                parse_peak_memory=self.peak_memory, source_key=self._source_key
+            )
+            if self._upsert:
+                result = sync_return_items(
+                    self.return_obj, return_items, strategy=self._write_strategy
+                )
+                timer.count(ROWS_WRITTEN, result.created + result.updated)
+            else:
+                timer.count(
+                    ROWS_WRITTEN,
+                    write_return_items(return_items, strategy=self._write_strategy),
+                )
+        if not self.return_obj.staging:
+            # once for the Return, rather than a signal for each ReturnItem
+            returns_changed.send(
+                sender=Return, financial_quarter_id=self.return_obj.financial_quarter_id
+            )
+        self.timings = timer.emit()
 
-    def _process_sheet_to_return(self, sheet: "WorkSheetFromDatamap") -> None:
-        sheet_name: str = sheet.title
-        relevant_dmls: Iterable[DatamapLine] = self._datamap.datamaplines.filter(
-            sheet=sheet_name
-        )
-        for dml in relevant_dmls:
-            logger.debug(f"Processing {dml.key} in {dml.sheet}")
-            _return_param = self._map_to_keyword_param(sheet[dml.key])
-            logger.debug(f"_return_param: {_return_param}")
-            _value_dict = {_return_param: sheet[dml.key].value}
-            logger.debug(f"_value_dict: {_value_dict}")
-            _other_params = self._return_params - set([_return_param])
-            logger.debug(f"_other_params: {_other_params}")
-            _combined_params = {k: None for k in list(_other_params)}
-            _combined_params.update(_value_dict)
-            logger.debug(f"_combined_params: {_combined_params}")
-            ReturnItem.objects.create(
-                parent=self.return_obj, datamapline=dml, **_combined_params
+    def _process_sheet_to_return(
+        self, sheet: "WorkSheetFromDatamap"
+    ) -> List[ReturnItem]:
+        """
+        Build, but do not save, a ReturnItem for each cell in the sheet,
+        setting whichever value field suits the type of the cell and None
+        in the others, and recording the type as value_type.
+        """
+        logger.debug(f"Processing {len(sheet.keys)} cells in {sheet.title}")
+        return_items: List[ReturnItem] = []
+        for dml_id, value, type_code in zip(
+            sheet.datamapline_ids, sheet.values, sheet.types
+        ):
+            _params = dict(_EMPTY_RETURN_PARAMS)
+            _params[_KEYWORD_PARAMS.get(type_code, "value_str")] = value
+            _params["value_type"] = (
+                ReturnItem.EMPTY
+                if value is None or value == ""
+                else _VALUE_TYPES.get(type_code, ReturnItem.STR)
             )
+            return_items.append(
+                ReturnItem(parent=self.return_obj, datamapline_id=dml_id, **_params)
+            )
+        return return_items
+
+    def _open_workbook(self):
+        """
+        Load the workbook, with cached values rather than formulae, unless
+        we already have a handle to it.
+        """
+        if self._extracted is not None:
+            return self._extracted
+        if self._workbook is None:
+            try:
+                self._workbook = open_workbook(
+                    self._template_path, engine=self._engine, read_only=self._read_only
+                )
+            except ImportError:
+                raise
+        return self._workbook
+
+    def _close_workbook(self) -> None:
+        """
+        Release the workbook. In read-only mode this also closes the
+        underlying file handle.
+        """
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
 
     def _get_sheets(self) -> None:
-        try:
-            wb = load_workbook(self._template_path)
-        except ImportError:
-            raise
-        self.sheetnames = wb.sheetnames
+        with self.instrumentation.stage(OPEN):
+            self.sheetnames = self._open_workbook().sheetnames
+        if self._extracted is None:
+            self.instrumentation.count(BYTES_READ, file_size(self._template_path) or 0)
 
     @property
     def return_obj(self):
@@ -151,6 +383,25 @@ class CellValueType(Enum):
     UNKNOWN = auto()
 
 
+# the ReturnItem field for each CellValueType value
+_KEYWORD_PARAMS = {
+    CellValueType.STRING.value: "value_str",
+    CellValueType.INTEGER.value: "value_int",
+    CellValueType.FLOAT.value: "value_float",
+    CellValueType.DATE.value: "value_date",
+}
+
+_EMPTY_RETURN_PARAMS = {param: None for param in _KEYWORD_PARAMS.values()}
+
+# the ReturnItem.value_type for each CellValueType value
+_VALUE_TYPES = {
+    CellValueType.STRING.value: ReturnItem.STR,
+    CellValueType.INTEGER.value: ReturnItem.INT,
+    CellValueType.FLOAT.value: ReturnItem.FLOAT,
+    CellValueType.DATE.value: ReturnItem.DATE,
+}
+
+
 class CellData(NamedTuple):
     """
     Holds the data and useful metadata parsed from a spreadsheet.
@@ -168,53 +419,113 @@ class WorkSheetFromDatamap:
     A dictionary-like object holding the data for a single spreadsheet sheet
     parsed using a Datamap object. Created by calling process() method on a
     ParsedSpreadsheet object.
+
+    The data is held in columns: keys, values and types are parallel
+    sequences in the order of the extraction plan, types being an array of
+    CellValueType values. sheet[key] builds a CellData from them on demand.
     """
 
-    def __init__(self, openpyxl_worksheet: OpenpyxlWorksheet, datamap: Datamap) -> None:
-        self._data: Dict[str, CellData] = {}
+    def __init__(
+        self,
+        openpyxl_worksheet: OpenpyxlWorksheet,
+        datamap: Datamap,
+        plan: Optional[ExtractionPlan] = None,
+        instrumentation: Optional[Instrumentation] = None,
+    ) -> None:
         self._openpyxl_worksheet = openpyxl_worksheet
         self._datamap = datamap
-        self._convert()
+        self._plan = plan if plan is not None else get_extraction_plan(datamap)
         self.title = self._openpyxl_worksheet.title
+        self._cells: List[PlannedCell] = []
+        self.keys: List[str] = []
+        self.values: List[Any] = []
+        self.types: array = array("B")
+        self._index: Dict[str, int] = {}
+        self._instrumentation = instrumentation or Instrumentation(self.title)
+        self._convert()
 
-    def __getitem__(self, item):
-        return self._data[item]
+    def __getitem__(self, item) -> "CellData":
+        position = self._index[item]
+        return CellData(
+            self.keys[position],
+            self.title,
+            self.values[position],
+            self._cells[position].cell_ref,
+            CellValueType(self.types[position]),
+        )
+
+    def __contains__(self, item) -> bool:
+        return item in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def datamapline_ids(self) -> List[int]:
+        return [cell.datamapline_id for cell in self._cells]
 
     def _convert(self) -> None:
         """
-        Populates self._data dictionary with data from the spreadsheet.
-        If type of data is not expected (i.e. not in the enum CellValueType)
-        will still parse the data but classify it as CellValueType.UNKOWN
-        for onward processing.
+        Extract the values of the Datamap's cells from the worksheet and
+        classify them in one pass. Read-only worksheets are read in a single
+        sweep over the rows holding the Datamap's cells rather than one
+        lookup per cell. If type of data is not expected (i.e. not in the
+        enum CellValueType) will still parse the data but classify it as
+        CellValueType.UNKNOWN for onward processing.
         :return: None
         :rtype: None
         """
-        for _dml in self._datamap.datamaplines.filter(
-            sheet__exact=self._openpyxl_worksheet.title
-        ):
-            _key = _dml.key
-            _parsed_value = self._openpyxl_worksheet[_dml.cell_ref].value
-            if isinstance(_parsed_value, datetime.datetime):
-                _parsed_value = _parsed_value.date()
-            _sheet_title = self._openpyxl_worksheet.title
-            try:
-                _value = CellData(
-                    _key,
-                    _sheet_title,
-                    _parsed_value,
-                    _dml.cell_ref,
-                    _detect_cell_type(_parsed_value),
-                )
-                self._data[_key] = _value
-            except ValueError:
-                _value = CellData(
-                    _key,
-                    _sheet_title,
-                    _parsed_value,
-                    _dml.cell_ref,
-                    CellValueType.UNKNOWN,
-                )
-                self._data[_key] = _value
+        timer = self._instrumentation
+        self._cells = self._plan.cells_for(self.title)
+        with timer.stage(EXTRACT):
+            _values = extract_values(self._openpyxl_worksheet, self._cells)
+        timer.count(SHEETS_READ)
+        timer.count(CELLS_READ, len(_values))
+        with timer.stage(DETECT_TYPES):
+            self.values = [
+                v.date() if isinstance(v, datetime.datetime) else v for v in _values
+            ]
+            self.types = detect_cell_types(self.values)
+        self.keys = [cell.key for cell in self._cells]
+        # as with a dict, a key repeated in the Datamap refers to its last cell
+        self._index = {key: position for position, key in enumerate(self.keys)}
+
+
+# CellValueType values by exact type, extended as other types are seen
+_TYPE_CODES: Dict[type, int] = {}
+
+
+def _type_code(value_type: type) -> int:
+    if issubclass(value_type, numbers.Integral):
+        return CellValueType.INTEGER.value
+    if issubclass(value_type, str):
+        return CellValueType.STRING.value
+    if issubclass(value_type, float):
+        return CellValueType.FLOAT.value
+    if issubclass(value_type, (datetime.datetime, datetime.date)):
+        return CellValueType.DATE.value
+    return CellValueType.UNKNOWN.value
+
+
+def detect_cell_types(values: List[Any]) -> array:
+    """
+    Classify values in one pass, returning an array of CellValueType values
+    in the same order. Equivalent to calling _detect_cell_type on each
+    value, with CellValueType.UNKNOWN for those it rejects, but the check
+    is made once per type rather than once per value.
+    """
+    codes = _TYPE_CODES
+    types = array("B", bytes(len(values)))
+    for position, value in enumerate(values):
+        value_type = type(value)
+        try:
+            types[position] = codes[value_type]
+        except KeyError:
+            types[position] = codes[value_type] = _type_code(value_type)
+    return types
 
 
 def _detect_cell_type(obj: Any) -> CellValueType:
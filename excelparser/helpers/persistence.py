@@ -0,0 +1,203 @@
+import io
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from returns.models import Return, ReturnItem
+
+logger = logging.getLogger(__name__)
+
+CREATE = "create"
+BULK_CREATE = "bulk_create"
+COPY = "copy"
+AUTO = "auto"
+
+WRITE_STRATEGIES = [CREATE, BULK_CREATE, COPY]
+
+DEFAULT_BATCH_SIZE = 500
+
+# the ReturnItem columns written by COPY, in order
+_COPY_FIELDS = [
+    "parent",
+    "datamapline",
+    "value_str",
+    "value_int",
+    "value_float",
+    "value_date",
+    "value_datetime",
+    "value_type",
+]
+
+# the columns compared when syncing ReturnItems with a new parse
+_VALUE_FIELDS = [
+    "value_str",
+    "value_int",
+    "value_float",
+    "value_date",
+    "value_datetime",
+    "value_type",
+]
+
+
+class WriteStrategyError(Exception):
+    pass
+
+
+class SyncResult(NamedTuple):
+    created: int
+    updated: int
+    deleted: int
+    unchanged: int
+
+
+def resolve_write_strategy(strategy: Optional[str] = None) -> str:
+    """
+    Work out which strategy to use for writing ReturnItems. If strategy is
+    not given, the RETURNITEM_WRITE_STRATEGY setting is used. The "auto"
+    strategy uses COPY when the database is PostgreSQL and bulk_create
+    otherwise.
+    """
+    if strategy is None:
+        strategy = getattr(settings, "RETURNITEM_WRITE_STRATEGY", AUTO)
+    if strategy == AUTO:
+        return COPY if connection.vendor == "postgresql" else BULK_CREATE
+    if strategy not in WRITE_STRATEGIES:
+        _valid = ", ".join(WRITE_STRATEGIES + [AUTO])
+        raise WriteStrategyError(
+            f"{strategy} is not a valid write strategy. Use one of: {_valid}."
+        )
+    if strategy == COPY and connection.vendor != "postgresql":
+        raise WriteStrategyError("The copy write strategy requires PostgreSQL.")
+    return strategy
+
+
+def write_return_items(
+    items: List[ReturnItem],
+    strategy: Optional[str] = None,
+    batch_size: Optional[int] = None,
+) -> int:
+    """
+    Persist unsaved ReturnItem objects in a single transaction. Returns the
+    number of items written.
+
+    :param items: unsaved ReturnItem objects
+    :param strategy: one of "create", "bulk_create", "copy" or "auto"
+    :param batch_size: rows per INSERT when using bulk_create. Defaults to
+        the RETURNITEM_BULK_CREATE_BATCH_SIZE setting.
+    """
+    strategy = resolve_write_strategy(strategy)
+    if batch_size is None:
+        batch_size = getattr(
+            settings, "RETURNITEM_BULK_CREATE_BATCH_SIZE", DEFAULT_BATCH_SIZE
+        )
+    logger.debug(f"Writing {len(items)} ReturnItems using {strategy}")
+    with transaction.atomic():
+        if strategy == CREATE:
+            for item in items:
+                item.save(force_insert=True)
+        elif strategy == BULK_CREATE:
+            ReturnItem.objects.bulk_create(items, batch_size=batch_size)
+        else:
+            _copy_return_items(items)
+    return len(items)
+
+
+def _copy_value(value: Any) -> str:
+    """
+    Format a database-ready value for COPY ... WITH (FORMAT csv). Every
+    value is quoted, so the unquoted NULL marker can never clash with a
+    string.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        value = int(value)
+    value = value.isoformat() if hasattr(value, "isoformat") else str(value)
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def _copy_return_items(items: List[ReturnItem]) -> None:
+    meta = ReturnItem._meta
+    fields = [meta.get_field(name) for name in _COPY_FIELDS]
+    buf = io.StringIO()
+    for item in items:
+        buf.write(
+            ",".join(
+                _copy_value(
+                    field.get_db_prep_save(getattr(item, field.attname), connection)
+                )
+                for field in fields
+            )
+        )
+        buf.write("\n")
+    buf.seek(0)
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+    sql = (
+        f"COPY {connection.ops.quote_name(meta.db_table)} ({columns}) "
+        f"FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buf)
+
+
+def _comparable(item: Any, fields) -> Tuple:
+    # values as they would be saved, so that e.g. a parsed float and the
+    # Decimal read back from value_float compare equal
+    return tuple(
+        field.get_db_prep_save(getattr(item, field.attname), connection)
+        for field in fields
+    )
+
+
+def sync_return_items(
+    return_obj: Return,
+    items: List[ReturnItem],
+    strategy: Optional[str] = None,
+    batch_size: Optional[int] = None,
+) -> SyncResult:
+    """
+    Make the ReturnItems of return_obj match items, a freshly parsed set of
+    unsaved ReturnItems, changing as few rows as possible: the existing
+    items are loaded in one query and matched to the new ones by
+    DatamapLine. Items whose values have changed are updated, new ones are
+    inserted using strategy (see write_return_items) and those no longer
+    present are deleted, all in one transaction.
+    """
+    fields = [ReturnItem._meta.get_field(name) for name in _VALUE_FIELDS]
+    with transaction.atomic():
+        existing: Dict[Optional[int], ReturnItem] = {}
+        to_delete: List[int] = []
+        for item in ReturnItem.objects.filter(parent=return_obj).only(
+            "id", "datamapline_id", *_VALUE_FIELDS
+        ):
+            if item.datamapline_id in existing:
+                # a duplicate left behind by an earlier ingest
+                to_delete.append(item.id)
+            else:
+                existing[item.datamapline_id] = item
+        to_create: List[ReturnItem] = []
+        updated = unchanged = 0
+        for item in items:
+            current = existing.pop(item.datamapline_id, None)
+            if current is None:
+                item.parent = return_obj
+                to_create.append(item)
+                continue
+            new_values = _comparable(item, fields)
+            if new_values == _comparable(current, fields):
+                unchanged += 1
+                continue
+            ReturnItem.objects.filter(pk=current.pk).update(
+                **{field.attname: getattr(item, field.attname) for field in fields}
+            )
+            updated += 1
+        to_delete.extend(item.id for item in existing.values())
+        if to_delete:
+            ReturnItem.objects.filter(pk__in=to_delete).delete()
+        if to_create:
+            write_return_items(to_create, strategy=strategy, batch_size=batch_size)
+    result = SyncResult(len(to_create), updated, len(to_delete), unchanged)
+    logger.debug(f"Synced ReturnItems for {return_obj}: {result}")
+    return result
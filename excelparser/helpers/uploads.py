@@ -0,0 +1,206 @@
+"""
+Archiving uploaded templates to storage off the request path.
+
+Uploads are parsed straight from Django's UploadedFile. Keeping a copy of
+the original in upload_storage (see core.storage), where each distinct
+file is stored once, is optional (ARCHIVE_UPLOADS) and is done by a small
+pool of background threads, so the request does not wait for the storage
+backend. The copy is referenced by the Return it was uploaded for, and
+released when that Return is deleted or another upload replaces it.
+
+A batch of templates can also be uploaded as a single .zip archive. Its
+members are listed from the archive's central directory without reading
+them, and each one is streamed out on its own by the worker that parses
+it.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import IO, Iterator, List, Optional, Union
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import UploadedFile
+from django.db import close_old_connections, connection, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from core.storage import upload_storage
+from returns.models import Return
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_WORKERS = 2
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        workers = getattr(settings, "UPLOAD_ARCHIVE_WORKERS", DEFAULT_ARCHIVE_WORKERS)
+        _executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload-archive"
+        )
+    return _executor
+
+
+def archive_path(uploaded_file: UploadedFile) -> str:
+    """
+    The name an upload is archived under, as ReturnBatchCreate has always
+    saved them. Storage keeps it by content, so only its extension is used.
+    """
+    return os.path.join(settings.MEDIA_ROOT, "uploads", uploaded_file.name)
+
+
+def _detach(uploaded_file: UploadedFile):
+    """
+    A copy of the upload's content that outlives the request, which
+    deletes a temporary upload file and discards one held in memory. A
+    temporary file is hard linked, so nothing is copied if it can be
+    avoided.
+    """
+    if hasattr(uploaded_file, "temporary_file_path"):
+        source = uploaded_file.temporary_file_path()
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(source), suffix=".archive")
+        os.close(fd)
+        os.remove(path)
+        try:
+            os.link(source, path)
+        except OSError:
+            shutil.copyfile(source, path)
+        return path
+    uploaded_file.seek(0)
+    content = ContentFile(uploaded_file.read())
+    uploaded_file.seek(0)
+    content.sha256 = getattr(uploaded_file, "sha256", None)
+    return content
+
+
+def _save(
+    name: str, content, sha256: Optional[str] = None, return_id: Optional[int] = None
+) -> str:
+    try:
+        if isinstance(content, str):
+            with open(content, "rb") as f:
+                stored = File(f)
+                stored.sha256 = sha256
+                saved = upload_storage.save(name, stored)
+        else:
+            saved = upload_storage.save(name, content)
+    except Exception:
+        logger.exception(f"Could not archive upload to {name}")
+        raise
+    finally:
+        if isinstance(content, str):
+            os.remove(content)
+    if return_id is not None:
+        _replace_upload(return_id, saved)
+    return saved
+
+
+def _archive(
+    name: str, content, sha256: Optional[str] = None, return_id: Optional[int] = None
+) -> str:
+    # runs on a pool thread, which would otherwise keep its connection, dead
+    # or not, from one upload to the next
+    close_old_connections()
+    try:
+        return _save(name, content, sha256, return_id)
+    finally:
+        connection.close()
+
+
+def _replace_upload(return_id: int, name: str) -> None:
+    """
+    Record name as the upload kept for the Return with return_id, releasing
+    the one it replaces, or name itself if the Return has been deleted.
+    """
+    with transaction.atomic():
+        previous = (
+            Return.all_objects.select_for_update()
+            .filter(pk=return_id)
+            .values_list("upload_name", flat=True)
+            .first()
+        )
+        if previous is not None:
+            Return.all_objects.filter(pk=return_id).update(upload_name=name)
+    if previous is None:
+        upload_storage.delete(name)
+    elif previous:
+        upload_storage.delete(previous)
+
+
+def archive_upload(
+    uploaded_file: UploadedFile,
+    name: Optional[str] = None,
+    return_obj: Optional[Return] = None,
+) -> Optional["Future[str]"]:
+    """
+    Save a copy of uploaded_file to upload_storage in the background, if
+    the ARCHIVE_UPLOADS setting is on. Returns a Future for the name it was
+    saved under, or None if uploads are not archived.
+
+    Given return_obj, the copy is kept as its upload_name until another
+    upload for it replaces it or it is deleted (see release_return_upload);
+    otherwise the caller is responsible for deleting it from storage.
+    """
+    if not getattr(settings, "ARCHIVE_UPLOADS", True):
+        return None
+    if name is None:
+        name = archive_path(uploaded_file)
+    return _get_executor().submit(
+        _archive,
+        name,
+        _detach(uploaded_file),
+        getattr(uploaded_file, "sha256", None),
+        return_obj.pk if return_obj is not None else None,
+    )
+
+
+@receiver(post_delete, sender=Return)
+def release_return_upload(sender, instance, **kwargs):
+    if instance.upload_name:
+        upload_storage.delete(instance.upload_name)
+
+
+def is_zip_upload(uploaded_file: UploadedFile) -> bool:
+    return uploaded_file.name.lower().endswith(".zip")
+
+
+def archive_members(archive: Union[str, IO[bytes]]) -> List[str]:
+    """
+    The names of the templates in a .zip archive, leaving out directories
+    and the metadata macOS adds (__MACOSX/ and dot files). Only the central
+    directory is read. Raises zipfile.BadZipFile if archive is not a zip.
+    """
+    with zipfile.ZipFile(archive) as zf:
+        return [
+            info.filename
+            for info in zf.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith("__MACOSX/")
+            and not os.path.basename(info.filename).startswith(".")
+        ]
+
+
+@contextmanager
+def extracted_member(archive: str, member: str) -> Iterator[str]:
+    """
+    Stream one member of the .zip archive at archive into a temporary file
+    with the member's file name, yielding its path and removing it after.
+    """
+    directory = tempfile.mkdtemp(prefix="upload-member-")
+    path = os.path.join(directory, os.path.basename(member))
+    try:
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as src:
+            with open(path, "wb") as dest:
+                shutil.copyfileobj(src, dest)
+        yield path
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
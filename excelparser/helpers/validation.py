@@ -0,0 +1,212 @@
+"""
+Validate populated templates against a Datamap without writing anything
+to the database.
+
+Cell values are extracted with the same engines and ExtractionPlan used by
+ingest, then checked for missing sheets, empty required cells, values
+whose type does not match DatamapLine.data_type and strings longer than
+DatamapLine.max_length. Each file produces a ValidationReport, which
+to_dict() turns into something that can be written out as JSON.
+"""
+import datetime
+import logging
+import os
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+from datamap.models import Datamap
+from excelparser.helpers.engines import ExtractedWorkbook, extract_workbook
+from excelparser.helpers.extraction_plan import (
+    ExtractionPlan,
+    PlannedCell,
+    get_extraction_plan,
+)
+from excelparser.helpers.ingest import worker_pool
+from excelparser.helpers.parser import CellValueType, detect_cell_types
+
+logger = logging.getLogger(__name__)
+
+MISSING_SHEET = "missing_sheet"
+REQUIRED = "required"
+TYPE_MISMATCH = "type_mismatch"
+MAX_LENGTH = "max_length"
+UNREADABLE = "unreadable"
+
+# the CellValueTypes acceptable for each DatamapLine.data_type: numbers are
+# acceptable as Text and integers as Float
+_ACCEPTED_TYPES = {
+    "Text": {CellValueType.STRING, CellValueType.INTEGER, CellValueType.FLOAT},
+    "Integer": {CellValueType.INTEGER},
+    "Float": {CellValueType.FLOAT, CellValueType.INTEGER},
+    "Date": {CellValueType.DATE},
+}
+
+
+class ValidationIssue(NamedTuple):
+    code: str
+    message: str
+    sheet: Optional[str] = None
+    cell_ref: Optional[str] = None
+    key: Optional[str] = None
+
+
+class ValidationReport:
+    """
+    The outcome of validating one populated template.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        issues: List[ValidationIssue],
+        cell_count: int = 0,
+        path: Optional[str] = None,
+    ) -> None:
+        self.filename = filename
+        self.path = path
+        self.issues = issues
+        self.cell_count = cell_count
+
+    @property
+    def valid(self) -> bool:
+        return not self.issues
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "filename": self.filename,
+            "path": self.path,
+            "valid": self.valid,
+            "cell_count": self.cell_count,
+            "issues": [issue._asdict() for issue in self.issues],
+        }
+
+    def __repr__(self):
+        return f"ValidationReport({self.filename}, issues={len(self.issues)})"
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _is_whole_number(cell: PlannedCell, value: Any) -> bool:
+    # Excel stores every number as a float, so 3.0 is a valid Integer
+    return (
+        cell.data_type == "Integer" and isinstance(value, float) and value.is_integer()
+    )
+
+
+def _check_cell(
+    sheet_name: str, cell: PlannedCell, value: Any, value_type: CellValueType
+) -> Optional[ValidationIssue]:
+    if _is_empty(value):
+        if cell.required:
+            return ValidationIssue(
+                REQUIRED, f"{cell.key} is required", sheet_name, cell.cell_ref, cell.key
+            )
+        return None
+    accepted = _ACCEPTED_TYPES.get(cell.data_type, set(CellValueType))
+    if value_type not in accepted and not _is_whole_number(cell, value):
+        return ValidationIssue(
+            TYPE_MISMATCH,
+            f"{cell.key} should be {cell.data_type}, not {type(value).__name__} "
+            f"({value!r})",
+            sheet_name,
+            cell.cell_ref,
+            cell.key,
+        )
+    if (
+        cell.max_length is not None
+        and isinstance(value, str)
+        and len(value) > cell.max_length
+    ):
+        return ValidationIssue(
+            MAX_LENGTH,
+            f"{cell.key} is {len(value)} characters long; the maximum is "
+            f"{cell.max_length}",
+            sheet_name,
+            cell.cell_ref,
+            cell.key,
+        )
+    return None
+
+
+def validate_extracted(
+    extracted: ExtractedWorkbook, plan: ExtractionPlan, path: Optional[str] = None
+) -> ValidationReport:
+    """
+    Check values already extracted from a populated template against plan.
+    """
+    issues: List[ValidationIssue] = []
+    for sheet_name in plan.sheetnames:
+        if sheet_name not in extracted.sheetnames:
+            issues.append(
+                ValidationIssue(
+                    MISSING_SHEET,
+                    f"The Datamap refers to a sheet {sheet_name} which is not in "
+                    f"the spreadsheet",
+                    sheet_name,
+                )
+            )
+            continue
+        cells = plan.cells_for(sheet_name)
+        values = [
+            v.date() if isinstance(v, datetime.datetime) else v
+            for v in extracted.values.get(sheet_name, [])
+        ]
+        types = detect_cell_types(values)
+        for cell, value, type_code in zip(cells, values, types):
+            issue = _check_cell(sheet_name, cell, value, CellValueType(type_code))
+            if issue is not None:
+                issues.append(issue)
+    return ValidationReport(extracted.filename, issues, extracted.cell_count, path)
+
+
+def validate_file(
+    path: str,
+    plan: ExtractionPlan,
+    engine: Optional[str] = None,
+    read_only: bool = True,
+) -> ValidationReport:
+    """
+    Extract the values in plan from the populated template at path and
+    validate them. A file which cannot be read at all gets a report with
+    a single "unreadable" issue rather than raising.
+    """
+    try:
+        extracted = extract_workbook(path, plan, engine=engine, read_only=read_only)
+    except MemoryError:
+        message = "Ran out of memory reading the file."
+    except Exception as e:
+        message = f"{type(e).__name__}: {e}"
+    else:
+        return validate_extracted(extracted, plan, path)
+    return ValidationReport(
+        os.path.basename(path), [ValidationIssue(UNREADABLE, message)], path=path
+    )
+
+
+def _validate_in_worker(args) -> ValidationReport:
+    return validate_file(*args)
+
+
+def validate_files(
+    paths: Iterable[str],
+    datamap: Datamap,
+    workers: Optional[int] = None,
+    memory_limit: Optional[int] = None,
+    engine: Optional[str] = None,
+    read_only: bool = True,
+) -> List[ValidationReport]:
+    """
+    Validate populated templates against datamap in parallel, using the
+    same worker pool settings as ingest (see
+    excelparser.helpers.ingest.worker_pool). Reports are returned in the
+    order of paths.
+    """
+    paths = list(paths)
+    plan = get_extraction_plan(datamap)
+    work = [(path, plan, engine, read_only) for path in paths]
+    with worker_pool(len(paths), workers, memory_limit) as pool:
+        reports = pool.map(_validate_in_worker, work)
+    invalid = sum(1 for report in reports if not report.valid)
+    logger.info(f"Validated {len(reports)} files against {datamap}: {invalid} invalid")
+    return reports
@@ -0,0 +1,472 @@
+"""
+A minimal, streaming reader for the cached cell values of .xlsx/.xlsm files.
+
+openpyxl builds an object model of the whole workbook before we can read a
+single value. For ingest we only need the cached values of the cells named
+in a Datamap, so NativeWorkbook reads the parts of the package it needs
+straight from the zip archive with an incremental XML parser:
+
+- the workbook part, for sheet names, the date system and relationships
+- each referenced worksheet part, stopping after the last target row
+- sharedStrings, decoding only the strings the target cells point at
+- styles, to tell date serials from plain numbers
+
+It has the same shape as the bits of an openpyxl Workbook that
+ParsedSpreadsheet uses: sheetnames, wb[sheet_name] and close().
+"""
+import datetime
+import posixpath
+import re
+import zipfile
+from typing import IO, Any, Dict, List, Optional, Set, Tuple, Union
+from xml.etree.ElementTree import iterparse
+from xml.parsers import expat
+
+from excelparser.helpers.extraction_plan import PlannedCell
+
+# builtin number formats which openpyxl and Excel treat as dates or times
+_BUILTIN_DATE_FORMAT_IDS = set(range(14, 23)) | {45, 46, 47}
+
+_FORMAT_STRIP_RE = re.compile(
+    r"\[(BLACK|BLUE|CYAN|GREEN|MAGENTA|RED|WHITE|YELLOW)\]|\"[^\"]+\"|\[\$[^\]]+\]",
+    re.IGNORECASE,
+)
+_FORMAT_DATE_RE = re.compile(r"[dmhysDMHYS]")
+
+_ISO8601_RE = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})(?:T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?)?"
+)
+
+_EPOCH_1900 = datetime.datetime(1899, 12, 30)
+_EPOCH_1904 = datetime.datetime(1904, 1, 1)
+
+_OFFICE_DOCUMENT_REL = "/officeDocument"
+_WORKSHEET_REL = "/worksheet"
+_SHARED_STRINGS_REL = "/sharedStrings"
+_STYLES_REL = "/styles"
+
+
+class NativeReaderError(Exception):
+    pass
+
+
+def _local(tag: str) -> str:
+    """Strip the namespace from an ElementTree tag."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _attr(element, name: str) -> Optional[str]:
+    """Get an attribute by local name, whatever its namespace."""
+    for key, value in element.attrib.items():
+        if _local(key) == name:
+            return value
+    return None
+
+
+def _column_letter(col: int) -> str:
+    letters = ""
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def is_date_format(fmt: Optional[str]) -> bool:
+    """
+    True if the number format code displays a date or time, applying the
+    same test as openpyxl: the first section of the code, with colours,
+    literals and locales removed, contains a date or time token.
+    """
+    if fmt is None:
+        return False
+    fmt = _FORMAT_STRIP_RE.sub("", fmt.split(";")[0])
+    return _FORMAT_DATE_RE.search(fmt) is not None
+
+
+def from_excel_serial(value: Union[int, float], date1904: bool = False) -> Any:
+    """
+    Convert an Excel date serial into a datetime, or a time when the value
+    is only a fraction of a day.
+    """
+    if date1904:
+        epoch = _EPOCH_1904
+    else:
+        epoch = _EPOCH_1900
+        if 1 < value < 60:
+            # Excel pretends 1900 was a leap year
+            value += 1
+    delta = datetime.timedelta(days=value)
+    if 0 < abs(value) < 1:
+        return (datetime.datetime.min + delta).time()
+    return epoch + delta
+
+
+def _from_iso8601(value: str) -> Any:
+    match = _ISO8601_RE.match(value)
+    if match is None:
+        return value
+    parts = [int(p) for p in match.groups()[:6] if p is not None]
+    if len(parts) == 3:
+        return datetime.datetime(*parts)
+    fraction = match.group(7)
+    microsecond = int(fraction.ljust(6, "0")) if fraction else 0
+    return datetime.datetime(*parts, microsecond)
+
+
+def _cast_number(value: str) -> Union[int, float]:
+    if "." in value or "E" in value or "e" in value:
+        return float(value)
+    return int(value)
+
+
+class _RawCell:
+    __slots__ = ("data_type", "style_id", "value")
+
+    def __init__(self, data_type: str, style_id: int, value: Optional[str]) -> None:
+        self.data_type = data_type
+        self.style_id = style_id
+        self.value = value
+
+
+class NativeWorksheet:
+    """
+    A handle on one worksheet of a NativeWorkbook. Values are read with
+    extract_cells().
+    """
+
+    def __init__(self, workbook: "NativeWorkbook", title: str, part_name: str) -> None:
+        self.parent = workbook
+        self.title = title
+        self._part_name = part_name
+
+    def __repr__(self):
+        return f'<NativeWorksheet "{self.title}">'
+
+    def extract_cells(self, cells: List[PlannedCell]) -> List[Any]:
+        """
+        Return the cached values of cells, in the same order as cells.
+        Cells which are empty or absent from the sheet give None.
+        """
+        if not cells:
+            return []
+        wanted: Dict[Tuple[int, int], List[int]] = {}
+        for position, cell in enumerate(cells):
+            wanted.setdefault((cell.row, cell.col), []).append(position)
+        raw = self._read_raw_cells(wanted)
+        self.parent._resolve_shared_strings(
+            {int(c.value) for c in raw.values() if c.data_type == "s" and c.value}
+        )
+        values: List[Any] = [None] * len(cells)
+        for coord, raw_cell in raw.items():
+            value = self.parent._decode(raw_cell)
+            for position in wanted[coord]:
+                values[position] = value
+        return values
+
+    def _read_raw_cells(
+        self, wanted: Dict[Tuple[int, int], List[int]]
+    ) -> Dict[Tuple[int, int], _RawCell]:
+        scanner = _SheetScanner(wanted)
+        with self.parent._archive.open(self._part_name) as source:
+            scanner.parse(source)
+        return scanner.found
+
+
+class _StopParsing(Exception):
+    pass
+
+
+class _ScannerBase:
+    """
+    Drives an expat parser over a part of the package. expat hands us
+    tags and text without building elements, which makes it several times
+    faster than ElementTree over large sheets; handlers raise _StopParsing
+    once they have what they need.
+    """
+
+    def parse(self, source: IO[bytes]) -> None:
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.characters
+        try:
+            parser.ParseFile(source)
+        except _StopParsing:
+            pass
+
+    # subclasses override the handlers for the events they need
+
+    def start(self, name: str, attrs: Dict[str, str]) -> None:
+        pass
+
+    def end(self, name: str) -> None:
+        pass
+
+    def characters(self, data: str) -> None:
+        pass
+
+
+class _SheetScanner(_ScannerBase):
+    """
+    Collects the raw cells at the wanted coordinates from a worksheet part,
+    stopping at the first row after the last wanted one.
+    """
+
+    def __init__(self, wanted: Dict[Tuple[int, int], List[int]]) -> None:
+        self.found: Dict[Tuple[int, int], _RawCell] = {}
+        self._wanted = wanted
+        self._wanted_refs = {
+            f"{_column_letter(col)}{row}": (row, col) for row, col in wanted
+        }
+        self._max_row = max(row for row, _ in wanted)
+        self._row = 0
+        self._col = 0
+        self._cell: Optional[_RawCell] = None
+        self._coord: Optional[Tuple[int, int]] = None
+        self._parts: List[str] = []
+        self._collecting = False
+        self._in_phonetic = False
+
+    def start(self, name, attrs):
+        tag = name.rpartition(":")[2]
+        if tag == "c":
+            ref = attrs.get("r")
+            if ref is not None:
+                coord = self._wanted_refs.get(ref)
+                if coord is None and "$" in ref:
+                    coord = self._wanted_refs.get(ref.replace("$", ""))
+                self._col = coord[1] if coord else self._col + 1
+            else:
+                self._col += 1
+                coord = (self._row, self._col)
+                if coord not in self._wanted:
+                    coord = None
+            if coord is not None:
+                self._coord = coord
+                self._cell = _RawCell(attrs.get("t", "n"), int(attrs.get("s", 0)), None)
+                self._parts = []
+        elif self._cell is not None:
+            if tag == "v":
+                self._collecting = True
+            elif tag == "rPh":
+                self._in_phonetic = True
+            elif tag == "t" and not self._in_phonetic:
+                self._collecting = True
+        elif tag == "row":
+            r = attrs.get("r")
+            self._row = int(r) if r else self._row + 1
+            self._col = 0
+            if self._row > self._max_row:
+                raise _StopParsing()
+
+    def end(self, name):
+        if self._cell is None:
+            return
+        tag = name.rpartition(":")[2]
+        if tag in ("v", "t"):
+            self._collecting = False
+        elif tag == "rPh":
+            self._in_phonetic = False
+        elif tag == "c":
+            value = "".join(self._parts)
+            if value or self._cell.data_type == "inlineStr":
+                self._cell.value = value
+            self.found[self._coord] = self._cell
+            self._cell = None
+            if len(self.found) == len(self._wanted):
+                raise _StopParsing()
+
+    def characters(self, data):
+        if self._collecting:
+            self._parts.append(data)
+
+
+class _SharedStringScanner(_ScannerBase):
+    """
+    Collects the text of the shared strings at the wanted indices, stopping
+    after the last one.
+    """
+
+    def __init__(self, wanted: Set[int]) -> None:
+        self.found: Dict[int, str] = {}
+        self._wanted = wanted
+        self._last = max(wanted)
+        self._index = -1
+        self._parts: Optional[List[str]] = None
+        self._collecting = False
+        self._in_phonetic = False
+
+    def start(self, name, attrs):
+        tag = name.rpartition(":")[2]
+        if tag == "si":
+            self._index += 1
+            self._parts = [] if self._index in self._wanted else None
+        elif self._parts is not None:
+            if tag == "rPh":
+                self._in_phonetic = True
+            elif tag == "t" and not self._in_phonetic:
+                self._collecting = True
+
+    def end(self, name):
+        if self._parts is None:
+            return
+        tag = name.rpartition(":")[2]
+        if tag == "t":
+            self._collecting = False
+        elif tag == "rPh":
+            self._in_phonetic = False
+        elif tag == "si":
+            self.found[self._index] = "".join(self._parts)
+            self._parts = None
+            if self._index >= self._last:
+                raise _StopParsing()
+
+    def characters(self, data):
+        if self._collecting:
+            self._parts.append(data)
+
+
+class NativeWorkbook:
+    """
+    Reads cached cell values from an .xlsx or .xlsm package without
+    openpyxl. source may be a path or a binary file-like object.
+    """
+
+    def __init__(self, source: Union[str, IO[bytes]]) -> None:
+        try:
+            self._archive = zipfile.ZipFile(source)
+        except zipfile.BadZipfile as e:
+            raise NativeReaderError(f"{source} is not a valid Excel file: {e}")
+        self._names = set(self._archive.namelist())
+        self.date1904 = False
+        self._sheets: Dict[str, str] = {}
+        self._shared_strings_part: Optional[str] = None
+        self._styles_part: Optional[str] = None
+        self._shared_strings: Dict[int, str] = {}
+        self._date_styles: Optional[Set[int]] = None
+        self._read_workbook()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, sheet_name: str) -> NativeWorksheet:
+        try:
+            return NativeWorksheet(self, sheet_name, self._sheets[sheet_name])
+        except KeyError:
+            raise KeyError(f"Worksheet {sheet_name} does not exist.")
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return list(self._sheets.keys())
+
+    def close(self) -> None:
+        self._archive.close()
+
+    def _relationships(self, part_name: str) -> Dict[str, Tuple[str, str]]:
+        """
+        Map relationship ids to (type, target part name) for part_name.
+        """
+        folder, filename = posixpath.split(part_name)
+        rels_name = posixpath.join(folder, "_rels", f"{filename}.rels")
+        rels: Dict[str, Tuple[str, str]] = {}
+        if rels_name not in self._names:
+            return rels
+        with self._archive.open(rels_name) as source:
+            for _, element in iterparse(source):
+                if _local(element.tag) != "Relationship":
+                    continue
+                target = element.get("Target", "")
+                if target.startswith("/"):
+                    target = target[1:]
+                else:
+                    target = posixpath.normpath(posixpath.join(folder, target))
+                rels[element.get("Id")] = (element.get("Type", ""), target)
+        return rels
+
+    def _workbook_part(self) -> str:
+        for rel_type, target in self._relationships("").values():
+            if rel_type.endswith(_OFFICE_DOCUMENT_REL):
+                return target
+        return "xl/workbook.xml"
+
+    def _read_workbook(self) -> None:
+        workbook_part = self._workbook_part()
+        if workbook_part not in self._names:
+            raise NativeReaderError("The file does not contain an Excel workbook.")
+        rels = self._relationships(workbook_part)
+        for rel_type, target in rels.values():
+            if rel_type.endswith(_SHARED_STRINGS_REL):
+                self._shared_strings_part = target
+            elif rel_type.endswith(_STYLES_REL):
+                self._styles_part = target
+        with self._archive.open(workbook_part) as source:
+            for _, element in iterparse(source):
+                tag = _local(element.tag)
+                if tag == "workbookPr":
+                    self.date1904 = element.get("date1904", "false") in ("1", "true")
+                elif tag == "sheet":
+                    rel = rels.get(_attr(element, "id"))
+                    if rel is not None and rel[0].endswith(_WORKSHEET_REL):
+                        self._sheets[element.get("name")] = rel[1]
+
+    def _resolve_shared_strings(self, indices: Set[int]) -> None:
+        """
+        Decode the shared strings at indices which we have not seen yet, in
+        one pass over the sharedStrings part.
+        """
+        missing = indices - set(self._shared_strings)
+        if not missing or self._shared_strings_part is None:
+            return
+        scanner = _SharedStringScanner(missing)
+        with self._archive.open(self._shared_strings_part) as source:
+            scanner.parse(source)
+        self._shared_strings.update(scanner.found)
+
+    def _load_date_styles(self) -> Set[int]:
+        if self._date_styles is not None:
+            return self._date_styles
+        self._date_styles = set()
+        if self._styles_part is None or self._styles_part not in self._names:
+            return self._date_styles
+        custom_formats: Dict[int, str] = {}
+        xf_format_ids: List[int] = []
+        in_cell_xfs = False
+        with self._archive.open(self._styles_part) as source:
+            for event, element in iterparse(source, events=("start", "end")):
+                tag = _local(element.tag)
+                if tag == "cellXfs":
+                    in_cell_xfs = event == "start"
+                elif event == "end" and tag == "numFmt":
+                    custom_formats[int(element.get("numFmtId"))] = element.get(
+                        "formatCode"
+                    )
+                elif event == "start" and tag == "xf" and in_cell_xfs:
+                    xf_format_ids.append(int(element.get("numFmtId", 0)))
+        for style_id, fmt_id in enumerate(xf_format_ids):
+            if fmt_id in custom_formats:
+                if is_date_format(custom_formats[fmt_id]):
+                    self._date_styles.add(style_id)
+            elif fmt_id in _BUILTIN_DATE_FORMAT_IDS:
+                self._date_styles.add(style_id)
+        return self._date_styles
+
+    def _decode(self, raw: _RawCell) -> Any:
+        if raw.value is None:
+            return None
+        if raw.data_type == "n":
+            value = _cast_number(raw.value)
+            if raw.style_id and raw.style_id in self._load_date_styles():
+                return from_excel_serial(value, self.date1904)
+            return value
+        if raw.data_type == "s":
+            return self._shared_strings.get(int(raw.value))
+        if raw.data_type == "b":
+            return raw.value == "1"
+        if raw.data_type == "d":
+            return _from_iso8601(raw.value)
+        # str (cached formula result), inlineStr and e (errors) are text
+        return raw.value
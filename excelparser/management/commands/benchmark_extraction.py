@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datamap.models import Datamap
+from excelparser.helpers.engines import NATIVE, OPENPYXL, extract_workbook
+from excelparser.helpers.extraction_plan import compile_extraction_plan
+
+# (label, engine, read_only)
+_CONTENDERS = [
+    ("openpyxl", OPENPYXL, False),
+    ("openpyxl read-only", OPENPYXL, True),
+    ("native", NATIVE, False),
+]
+
+
+class Command(BaseCommand):
+    help = """
+    Times extracting a Datamap's cells from populated templates with
+    openpyxl, openpyxl in read-only mode and the native streaming reader,
+    and checks that all three agree. Nothing is written to the database.
+
+    python manage.py benchmark_extraction --datamap 1 returns/*.xlsm
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+")
+        parser.add_argument("--datamap", type=int, required=True, help="Datamap id")
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        try:
+            datamap = Datamap.objects.get(pk=options["datamap"])
+        except Datamap.DoesNotExist:
+            raise CommandError(f"There is no Datamap with id {options['datamap']}")
+        plan = compile_extraction_plan(datamap)
+        for path in options["paths"]:
+            self.stdout.write(f"{path} ({len(plan)} cells)")
+            results = {}
+            for label, engine, read_only in _CONTENDERS:
+                timings = []
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    extracted = extract_workbook(path, plan, engine, read_only)
+                    results[label] = extracted.values
+                    timings.append(time.perf_counter() - start)
+                self.stdout.write(f"{label:>20}: best {min(timings) * 1000:.1f} ms")
+            reference = results[_CONTENDERS[0][0]]
+            for label, values in results.items():
+                if values != reference:
+                    self.stdout.write(
+                        self.style.ERROR(f"{label:>20}: values differ from openpyxl")
+                    )
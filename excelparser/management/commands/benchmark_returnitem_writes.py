@@ -0,0 +1,104 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from datamap.models import Datamap, DatamapLine
+from excelparser.helpers.persistence import COPY, WRITE_STRATEGIES, write_return_items
+from register.models import FinancialQuarter, Project, Tier
+from returns.models import Return, ReturnItem
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = """
+    Compares the strategies for writing parsed ReturnItems to the database:
+    one INSERT per item (create), batched INSERTs (bulk_create) and
+    COPY FROM STDIN (copy, PostgreSQL only).
+
+    Everything is written inside a transaction which is rolled back, so
+    the database is left untouched:
+
+    python manage.py benchmark_returnitem_writes --items 1200 --repeat 3
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=1200)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument(
+            "--strategy", action="append", choices=WRITE_STRATEGIES, dest="strategies"
+        )
+
+    def handle(self, *args, **options):
+        strategies = options["strategies"] or list(WRITE_STRATEGIES)
+        if COPY in strategies and connection.vendor != "postgresql":
+            self.stdout.write(f"Skipping {COPY}: the database is not PostgreSQL.")
+            strategies.remove(COPY)
+        if not strategies:
+            raise CommandError("No write strategies to benchmark.")
+        try:
+            with transaction.atomic():
+                self._benchmark(strategies, options)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _benchmark(self, strategies, options):
+        tier = Tier.objects.create(name="Benchmark Tier")
+        datamap = Datamap.objects.create(name="Benchmark Datamap", tier=tier)
+        project = Project.objects.create(name="Benchmark Project", tier=tier)
+        fq = FinancialQuarter.objects.create(quarter=1, year=1900)
+        dml_ids = [
+            DatamapLine.objects.create(
+                datamap=datamap, key=f"Key {n}", sheet="Benchmark", cell_ref=f"B{n}"
+            ).id
+            for n in range(1, options["items"] + 1)
+        ]
+        for strategy in strategies:
+            timings = []
+            for _ in range(options["repeat"]):
+                return_obj = Return.objects.create(project=project, financial_quarter=fq)
+                items = [
+                    _dummy_item(return_obj, dml_id, n) for n, dml_id in enumerate(dml_ids)
+                ]
+                start = time.perf_counter()
+                write_return_items(
+                    items, strategy=strategy, batch_size=options["batch_size"]
+                )
+                timings.append(time.perf_counter() - start)
+                return_obj.delete()
+            best = min(timings)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{strategy:>12}: best {best * 1000:.1f} ms of {options['repeat']}"
+                    f" ({len(dml_ids) / best:.0f} items/s)"
+                )
+            )
+
+
+def _dummy_item(return_obj: Return, dml_id: int, n: int) -> ReturnItem:
+    # a realistic mix of the value types found in a populated template
+    kind = n % 4
+    if kind == 0:
+        return ReturnItem(
+            parent=return_obj, datamapline_id=dml_id, value_str=f'Text "{n}", with comma'
+        )
+    if kind == 1:
+        return ReturnItem(
+            parent=return_obj, datamapline_id=dml_id, value_str=None, value_int=n
+        )
+    if kind == 2:
+        return ReturnItem(
+            parent=return_obj, datamapline_id=dml_id, value_str=None, value_float=n / 4
+        )
+    return ReturnItem(
+        parent=return_obj,
+        datamapline_id=dml_id,
+        value_str=None,
+        value_date=datetime.date(2019, 1, 1) + datetime.timedelta(days=n),
+    )
@@ -0,0 +1,77 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datamap.models import Datamap
+from excelparser.helpers.engines import ENGINES
+from excelparser.helpers.ingest import REINGEST_MODES, IngestJob, parallel_ingest
+from register.models import FinancialQuarter
+
+
+class Command(BaseCommand):
+    help = """
+    Parses populated templates in parallel into a Return for each. With
+    --mode upsert (the default REINGEST_MODE) an existing Return for the
+    project and quarter is updated in place; with --mode replace it is
+    deleted and created again. As with a batch upload, the project is taken
+    from the file name, so "Project A.xlsm" is ingested for the project
+    named "Project A".
+
+    python manage.py ingest_returns 3 1 returns/*.xlsm --workers 4
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("financial_quarter", type=int, help="FinancialQuarter id")
+        parser.add_argument("datamap", type=int, help="Datamap id")
+        parser.add_argument("paths", nargs="+")
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument(
+            "--memory-limit",
+            type=int,
+            default=None,
+            help="Maximum address space of each worker, in MB",
+        )
+        parser.add_argument("--engine", choices=ENGINES, default=None)
+        parser.add_argument("--mode", choices=REINGEST_MODES, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            fq = FinancialQuarter.objects.get(pk=options["financial_quarter"])
+        except FinancialQuarter.DoesNotExist:
+            raise CommandError(
+                f"There is no FinancialQuarter with id {options['financial_quarter']}"
+            )
+        try:
+            datamap = Datamap.objects.get(pk=options["datamap"])
+        except Datamap.DoesNotExist:
+            raise CommandError(f"There is no Datamap with id {options['datamap']}")
+        memory_limit = options["memory_limit"]
+        if memory_limit:
+            memory_limit *= 1024 * 1024
+        jobs = [
+            IngestJob(path, os.path.basename(path).split(".")[0])
+            for path in options["paths"]
+        ]
+        results = parallel_ingest(
+            jobs,
+            fq,
+            datamap,
+            workers=options["workers"],
+            memory_limit=memory_limit,
+            engine=options["engine"],
+            mode=options["mode"],
+        )
+        failures = 0
+        for result in sorted(results, key=lambda r: r.path):
+            if result.error:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f"{result.path}: {result.error}"))
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{result.path}: Return {result.return_id}"
+                        f" ({result.cell_count} cells)"
+                    )
+                )
+        if failures:
+            raise CommandError(f"{failures} of {len(results)} files failed to ingest.")
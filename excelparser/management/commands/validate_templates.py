@@ -0,0 +1,65 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datamap.models import Datamap
+from excelparser.helpers.engines import ENGINES
+from excelparser.helpers.validation import validate_files
+
+_TEMPLATE_EXTENSIONS = (".xlsx", ".xlsm")
+
+
+def _template_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(_TEMPLATE_EXTENSIONS) and not name.startswith(
+                    "~$"
+                ):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+class Command(BaseCommand):
+    help = """
+    Checks populated templates against a Datamap without writing to the
+    database: missing sheets, empty required cells, values of the wrong
+    type and text longer than its DatamapLine's max_length. Directories
+    are searched for .xlsx and .xlsm files. A JSON report for each file is
+    written to stdout, or to --output.
+
+    python manage.py validate_templates 1 returns/q4/ --output report.json
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("datamap", type=int, help="Datamap id")
+        parser.add_argument("paths", nargs="+", help="Templates or directories")
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--engine", choices=ENGINES, default=None)
+        parser.add_argument("--output", default=None, help="File to write the report to")
+
+    def handle(self, *args, **options):
+        try:
+            datamap = Datamap.objects.get(pk=options["datamap"])
+        except Datamap.DoesNotExist:
+            raise CommandError(f"There is no Datamap with id {options['datamap']}")
+        paths = list(_template_paths(options["paths"]))
+        if not paths:
+            raise CommandError("No templates found.")
+        reports = validate_files(
+            paths, datamap, workers=options["workers"], engine=options["engine"]
+        )
+        report = json.dumps([r.to_dict() for r in reports], indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+        invalid = [r for r in reports if not r.valid]
+        summary = f"{len(reports) - len(invalid)} of {len(reports)} templates are valid"
+        if invalid:
+            self.stderr.write(self.style.ERROR(summary))
+        else:
+            self.stderr.write(self.style.SUCCESS(summary))
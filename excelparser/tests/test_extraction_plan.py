@@ -0,0 +1,74 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from datamap.models import DatamapLine
+from excelparser.helpers.extraction_plan import (
+    _GENERATION_CACHE_KEY,
+    PlannedCell,
+    cell_ref_to_row_col,
+    compile_extraction_plan,
+    get_extraction_plan,
+)
+from factories.datamap_factories import DatamapFactory
+
+
+class TestExtractionPlan(TestCase):
+    def setUp(self):
+        self.datamap = DatamapFactory()
+        self.dml_b10 = DatamapLine.objects.create(
+            datamap=self.datamap, key="Late Key", sheet="Test Sheet 1", cell_ref="B10"
+        )
+        self.dml_c2 = DatamapLine.objects.create(
+            datamap=self.datamap, key="Right Key", sheet="Test Sheet 1", cell_ref="C2"
+        )
+        self.dml_a2 = DatamapLine.objects.create(
+            datamap=self.datamap, key="Left Key", sheet="Test Sheet 1", cell_ref="A2"
+        )
+        self.dml_sheet2 = DatamapLine.objects.create(
+            datamap=self.datamap, key="Other Key", sheet="Test Sheet 2", cell_ref="AA1"
+        )
+
+    def test_cell_ref_to_row_col(self):
+        self.assertEqual(cell_ref_to_row_col("B10"), (10, 2))
+        self.assertEqual(cell_ref_to_row_col("aa1"), (1, 27))
+
+    def test_cells_sorted_by_row_then_col(self):
+        plan = compile_extraction_plan(self.datamap)
+        self.assertEqual(
+            [c.key for c in plan.cells_for("Test Sheet 1")],
+            ["Left Key", "Right Key", "Late Key"],
+        )
+        self.assertEqual(
+            plan.cells_for("Test Sheet 2"),
+            [PlannedCell(1, 27, "Other Key", self.dml_sheet2.id, "Text", "AA1")],
+        )
+        self.assertEqual(plan.cells_for("Not In Datamap"), [])
+        self.assertEqual(len(plan), 4)
+
+    def test_plan_compiled_once(self):
+        plan = get_extraction_plan(self.datamap)
+        with self.assertNumQueries(0):
+            self.assertIs(get_extraction_plan(self.datamap), plan)
+
+    def test_plan_invalidated_when_datamapline_changes(self):
+        plan = get_extraction_plan(self.datamap)
+        self.dml_a2.key = "Renamed Key"
+        self.dml_a2.save()
+        new_plan = get_extraction_plan(self.datamap)
+        self.assertIsNot(new_plan, plan)
+        self.assertNotEqual(new_plan.version, plan.version)
+        self.assertEqual(new_plan.cells_for("Test Sheet 1")[0].key, "Renamed Key")
+
+        self.dml_sheet2.delete()
+        self.assertNotIn("Test Sheet 2", get_extraction_plan(self.datamap))
+
+    def test_plan_not_reused_when_generation_is_culled(self):
+        key = _GENERATION_CACHE_KEY.format(self.datamap.pk)
+        cache.delete(key)
+        plan = get_extraction_plan(self.datamap)
+        # another process edits a line, then its token is culled from the cache
+        DatamapLine.objects.filter(pk=self.dml_a2.pk).update(key="Renamed Key")
+        cache.delete(key)
+        new_plan = get_extraction_plan(self.datamap)
+        self.assertIsNot(new_plan, plan)
+        self.assertEqual(new_plan.cells_for("Test Sheet 1")[0].key, "Renamed Key")
@@ -0,0 +1,55 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+from openpyxl import Workbook, load_workbook
+
+from excelparser.helpers.extraction_plan import PlannedCell, cell_ref_to_row_col
+from excelparser.helpers.extractors import random_access_extract, sweep_extract
+
+
+def _planned(*cell_refs):
+    cells = [
+        PlannedCell(*cell_ref_to_row_col(ref), f"Key {ref}", n, "Text", ref)
+        for n, ref in enumerate(cell_refs)
+    ]
+    return sorted(cells, key=lambda c: (c.row, c.col))
+
+
+class TestSweepExtract(SimpleTestCase):
+    def setUp(self):
+        self.wb = Workbook()
+        ws = self.wb.active
+        ws.title = "Test Sheet 1"
+        ws["B2"] = "Project Name"
+        ws["D2"] = 45.2
+        ws["C5"] = datetime.datetime(2022, 2, 23)
+        ws["A9"] = 10
+        ws["Z1000"] = "Far away"
+
+    def test_sweep_matches_random_access(self):
+        cells = _planned("D2", "B2", "C5", "A9", "B7", "E20")
+        ws = self.wb.active
+        self.assertEqual(sweep_extract(ws, cells), random_access_extract(ws, cells))
+        self.assertEqual(
+            sweep_extract(ws, cells),
+            ["Project Name", 45.2, datetime.datetime(2022, 2, 23), None, 10, None],
+        )
+
+    def test_sweep_read_only_worksheet(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "sweep_test.xlsx")
+        self.wb.save(path)
+        wb = load_workbook(path, read_only=True, data_only=True)
+        self.addCleanup(wb.close)
+        cells = _planned("B2", "D2", "C5", "A9")
+        self.assertEqual(
+            sweep_extract(wb["Test Sheet 1"], cells),
+            ["Project Name", 45.2, datetime.datetime(2022, 2, 23), 10],
+        )
+
+    def test_sweep_no_cells(self):
+        self.assertEqual(sweep_extract(self.wb.active, []), [])
@@ -0,0 +1,141 @@
+import os
+import pickle
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from datamap.models import DatamapLine
+from excelparser.helpers.engines import extract_workbook
+from excelparser.helpers.extraction_plan import get_extraction_plan
+from excelparser.helpers.ingest import (
+    IngestJob,
+    _extract_in_worker,
+    _persist,
+    ingesting,
+    parallel_ingest,
+    worker_pool,
+)
+from factories.datamap_factories import DatamapFactory, ProjectFactory
+from register.models import FinancialQuarter
+from returns.models import Return, ReturnItem
+
+POPULATED = os.path.join(os.path.dirname(__file__), "populated.xlsm")
+
+
+@override_settings(PARSE_CACHE_DIR=None)
+class TestParallelIngest(TestCase):
+    def setUp(self):
+        self.financial_quarter = FinancialQuarter.objects.create(quarter=4, year=2018)
+        self.project = ProjectFactory(name="populated")
+        self.datamap = DatamapFactory()
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Project Name", sheet="Test Sheet 1", cell_ref="B1"
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Total Cost", sheet="Test Sheet 1", cell_ref="B2"
+        )
+        self.job = IngestJob(POPULATED, "populated")
+
+    def test_extracted_workbook_survives_pickling(self):
+        plan = get_extraction_plan(self.datamap)
+        extracted = extract_workbook(POPULATED, plan, read_only=True)
+        self.assertEqual(pickle.loads(pickle.dumps(extracted)), extracted)
+
+    def test_worker_reports_errors(self):
+        plan = get_extraction_plan(self.datamap)
+        result = _extract_in_worker((IngestJob("missing.xlsm", "x"), plan, None, True))
+        self.assertIsNone(result.extracted)
+        self.assertIn("missing.xlsm", result.error)
+
+    def test_single_writer_replaces_return(self):
+        Return.objects.create(
+            project=self.project, financial_quarter=self.financial_quarter
+        )
+        plan = get_extraction_plan(self.datamap)
+        worker_result = _extract_in_worker((self.job, plan, None, True))
+        result = _persist(
+            worker_result, self.financial_quarter, self.datamap, None, "replace"
+        )
+        self.assertIsNone(result.error)
+        self.assertEqual(result.cell_count, 2)
+        self.assertIn("extract", result.timings["stages"])
+        self.assertEqual(result.timings["counters"]["rows_written"], 2)
+        return_obj = Return.objects.get(
+            project=self.project, financial_quarter=self.financial_quarter
+        )
+        self.assertEqual(return_obj.pk, result.return_id)
+        self.assertEqual(
+            return_obj.return_returnitems.get(datamapline__key="Project Name").value_str,
+            "Testable Project",
+        )
+
+    def test_replaced_return_is_swapped_in_when_complete(self):
+        old = Return.objects.create(
+            project=self.project, financial_quarter=self.financial_quarter
+        )
+        with ingesting(self.project, self.financial_quarter, "replace") as staged:
+            self.assertTrue(staged.staging)
+            self.assertEqual(
+                list(self.financial_quarter.return_financial_quarters.all()), [old]
+            )
+        self.assertFalse(staged.staging)
+        self.assertEqual(
+            list(self.financial_quarter.return_financial_quarters.all()), [staged]
+        )
+        self.assertFalse(Return.all_objects.filter(pk=old.pk).exists())
+
+    def test_failed_replace_leaves_return(self):
+        old = Return.objects.create(
+            project=self.project, financial_quarter=self.financial_quarter
+        )
+        with self.assertRaises(ValueError):
+            with ingesting(self.project, self.financial_quarter, "replace"):
+                raise ValueError
+        self.assertEqual(list(Return.all_objects.all()), [old])
+
+    def test_upsert_keeps_return(self):
+        plan = get_extraction_plan(self.datamap)
+        worker_result = _extract_in_worker((self.job, plan, None, True))
+        first = _persist(
+            worker_result, self.financial_quarter, self.datamap, None, "upsert"
+        )
+        item_ids = set(
+            ReturnItem.objects.filter(parent_id=first.return_id).values_list(
+                "id", flat=True
+            )
+        )
+        second = _persist(
+            worker_result, self.financial_quarter, self.datamap, None, "upsert"
+        )
+        self.assertEqual(first.return_id, second.return_id)
+        self.assertEqual(
+            set(
+                ReturnItem.objects.filter(parent_id=second.return_id).values_list(
+                    "id", flat=True
+                )
+            ),
+            item_ids,
+        )
+
+    def test_parallel_ingest(self):
+        results = parallel_ingest(
+            [self.job, IngestJob("missing.xlsm", "populated")],
+            self.financial_quarter,
+            self.datamap,
+            workers=2,
+        )
+        by_path = {result.path: result for result in results}
+        self.assertIsNone(by_path[POPULATED].error)
+        self.assertIsNotNone(by_path["missing.xlsm"].error)
+        return_obj = Return.objects.get(pk=by_path[POPULATED].return_id)
+        self.assertEqual(return_obj.return_returnitems.count(), 2)
+
+    def test_pool_is_forked_without_open_connections(self):
+        idle = mock.Mock(in_atomic_block=False)
+        in_transaction = mock.Mock(in_atomic_block=True)
+        with mock.patch("excelparser.helpers.ingest.connections") as connections:
+            connections.all.return_value = [idle, in_transaction]
+            with worker_pool(1, 1):
+                pass
+        idle.close.assert_called_once_with()
+        in_transaction.close.assert_not_called()
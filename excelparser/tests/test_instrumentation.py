@@ -0,0 +1,49 @@
+import json
+
+from django.test import SimpleTestCase
+
+from excelparser.helpers.instrumentation import Instrumentation, aggregate
+
+
+class TestInstrumentation(SimpleTestCase):
+    def test_stages_and_counters(self):
+        timer = Instrumentation("a.xlsm")
+        with timer.stage("extract"):
+            pass
+        with timer.stage("extract"):
+            pass
+        timer.count("cells_read", 10)
+        timer.count("cells_read", 5)
+        record = timer.record()
+        self.assertEqual(record["file"], "a.xlsm")
+        self.assertEqual(list(record["stages"]), ["extract"])
+        self.assertEqual(record["counters"], {"cells_read": 15})
+        self.assertGreaterEqual(record["total"], record["stages"]["extract"])
+        json.dumps(record)
+
+    def test_carry_on_from_record(self):
+        record = {
+            "total": 2.0,
+            "stages": {"extract": 1.5},
+            "counters": {"bytes_read": 9},
+        }
+        timer = Instrumentation("a.xlsm", record=record)
+        timer.count("bytes_read")
+        self.assertEqual(timer.record()["counters"], {"bytes_read": 10})
+        self.assertGreaterEqual(timer.record()["total"], 2.0)
+
+    def test_aggregate(self):
+        records = [
+            {"file": "a", "total": 1.0, "stages": {"open": 0.5}, "counters": {"q": 1}},
+            {"file": "b", "total": 3.0, "stages": {"open": 1.0}, "counters": {"q": 2}},
+        ]
+        self.assertEqual(
+            aggregate(records),
+            {
+                "files": 2,
+                "total": 4.0,
+                "stages": {"open": 1.5},
+                "counters": {"q": 3},
+                "slowest": "b",
+            },
+        )
@@ -0,0 +1,78 @@
+import io
+import os
+import resource
+
+from django.test import SimpleTestCase, override_settings
+
+from excelparser.helpers.memory import (
+    MB,
+    MemoryMonitor,
+    ParserMemoryError,
+    exceeds_streaming_threshold,
+    file_size,
+)
+
+POPULATED = os.path.join(os.path.dirname(__file__), "populated.xlsm")
+
+
+class TestMemoryMonitor(SimpleTestCase):
+    def test_records_peak_rss(self):
+        with MemoryMonitor(interval=0.01) as memory:
+            start = memory.peak_rss
+            block = bytearray(64 * MB)
+        del block
+        self.assertGreaterEqual(memory.peak_rss, start + 32 * MB)
+
+    def test_restarted_monitor_measures_from_its_first_start(self):
+        memory = MemoryMonitor(interval=0.01)
+        with memory:
+            block = bytearray(64 * MB)
+        baseline = memory.baseline_rss
+        with memory:
+            pass
+        del block
+        self.assertEqual(memory.baseline_rss, baseline)
+        self.assertGreaterEqual(memory.peak_increase, 32 * MB)
+
+    def test_tracemalloc(self):
+        with MemoryMonitor(trace=True) as memory:
+            block = bytearray(8 * MB)
+        del block
+        self.assertGreaterEqual(memory.peak_traced, 8 * MB)
+
+    def test_budget_aborts_cleanly(self):
+        limit = resource.getrlimit(resource.RLIMIT_AS)
+        with self.assertRaisesMessage(ParserMemoryError, "budget of 32 MB"):
+            with MemoryMonitor(budget=32 * MB, label="big.xlsm"):
+                bytearray(512 * MB)
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_AS), limit)
+
+    def test_overlapping_budgets_restore_the_limit(self):
+        limit = resource.getrlimit(resource.RLIMIT_AS)
+        outer = MemoryMonitor(budget=1024 * MB).start()
+        inner = MemoryMonitor(budget=512 * MB).start()
+        lowered = resource.getrlimit(resource.RLIMIT_AS)[0]
+        # stopped in a different order from how they started
+        outer.stop()
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_AS)[0], lowered)
+        inner.stop()
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_AS), limit)
+
+
+class TestStreamingThreshold(SimpleTestCase):
+    def test_file_size(self):
+        size = os.path.getsize(POPULATED)
+        self.assertEqual(file_size(POPULATED), size)
+        stream = io.BytesIO(b"x" * 10)
+        stream.seek(3)
+        self.assertEqual(file_size(stream), 10)
+        self.assertEqual(stream.tell(), 3)
+
+    def test_threshold(self):
+        size = os.path.getsize(POPULATED)
+        with override_settings(PARSER_STREAMING_THRESHOLD=size - 1):
+            self.assertTrue(exceeds_streaming_threshold(POPULATED))
+        with override_settings(PARSER_STREAMING_THRESHOLD=size):
+            self.assertFalse(exceeds_streaming_threshold(POPULATED))
+        with override_settings(PARSER_STREAMING_THRESHOLD=None):
+            self.assertFalse(exceeds_streaming_threshold(POPULATED))
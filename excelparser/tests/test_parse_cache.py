@@ -0,0 +1,113 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from datamap.models import DatamapLine
+from excelparser.helpers.engines import ExtractedWorkbook
+from excelparser.helpers.extraction_plan import get_extraction_plan
+from excelparser.helpers.parse_cache import (
+    CacheKey,
+    ParseCache,
+    cached_extract_workbook,
+    get_parse_cache,
+    hash_file,
+)
+from factories.datamap_factories import DatamapFactory
+
+POPULATED = os.path.join(os.path.dirname(__file__), "populated.xlsm")
+
+
+def _extracted(n):
+    return ExtractedWorkbook(f"{n}.xlsm", ["Sheet"], {"Sheet": [n] * 100}, "v1")
+
+
+class TestParseCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ParseCache(self.directory)
+        self.datamap = DatamapFactory()
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Project Name", sheet="Test Sheet 1", cell_ref="B1"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hash_file_path_and_stream_agree(self):
+        with open(POPULATED, "rb") as f:
+            stream = io.BytesIO(f.read())
+        self.assertEqual(hash_file(POPULATED), hash_file(stream))
+        self.assertEqual(stream.tell(), 0)
+        # a stream which has already been read is still hashed whole
+        stream.read()
+        self.assertEqual(hash_file(POPULATED), hash_file(stream))
+
+    def test_round_trip(self):
+        key = CacheKey("ab" * 32, 1, "v1", "openpyxl")
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, _extracted(1))
+        self.assertEqual(self.cache.get(key), _extracted(1))
+
+    def test_corrupt_entry_is_discarded(self):
+        key = CacheKey("ab" * 32, 1, "v1", "openpyxl")
+        self.cache.set(key, _extracted(1))
+        with open(self.cache._path(key), "wb") as f:
+            f.write(b"not a cache entry")
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(self.cache._path(key)))
+
+    def test_evicts_least_recently_used(self):
+        keys = [CacheKey(f"{n:02}" * 32, 1, "v1", "openpyxl") for n in range(3)]
+        for n, key in enumerate(keys):
+            self.cache.set(key, _extracted(n))
+            os.utime(self.cache._path(key), (n, n))
+        sizes = [os.path.getsize(self.cache._path(key)) for key in keys]
+        self.cache.max_bytes = sum(sizes) - 1
+        self.cache.get(keys[0])
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+
+    def test_hit_skips_extraction(self):
+        plan = get_extraction_plan(self.datamap)
+        extracted, hit = cached_extract_workbook(POPULATED, plan, cache=self.cache)
+        self.assertFalse(hit)
+        with mock.patch("excelparser.helpers.parse_cache.extract_workbook") as extract:
+            cached, hit = cached_extract_workbook(
+                POPULATED, plan, filename="renamed.xlsm", cache=self.cache
+            )
+        extract.assert_not_called()
+        self.assertTrue(hit)
+        self.assertEqual(cached, extracted)
+        self.assertEqual(cached.filename, "renamed.xlsm")
+
+    def test_datamap_change_misses(self):
+        plan = get_extraction_plan(self.datamap)
+        cached_extract_workbook(POPULATED, plan, cache=self.cache)
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Total Cost", sheet="Test Sheet 1", cell_ref="B2"
+        )
+        plan = get_extraction_plan(self.datamap)
+        extracted, hit = cached_extract_workbook(POPULATED, plan, cache=self.cache)
+        self.assertFalse(hit)
+        self.assertEqual(extracted.cell_count, 2)
+
+    def test_engine_change_misses(self):
+        plan = get_extraction_plan(self.datamap)
+        cached_extract_workbook(POPULATED, plan, engine="openpyxl", cache=self.cache)
+        _, hit = cached_extract_workbook(
+            POPULATED, plan, engine="native", cache=self.cache
+        )
+        self.assertFalse(hit)
+        with override_settings(PARSER_DEFAULT_ENGINE="native"):
+            _, hit = cached_extract_workbook(POPULATED, plan, cache=self.cache)
+        self.assertTrue(hit)
+
+    @override_settings(PARSE_CACHE_DIR=None)
+    def test_disabled(self):
+        self.assertIsNone(get_parse_cache())
@@ -1,4 +1,6 @@
+import resource
 import unittest
+from unittest import mock
 
 from datetime import datetime, date
 
@@ -6,11 +8,19 @@ from django.test import TestCase
 from django.utils import timezone
 
 from datamap.models import DatamapLine
-from excelparser.helpers.parser import ParsedSpreadsheet, CellData, CellValueType
+from excelparser.helpers.extractors import extract_values
+from excelparser.helpers.memory import MB, ParserMemoryError
+from excelparser.helpers.parser import (
+    ParsedSpreadsheet,
+    CellData,
+    CellValueType,
+    MissingSheetError,
+    detect_cell_types,
+)
 from factories.datamap_factories import DatamapFactory
 from factories.datamap_factories import ProjectFactory
 from register.models import FinancialQuarter
-from returns.models import Return
+from returns.models import Return, ReturnItem
 
 
 class TestParseToReturn(TestCase):
@@ -133,6 +143,7 @@ class TestParseToReturn(TestCase):
 
         self.assertEqual(return_item_srocell.datamapline.key, "SRO Retirement Date")
         self.assertEqual(return_item_srocell.value_date, date(2022, 2, 23))
+        self.assertEqual(return_item_srocell.value_type, ReturnItem.DATE)
 
         self.assertEqual(return_item_sro.datamapline.key, "SRO")
         self.assertEqual(return_item_sro.value_str, "John Milton")
@@ -143,3 +154,157 @@ class TestParseToReturn(TestCase):
         self.assertIsNone(return_item_missing_data.value_date)
         self.assertIsNone(return_item_missing_data.value_str)
         self.assertIsNone(return_item_missing_data.value_float)
+        self.assertEqual(return_item_missing_data.value_type, ReturnItem.EMPTY)
+        self.assertEqual(return_item_missing_data.value, "")
+
+    def test_parse_to_return_object_read_only(self):
+        parsed_spreadsheet = ParsedSpreadsheet(
+            template_path=self.populated_template,
+            project=self.project,
+            return_obj=self.return_obj,
+            datamap=self.datamap,
+            read_only=True,
+        )
+        parsed_spreadsheet.process()
+        return_item = (
+            Return.objects.get(id=self.return_obj.id)
+            .return_returnitems.filter(datamapline__key="SRO Retirement Date")
+            .first()
+        )
+        self.assertEqual(return_item.value_date, date(2022, 2, 23))
+        self.assertEqual(parsed_spreadsheet["Test Sheet 1"]["SRO"].value, "John Milton")
+        self.assertEqual(
+            Return.objects.get(id=self.return_obj.id).return_returnitems.count(), 6
+        )
+
+    def test_parse_to_return_object_native_engine(self):
+        parsed_spreadsheet = ParsedSpreadsheet(
+            template_path=self.populated_template,
+            project=self.project,
+            return_obj=self.return_obj,
+            datamap=self.datamap,
+            engine="native",
+        )
+        self.assertEqual(parsed_spreadsheet.sheetnames, ["Test Sheet 1", "Test Sheet 2"])
+        parsed_spreadsheet.process()
+        sheet = parsed_spreadsheet["Test Sheet 1"]
+        self.assertEqual(sheet["Project Name"].value, "Testable Project")
+        self.assertEqual(sheet["Total Cost"].value, 45.2)
+        self.assertEqual(sheet["SRO Retirement Date"].value, date(2022, 2, 23))
+        self.assertEqual(sheet["SRO Retirement Date"].type, CellValueType.DATE)
+        self.assertIsNone(sheet["Missing Data"].value)
+        self.assertEqual(
+            parsed_spreadsheet["Test Sheet 2"]["Janitor's Favourite Colour"].value,
+            "Purple",
+        )
+        self.assertEqual(
+            Return.objects.get(id=self.return_obj.id).return_returnitems.count(), 6
+        )
+
+    def test_parse_against_several_datamaps(self):
+        new_datamap = DatamapFactory(name="New Datamap")
+        DatamapLine.objects.create(
+            datamap=new_datamap, key="Name", sheet="Test Sheet 1", cell_ref="B1"
+        )
+        DatamapLine.objects.create(
+            datamap=new_datamap, key="Retirement", sheet="Test Sheet 1", cell_ref="B4"
+        )
+        with mock.patch(
+            "excelparser.helpers.engines.extract_values", wraps=extract_values
+        ) as extract:
+            parsed = ParsedSpreadsheet.for_datamaps(
+                self.populated_template,
+                self.project,
+                self.return_obj,
+                [self.datamap, new_datamap],
+                read_only=True,
+            )
+        # one read of each sheet, of the union of the cells
+        self.assertEqual(extract.call_count, 2)
+        self.assertEqual(len(extract.call_args_list[0][0][1]), 5)
+        old, new = parsed[self.datamap], parsed[new_datamap]
+        self.assertEqual(
+            old["Test Sheet 1"]["Project Name"].value,
+            new["Test Sheet 1"]["Name"].value,
+        )
+        self.assertEqual(new["Test Sheet 1"]["Retirement"].value, date(2022, 2, 23))
+        self.assertEqual(
+            old["Test Sheet 2"]["Janitor's Favourite Colour"].value, "Purple"
+        )
+        new.process()
+        self.assertEqual(self.return_obj.return_returnitems.count(), 2)
+
+    def test_timings_recorded(self):
+        self.parsed_spreadsheet.process()
+        timings = self.parsed_spreadsheet.timings
+        self.assertEqual(
+            list(timings["stages"]),
+            ["open", "extract", "detect_types", "build_items", "write"],
+        )
+        self.assertEqual(timings["counters"]["cells_read"], 6)
+        self.assertEqual(timings["counters"]["rows_written"], 6)
+        self.assertGreater(timings["counters"]["queries"], 0)
+
+    def test_peak_memory_recorded(self):
+        # measured while the workbook is opened and while it is processed
+        memory = self.parsed_spreadsheet._memory
+        self.assertFalse(memory.running)
+        opened = memory.baseline_rss
+        self.assertIsNotNone(opened)
+        self.parsed_spreadsheet.process()
+        self.assertFalse(memory.running)
+        self.assertEqual(memory.baseline_rss, opened)
+        self.assertEqual(
+            Return.objects.get(id=self.return_obj.id).parse_peak_memory,
+            memory.peak_rss - opened,
+        )
+
+    def test_memory_budget_covers_opening_the_workbook(self):
+        limit = resource.getrlimit(resource.RLIMIT_AS)
+        # a full load reads the whole workbook into memory before process()
+        with mock.patch(
+            "excelparser.helpers.parser.open_workbook",
+            side_effect=lambda *args, **kwargs: bytearray(512 * MB),
+        ):
+            with self.assertRaisesMessage(ParserMemoryError, "budget of 32 MB"):
+                ParsedSpreadsheet(
+                    template_path=self.populated_template,
+                    project=self.project,
+                    return_obj=self.return_obj,
+                    datamap=self.datamap,
+                    memory_budget=32 * MB,
+                )
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_AS), limit)
+
+    def test_sheets_are_converted_on_first_access(self):
+        with ParsedSpreadsheet(
+            template_path=self.populated_template,
+            project=self.project,
+            return_obj=self.return_obj,
+            datamap=self.datamap,
+            read_only=True,
+        ) as parsed_spreadsheet:
+            sheet = parsed_spreadsheet["Test Sheet 2"]
+            self.assertEqual(list(parsed_spreadsheet._sheet_data), ["Test Sheet 2"])
+            self.assertIs(parsed_spreadsheet["Test Sheet 2"], sheet)
+        self.assertEqual(sheet["Janitor's Favourite Colour"].value, "Purple")
+        with self.assertRaises(MissingSheetError):
+            parsed_spreadsheet["Not A Sheet"]
+
+
+class TestDetectCellTypes(unittest.TestCase):
+    def test_matches_per_cell_detection(self):
+        values = ["a", 1, True, 1.5, date(2018, 1, 1), datetime(2018, 1, 1), None, [1]]
+        expected = [
+            CellValueType.STRING,
+            CellValueType.INTEGER,
+            CellValueType.INTEGER,
+            CellValueType.FLOAT,
+            CellValueType.DATE,
+            CellValueType.DATE,
+            CellValueType.UNKNOWN,
+            CellValueType.UNKNOWN,
+        ]
+        self.assertEqual(
+            [CellValueType(code) for code in detect_cell_types(values)], expected
+        )
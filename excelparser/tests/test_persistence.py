@@ -0,0 +1,158 @@
+import datetime
+import decimal
+import unittest
+
+from django.db import connection
+from django.test import TestCase
+
+from datamap.models import DatamapLine
+from excelparser.helpers.persistence import (
+    WriteStrategyError,
+    _copy_value,
+    SyncResult,
+    resolve_write_strategy,
+    sync_return_items,
+    write_return_items,
+)
+from factories.datamap_factories import DatamapFactory, ProjectFactory
+from register.models import FinancialQuarter
+from returns.models import Return, ReturnItem
+
+
+class TestWriteReturnItems(TestCase):
+    def setUp(self):
+        self.datamap = DatamapFactory()
+        self.return_obj = Return.objects.create(
+            project=ProjectFactory(),
+            financial_quarter=FinancialQuarter.objects.create(quarter=1, year=2010),
+        )
+        self.dmls = [
+            DatamapLine.objects.create(
+                datamap=self.datamap, key=f"Key {n}", sheet="Sheet", cell_ref=f"A{n}"
+            )
+            for n in range(1, 6)
+        ]
+
+    def _items(self):
+        return [
+            ReturnItem(parent=self.return_obj, datamapline=dml, value_str=dml.key)
+            for dml in self.dmls
+        ]
+
+    def test_bulk_create_is_batched(self):
+        with self.assertNumQueries(3):
+            # SAVEPOINT, INSERT, RELEASE SAVEPOINT
+            write_return_items(self._items(), strategy="bulk_create", batch_size=10)
+        self.assertEqual(self.return_obj.return_returnitems.count(), 5)
+        self.assertEqual(
+            self.return_obj.return_returnitems.get(datamapline=self.dmls[2]).value_str,
+            "Key 3",
+        )
+
+    def test_create_writes_each_item(self):
+        self.assertEqual(write_return_items(self._items(), strategy="create"), 5)
+        self.assertEqual(self.return_obj.return_returnitems.count(), 5)
+
+    def test_bad_strategy(self):
+        with self.assertRaises(WriteStrategyError):
+            resolve_write_strategy("telepathy")
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_copy_round_trip(self):
+        values = [
+            {"value_str": None},
+            {"value_str": ""},
+            {"value_str": 'Say "hi", Bob'},
+            {"value_str": None, "value_date": datetime.date(2019, 3, 1)},
+            {"value_str": None, "value_float": 1.25},
+        ]
+        items = [
+            ReturnItem(parent=self.return_obj, datamapline=dml, **fields)
+            for dml, fields in zip(self.dmls, values)
+        ]
+        self.assertEqual(write_return_items(items, strategy="copy"), 5)
+        written = {
+            item.datamapline_id: item
+            for item in self.return_obj.return_returnitems.all()
+        }
+        self.assertIsNone(written[self.dmls[0].id].value_str)
+        self.assertEqual(written[self.dmls[1].id].value_str, "")
+        self.assertEqual(written[self.dmls[2].id].value_str, 'Say "hi", Bob')
+        self.assertEqual(written[self.dmls[3].id].value_date, datetime.date(2019, 3, 1))
+        self.assertIsNone(written[self.dmls[3].id].value_float)
+        self.assertEqual(written[self.dmls[4].id].value_float, decimal.Decimal("1.25"))
+
+    @unittest.skipIf(connection.vendor == "postgresql", "PostgreSQL allows copy")
+    def test_auto_strategy_without_postgres(self):
+        self.assertEqual(resolve_write_strategy("auto"), "bulk_create")
+        with self.assertRaises(WriteStrategyError):
+            resolve_write_strategy("copy")
+
+    def test_copy_value_format(self):
+        self.assertEqual(_copy_value(None), "\\N")
+        self.assertEqual(_copy_value(""), '""')
+        self.assertEqual(_copy_value('Say "hi", Bob'), '"Say ""hi"", Bob"')
+        self.assertEqual(_copy_value(12), '"12"')
+        self.assertEqual(_copy_value(datetime.date(2019, 3, 1)), '"2019-03-01"')
+
+
+class TestSyncReturnItems(TestCase):
+    def setUp(self):
+        self.datamap = DatamapFactory()
+        self.return_obj = Return.objects.create(
+            project=ProjectFactory(),
+            financial_quarter=FinancialQuarter.objects.create(quarter=1, year=2010),
+        )
+        self.dmls = [
+            DatamapLine.objects.create(
+                datamap=self.datamap, key=f"Key {n}", sheet="Sheet", cell_ref=f"A{n}"
+            )
+            for n in range(1, 5)
+        ]
+        write_return_items(
+            [
+                self._item(self.dmls[0], value_str="a"),
+                self._item(self.dmls[1], value_str=None, value_float=1.5),
+                self._item(self.dmls[2], value_str="c"),
+            ],
+            strategy="bulk_create",
+        )
+        self.ids = dict(
+            self.return_obj.return_returnitems.values_list("datamapline_id", "id")
+        )
+
+    def _item(self, dml, **values):
+        return ReturnItem(parent=self.return_obj, datamapline_id=dml.id, **values)
+
+    def test_identical_parse_changes_nothing(self):
+        items = [
+            self._item(self.dmls[0], value_str="a"),
+            self._item(self.dmls[1], value_str=None, value_float=1.5),
+            self._item(self.dmls[2], value_str="c"),
+        ]
+        with self.assertNumQueries(3):
+            # SAVEPOINT, SELECT, RELEASE SAVEPOINT
+            result = sync_return_items(self.return_obj, items)
+        self.assertEqual(result, SyncResult(0, 0, 0, 3))
+
+    def test_diff(self):
+        items = [
+            self._item(self.dmls[0], value_str="a"),
+            self._item(self.dmls[1], value_str=None, value_float=2.25),
+            self._item(self.dmls[3], value_str="d"),
+        ]
+        result = sync_return_items(self.return_obj, items, strategy="bulk_create")
+        self.assertEqual(
+            result, SyncResult(created=1, updated=1, deleted=1, unchanged=1)
+        )
+        current = {
+            item.datamapline_id: item
+            for item in self.return_obj.return_returnitems.all()
+        }
+        self.assertEqual(
+            set(current), {self.dmls[0].id, self.dmls[1].id, self.dmls[3].id}
+        )
+        # existing rows are updated in place
+        self.assertEqual(current[self.dmls[1].id].id, self.ids[self.dmls[1].id])
+        self.assertEqual(float(current[self.dmls[1].id].value_float), 2.25)
+        self.assertEqual(current[self.dmls[3].id].value_str, "d")
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from core.models import StoredBlob
+from core.storage import collect_garbage, upload_storage
+from datamap.models import DatamapLine
+from excelparser.helpers.parser import ParsedSpreadsheet
+from excelparser.helpers.uploads import (
+    archive_members,
+    archive_upload,
+    extracted_member,
+)
+from factories.datamap_factories import DatamapFactory, ProjectFactory
+from register.models import FinancialQuarter
+from returns.models import Return
+
+POPULATED = os.path.join(os.path.dirname(__file__), "populated.xlsm")
+
+
+class TestUploads(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        with open(POPULATED, "rb") as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_parse_from_upload(self):
+        datamap = DatamapFactory()
+        DatamapLine.objects.create(
+            datamap=datamap, key="Project Name", sheet="Test Sheet 1", cell_ref="B1"
+        )
+        project = ProjectFactory()
+        return_obj = Return.objects.create(
+            project=project,
+            financial_quarter=FinancialQuarter.objects.create(quarter=1, year=2010),
+        )
+        upload = SimpleUploadedFile("Upload Project.xlsm", self.content)
+        parsed = ParsedSpreadsheet(upload, project, return_obj, datamap)
+        self.assertEqual(parsed.filename, "Upload Project.xlsm")
+        parsed.process()
+        self.assertEqual(
+            return_obj.return_returnitems.get().value_str, "Testable Project"
+        )
+
+    @override_settings(ARCHIVE_UPLOADS=False)
+    def test_archiving_disabled(self):
+        upload = SimpleUploadedFile("Upload Project.xlsm", self.content)
+        self.assertIsNone(archive_upload(upload))
+
+    def test_zip_members(self):
+        archive = os.path.join(self.media_root, "batch.zip")
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("templates/", "")
+            zf.writestr("templates/Upload Project.xlsm", self.content)
+            zf.writestr("__MACOSX/templates/._Upload Project.xlsm", b"")
+            zf.writestr("templates/.DS_Store", b"")
+        self.assertEqual(archive_members(archive), ["templates/Upload Project.xlsm"])
+        with extracted_member(archive, "templates/Upload Project.xlsm") as path:
+            self.assertEqual(os.path.basename(path), "Upload Project.xlsm")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(path))
+
+
+class TestArchiveUpload(TransactionTestCase):
+    # uploads are saved, and their Return updated, by a background thread,
+    # which only sees committed data and commits the StoredBlob rows it
+    # writes; flushing the database after each test removes them
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        with open(POPULATED, "rb") as f:
+            self.content = f.read()
+        self.return_obj = Return.objects.create(
+            project=ProjectFactory(),
+            financial_quarter=FinancialQuarter.objects.create(quarter=1, year=2010),
+        )
+
+    def _archive(self, content):
+        upload = SimpleUploadedFile("Upload Project.xlsm", content)
+        return archive_upload(upload, return_obj=self.return_obj).result()
+
+    def test_archive_in_memory_upload(self):
+        upload = SimpleUploadedFile("Upload Project.xlsm", self.content)
+        name = archive_upload(upload).result()
+        with open(os.path.join(self.media_root, name), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(upload.tell(), 0)
+
+    def test_archive_temporary_upload(self):
+        upload = TemporaryUploadedFile(
+            "Upload Project.xlsm", "application/octet-stream", len(self.content), None
+        )
+        upload.write(self.content)
+        upload.flush()
+        future = archive_upload(upload)
+        # the request finishing deletes the temporary file
+        upload.close()
+        with open(os.path.join(self.media_root, future.result()), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_archive_closes_its_connection(self):
+        upload = SimpleUploadedFile("Upload Project.xlsm", self.content)
+        with mock.patch("excelparser.helpers.uploads.connection") as connection:
+            archive_upload(upload).result()
+        connection.close.assert_called_once_with()
+
+    def test_replaced_upload_becomes_collectable(self):
+        first = self._archive(self.content)
+        second = self._archive(self.content + b"\0")
+        self.return_obj.refresh_from_db()
+        self.assertEqual(self.return_obj.upload_name, second)
+        self.assertEqual(StoredBlob.objects.get(name=first).refcount, 0)
+        self.assertEqual(collect_garbage(upload_storage, grace=0), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, first)))
+
+        self.return_obj.delete()
+        self.assertEqual(StoredBlob.objects.get(name=second).refcount, 0)
@@ -0,0 +1,105 @@
+import datetime
+import os
+
+from django.test import TestCase
+
+from datamap.models import DatamapLine
+from excelparser.helpers.engines import ExtractedWorkbook
+from excelparser.helpers.extraction_plan import get_extraction_plan
+from excelparser.helpers.validation import (
+    MAX_LENGTH,
+    MISSING_SHEET,
+    REQUIRED,
+    TYPE_MISMATCH,
+    UNREADABLE,
+    validate_extracted,
+    validate_files,
+)
+from factories.datamap_factories import DatamapFactory
+
+POPULATED = os.path.join(os.path.dirname(__file__), "populated.xlsm")
+
+
+class TestValidation(TestCase):
+    def setUp(self):
+        self.datamap = DatamapFactory()
+        DatamapLine.objects.create(
+            datamap=self.datamap,
+            key="Project Name",
+            sheet="Test Sheet 1",
+            cell_ref="B1",
+            max_length=10,
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap,
+            key="Total Cost",
+            sheet="Test Sheet 1",
+            cell_ref="B2",
+            data_type="Float",
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap,
+            key="SRO",
+            sheet="Test Sheet 1",
+            cell_ref="B3",
+            data_type="Date",
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap,
+            key="Missing Data",
+            sheet="Test Sheet 1",
+            cell_ref="B5",
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap,
+            key="Optional Data",
+            sheet="Test Sheet 1",
+            cell_ref="B6",
+            required=False,
+        )
+        self.plan = get_extraction_plan(self.datamap)
+
+    def test_validate_file(self):
+        report, = validate_files([POPULATED], self.datamap, workers=1)
+        self.assertFalse(report.valid)
+        self.assertEqual(report.cell_count, 5)
+        issues = {issue.key: issue.code for issue in report.issues}
+        self.assertEqual(
+            issues,
+            {
+                "Project Name": MAX_LENGTH,
+                "SRO": TYPE_MISMATCH,
+                "Missing Data": REQUIRED,
+            },
+        )
+        self.assertEqual(report.to_dict()["issues"][0]["cell_ref"], "B1")
+
+    def test_missing_sheet_and_unreadable(self):
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Elsewhere", sheet="Not There", cell_ref="A1"
+        )
+        reports = validate_files([POPULATED, "missing.xlsm"], self.datamap, workers=2)
+        self.assertIn(MISSING_SHEET, [issue.code for issue in reports[0].issues])
+        self.assertEqual([issue.code for issue in reports[1].issues], [UNREADABLE])
+
+    def test_whole_float_is_an_integer(self):
+        for key, data_type in [("Total Cost", "Integer"), ("SRO", "Text")]:
+            dml = DatamapLine.objects.get(datamap=self.datamap, key=key)
+            dml.data_type = data_type
+            dml.save()
+        plan = get_extraction_plan(self.datamap)
+        extracted = ExtractedWorkbook(
+            "test.xlsm",
+            ["Test Sheet 1"],
+            {"Test Sheet 1": ["Short", 12.0, 14, "   ", None]},
+            plan.version,
+        )
+        report = validate_extracted(extracted, plan)
+        self.assertEqual([issue.key for issue in report.issues], ["Missing Data"])
+        extracted.values["Test Sheet 1"][1] = 12.5
+        extracted.values["Test Sheet 1"][2] = datetime.datetime(2019, 1, 1)
+        report = validate_extracted(extracted, plan)
+        self.assertEqual(
+            [issue.key for issue in report.issues],
+            ["Total Cost", "SRO", "Missing Data"],
+        )
@@ -0,0 +1,132 @@
+import datetime
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+from openpyxl import Workbook, load_workbook
+
+from excelparser.helpers.extraction_plan import PlannedCell, cell_ref_to_row_col
+from excelparser.helpers.extractors import random_access_extract
+from excelparser.helpers.xlsx_reader import (
+    NativeReaderError,
+    NativeWorkbook,
+    from_excel_serial,
+    is_date_format,
+)
+
+
+def _planned(*cell_refs):
+    cells = [
+        PlannedCell(*cell_ref_to_row_col(ref), f"Key {ref}", n, "Text", ref)
+        for n, ref in enumerate(cell_refs)
+    ]
+    return sorted(cells, key=lambda c: (c.row, c.col))
+
+
+class TestNativeWorkbook(SimpleTestCase):
+    """
+    The native reader must give the same values as openpyxl in data_only
+    mode.
+    """
+
+    def setUp(self):
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Test Sheet 1"
+        ws["A1"] = "Project Name"
+        ws["B1"] = "Testable Project"
+        ws["B2"] = 45.2
+        ws["B3"] = 12
+        ws["B4"] = datetime.datetime(2022, 2, 23)
+        ws["B5"] = True
+        ws["B6"] = "=B2*2"
+        ws["C7"] = datetime.datetime(2019, 3, 1, 12, 0)
+        ws["D7"] = "Testable Project"
+        ws2 = wb.create_sheet("Test Sheet 2")
+        ws2["B1"] = "Purple"
+        ws2["B200"] = "Far down"
+        wb.create_sheet("Not In Datamap")["A1"] = "Ignored"
+        fd, self.path = tempfile.mkstemp(suffix=".xlsx")
+        os.close(fd)
+        wb.save(self.path)
+        self.cells = _planned("A1", "B1", "B2", "B3", "B4", "B5", "B6", "C7", "D7", "Z99")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_sheetnames(self):
+        with NativeWorkbook(self.path) as wb:
+            self.assertEqual(
+                wb.sheetnames, ["Test Sheet 1", "Test Sheet 2", "Not In Datamap"]
+            )
+
+    def test_matches_openpyxl(self):
+        expected_wb = load_workbook(self.path, data_only=True)
+        with NativeWorkbook(self.path) as wb:
+            for sheet_name, cells in [
+                ("Test Sheet 1", self.cells),
+                ("Test Sheet 2", _planned("B1", "B200", "C1")),
+            ]:
+                self.assertEqual(
+                    wb[sheet_name].extract_cells(cells),
+                    random_access_extract(expected_wb[sheet_name], cells),
+                )
+
+    def test_values(self):
+        with NativeWorkbook(self.path) as wb:
+            values = wb["Test Sheet 1"].extract_cells(self.cells)
+        self.assertEqual(
+            values,
+            [
+                "Project Name",
+                "Testable Project",
+                45.2,
+                12,
+                datetime.datetime(2022, 2, 23),
+                True,
+                None,
+                datetime.datetime(2019, 3, 1, 12, 0),
+                "Testable Project",
+                None,
+            ],
+        )
+
+    def test_file_like_source(self):
+        with open(self.path, "rb") as f:
+            with NativeWorkbook(f) as wb:
+                self.assertEqual(
+                    wb["Test Sheet 2"].extract_cells(_planned("B1")), ["Purple"]
+                )
+
+    def test_missing_sheet(self):
+        with NativeWorkbook(self.path) as wb:
+            with self.assertRaises(KeyError):
+                wb["MISSING SHEET"]
+
+    def test_not_an_excel_file(self):
+        with tempfile.NamedTemporaryFile(suffix=".xlsm") as f:
+            f.write(b"not a zip file")
+            f.flush()
+            with self.assertRaises(NativeReaderError):
+                NativeWorkbook(f.name)
+
+
+class TestNativeConversions(SimpleTestCase):
+    def test_is_date_format(self):
+        self.assertTrue(is_date_format("dd/mm/yyyy"))
+        self.assertTrue(is_date_format("[$-809]dd mmmm yyyy;@"))
+        self.assertFalse(is_date_format("0.00"))
+        self.assertFalse(is_date_format('"Days "0'))
+        self.assertFalse(is_date_format("[Red]#,##0"))
+
+    def test_from_excel_serial(self):
+        self.assertEqual(from_excel_serial(44615), datetime.datetime(2022, 2, 23))
+        self.assertEqual(from_excel_serial(59), datetime.datetime(1900, 2, 28))
+        self.assertEqual(from_excel_serial(61), datetime.datetime(1900, 3, 1))
+        self.assertEqual(
+            from_excel_serial(43525.5), datetime.datetime(2019, 3, 1, 12, 0)
+        )
+        self.assertEqual(
+            from_excel_serial(0, date1904=True), datetime.datetime(1904, 1, 1)
+        )
+        self.assertEqual(from_excel_serial(0.25), datetime.time(6, 0))
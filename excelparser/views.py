@@ -1,17 +1,15 @@
 import logging
-import os
 
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
-from django.conf import settings
 from django.contrib import messages
-from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import UploadedFile
 from django.urls import reverse_lazy
 from django.views.generic import FormView
 
 from excelparser.forms import ProcessPopulatedTemplateForm
 from excelparser.helpers.parser import ParsedSpreadsheet
+from excelparser.helpers.uploads import archive_upload
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -39,14 +37,16 @@ class ProcessPopulatedTemplate(FormView):
     def form_valid(self, form):
         logger.info("Trying to parse form {}".format(form))
         uploaded_file: UploadedFile = self.request.FILES['source_file']
-        save_path = os.path.join(settings.MEDIA_ROOT, 'uploads', uploaded_file.name)
-        path = default_storage.save(save_path, uploaded_file)
         project = form.cleaned_data['return_obj'].project
         return_obj = form.cleaned_data['return_obj']
+        archive_upload(uploaded_file, return_obj=return_obj)
         datamap = form.cleaned_data['datamap']
         try:
-            logger.info("Trying to parse spreadsheet {}".format(save_path))
-            parsed_spreadsheet = ParsedSpreadsheet(path, project, return_obj, datamap)
+            logger.info("Trying to parse spreadsheet {}".format(uploaded_file.name))
+            # parse straight from the upload rather than the archived copy
+            parsed_spreadsheet = ParsedSpreadsheet(
+                uploaded_file, project, return_obj, datamap
+            )
         except Exception:
             messages.add_message(self.request, messages.ERROR, f"ERROR uploading file: {uploaded_file}. Please check that it is a valid template.")
             return redirect("excelparser:process_populated", self.kwargs['return_id'])
@@ -1,7 +1,29 @@
 from django.contrib import admin
 
-from returns.models import ReturnItem, Return
+from returns.models import IngestBatch, IngestFile, MasterArtefact, ReturnItem, Return
+from returns.signals import returns_changed
+
+
+class ReturnItemAdmin(admin.ModelAdmin):
+    # ReturnItems send no model signals, so report the change to their Return
+    def _changed(self, obj):
+        if not obj.parent.staging:
+            returns_changed.send(
+                sender=Return, financial_quarter_id=obj.parent.financial_quarter_id
+            )
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self._changed(obj)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self._changed(obj)
+
 
 admin.site.register(Return)
-admin.site.register(ReturnItem)
+admin.site.register(ReturnItem, ReturnItemAdmin)
 
+admin.site.register(IngestBatch)
+admin.site.register(IngestFile)
+admin.site.register(MasterArtefact)
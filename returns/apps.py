@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ReturnsConfig(AppConfig):
     name = 'returns'
 
+    def ready(self):
+        # connect the signal receivers that mark built master workbooks stale
+        from returns import helpers  # noqa: F401
@@ -0,0 +1,165 @@
+"""
+Exports of the master in formats which load straight into a dataframe.
+
+Each is made from master_pivot(), as the workbook is, but has a row for
+each Return and a column for each key, so that a column holds values of
+one kind: "Project", then the keys in DatamapLine order, each named so
+that no two columns share a name (see master_columns). Empty cells are
+null. CSV and NDJSON are streamed as they are produced; Parquet and Arrow
+IPC need pyarrow, and are only offered when it is installed.
+"""
+import csv
+import datetime
+import decimal
+import io
+import json
+from collections import Counter
+from typing import IO, Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from returns.helpers import MasterPivot
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PROJECT_COLUMN = "Project"
+
+
+class ExportFormat(NamedTuple):
+    """
+    A format the master can be exported in, named by its file extension
+    in EXPORT_FORMATS.
+    """
+
+    content_type: str
+    # exactly one of these is given: a generator of the output's chunks, or a
+    # function writing it to a binary file
+    stream: Optional[Callable[[MasterPivot], Iterator[str]]] = None
+    write: Optional[Callable[[MasterPivot, IO[bytes]], None]] = None
+
+
+def master_columns(pivot: MasterPivot) -> List[str]:
+    """
+    "Project", then the key of each DatamapLine. A key which is not unique
+    is followed by its sheet, or its sheet and cell if that is not enough.
+    """
+    keys = Counter([PROJECT_COLUMN] + pivot.keys)
+    sheet_keys = Counter(zip(pivot.keys, (sheet for sheet, _ in pivot.cells)))
+    columns = [PROJECT_COLUMN]
+    for key, (sheet, cell_ref) in zip(pivot.keys, pivot.cells):
+        if keys[key] == 1:
+            columns.append(key)
+        elif sheet_keys[key, sheet] == 1:
+            columns.append(f"{key} ({sheet})")
+        else:
+            columns.append(f"{key} ({sheet}!{cell_ref})")
+    return columns
+
+
+def master_records(pivot: MasterPivot) -> Iterator[List[Any]]:
+    """
+    A row for each Return in pivot: its project, then its value for each
+    key, None where the cell is empty or the Return has no item for it.
+    """
+    for column, project in enumerate(pivot.projects):
+        record = [project]
+        for row in pivot.rows:
+            value = row[column]
+            record.append(None if value == "" else value)
+        yield record
+
+
+class _Echo:
+    # a file-like object for csv.writer which hands back what it is given
+    def write(self, value: str) -> str:
+        return value
+
+
+def iter_master_csv(pivot: MasterPivot) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(master_columns(pivot))
+    for record in master_records(pivot):
+        yield writer.writerow(["" if value is None else value for value in record])
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def iter_master_ndjson(pivot: MasterPivot) -> Iterator[str]:
+    columns = master_columns(pivot)
+    for record in master_records(pivot):
+        yield json.dumps(dict(zip(columns, record)), default=_json_default) + "\n"
+
+
+def _arrow_column(values: List[Any]) -> "pyarrow.Array":
+    try:
+        return pyarrow.array(values)
+    except pyarrow.ArrowException:
+        # different types of value under one key: keep them all, as text
+        return pyarrow.array(
+            [None if value is None else str(value) for value in values],
+            pyarrow.string(),
+        )
+
+
+def master_table(pivot: MasterPivot) -> "pyarrow.Table":
+    """
+    The master as a pyarrow Table, with a typed column for each key.
+    """
+    columns = list(zip(*master_records(pivot)))
+    if not columns:
+        columns = [()] * len(master_columns(pivot))
+    return pyarrow.Table.from_arrays(
+        [_arrow_column(list(values)) for values in columns],
+        names=master_columns(pivot),
+    )
+
+
+def write_master_parquet(pivot: MasterPivot, output: IO[bytes]) -> None:
+    pyarrow.parquet.write_table(master_table(pivot), output)
+
+
+def write_master_arrow(pivot: MasterPivot, output: IO[bytes]) -> None:
+    table = master_table(pivot)
+    with pyarrow.ipc.new_file(output, table.schema) as writer:
+        writer.write_table(table)
+
+
+EXPORT_FORMATS: Dict[str, ExportFormat] = {
+    "csv": ExportFormat("text/csv", stream=iter_master_csv),
+    "ndjson": ExportFormat("application/x-ndjson", stream=iter_master_ndjson),
+    "parquet": ExportFormat(
+        "application/vnd.apache.parquet", write=write_master_parquet
+    ),
+    "arrow": ExportFormat(
+        "application/vnd.apache.arrow.file", write=write_master_arrow
+    ),
+}
+
+_NEEDS_PYARROW = {"parquet", "arrow"}
+
+
+def available_formats() -> List[str]:
+    return [
+        name
+        for name in EXPORT_FORMATS
+        if pyarrow is not None or name not in _NEEDS_PYARROW
+    ]
+
+
+def export_bytes(pivot: MasterPivot, name: str) -> bytes:
+    """
+    The whole of pivot in the format called name, for formats which cannot
+    be streamed.
+    """
+    output = io.BytesIO()
+    EXPORT_FORMATS[name].write(pivot, output)
+    return output.getvalue()
@@ -22,7 +22,8 @@ class ReturnBatchCreateForm(forms.Form):
         queryset=Datamap.objects.all(), help_text="Choose a datamap"
     )
     source_files = forms.FileField(
-        help_text="Please ensure the name of each file matches exactly the title of the project, and only .xlsm files will work.",
+        help_text="Please ensure the name of each file matches exactly the title of the project, and only .xlsm files will work. "
+        "Many templates can be uploaded together as a single .zip archive.",
         widget=forms.ClearableFileInput(attrs={"multiple": True}),
     )
 
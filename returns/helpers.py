@@ -1,71 +1,209 @@
-from typing import List, Tuple, Union
-import datetime
-
-from inspect import getmembers
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Tuple, Union
+import logging
+import os
+import tempfile
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from openpyxl import Workbook
 from openpyxl import utils
 
 from register.models import FinancialQuarter
-from returns.models import ReturnItem
+from returns.models import MasterArtefact, Return, ReturnItem
+from returns.signals import returns_changed
 from datamap.models import Datamap
 
-RETURN_ITEM_PARM_STRS = [
-    "value_str",
-    "value_float",
-    "value_date",
-    "value_datetime",
-    "value_int",
-]
-
-
-def _get_populated_param(
-    return_item: ReturnItem
-) -> Tuple[str, Union[str, int, float, datetime.datetime, datetime.date]]:
-    _ri_params = [
-        param for param in getmembers(return_item) if param[0] in RETURN_ITEM_PARM_STRS
-    ]
-    _non_none_params = [
-        param for param in _ri_params if param[1] is not None and param[1] is not ""
-    ]
-    if len(_non_none_params) > 1:
-        raise ValueError(
-            "You can't have multiple populated params in a ReturnItem object"
+logger = logging.getLogger(__name__)
+
+# seconds the Returns of a quarter must go unchanged before its stale masters
+# are rebuilt
+DEFAULT_MASTER_REBUILD_DELAY = 30
+
+
+class MasterPivot(NamedTuple):
+    """
+    The values of every Return for a FinancialQuarter, by DatamapLine:
+    rows[i][j] is the value for keys[i] in the Return of projects[j], None
+    if that Return has no ReturnItem for the key. cells[i] is the (sheet,
+    cell_ref) keys[i] is read from, as a key need not be unique.
+    """
+
+    keys: List[str]
+    projects: List[str]
+    rows: List[List[Any]]
+    cells: List[Tuple[str, str]]
+
+
+def master_pivot(financial_quarter: FinancialQuarter, datamap: Datamap) -> MasterPivot:
+    """
+    Pivot the ReturnItems of financial_quarter's Returns against datamap,
+    with one query for the Returns, one for the DatamapLines and a single
+    pass over one query for the ReturnItems, whose values are read by
+    value_type ("" for an empty cell). Each value is placed by its
+    DatamapLine, so a Return missing an item leaves a gap rather than
+    shifting the values below it.
+    """
+    returns = list(
+        financial_quarter.return_financial_quarters.order_by("project").values_list(
+            "pk", "project__name"
         )
-    else:
-        try:
-            _non_none_params[0]
-        except IndexError:
-            # all params are None, therefore empty cell
-            # we can just pass it as value_str
-            return ("value_str", "")
-        return _non_none_params[0]
+    )
+    lines = list(
+        datamap.datamaplines.order_by("pk").values_list(
+            "pk", "key", "sheet", "cell_ref"
+        )
+    )
+    column_of: Dict[int, int] = {pk: i for i, (pk, _) in enumerate(returns)}
+    row_of: Dict[int, int] = {line[0]: i for i, line in enumerate(lines)}
+    rows: List[List[Any]] = [[None] * len(returns) for _ in lines]
+    items = ReturnItem.objects.filter(
+        parent__financial_quarter=financial_quarter,
+        parent__staging_key="",
+        datamapline__datamap=datamap,
+    )
+    for parent_id, datamapline_id, value in items.typed_values(
+        "parent_id", "datamapline_id"
+    ):
+        column: Optional[int] = column_of.get(parent_id)
+        if column is not None:
+            rows[row_of[datamapline_id]][column] = value
+    return MasterPivot(
+        [key for _, key, _, _ in lines],
+        [name for _, name in returns],
+        rows,
+        [(sheet, cell_ref) for _, _, sheet, cell_ref in lines],
+    )
 
 
 def generate_master(
-    financial_quarter: FinancialQuarter, output: str, datamap: Datamap
+    financial_quarter: FinancialQuarter, output: Union[str, IO[bytes]], datamap: Datamap
 ) -> None:
-    # we need to get all returns for a FinancialQuarter
-    all_returns = financial_quarter.return_financial_quarters.all().order_by('project')
-    keys: List = [dml.key for dml in datamap.datamaplines.all().order_by('pk')]
-    wb = Workbook()
-    ws = wb.active
-
-    # do the key column
-    for row in range(1, len(keys) + 1):
-        ws.cell(column=1, row=row, value=keys[row - 1])
-
-    column_counter = 2  # start at column 2 after the key column
-    for ret in all_returns:
-        ret_items = ret.return_returnitems.all().order_by("datamapline")
-        for counter_through_items, item in enumerate(ret_items, start=1):
-            param: str = _get_populated_param(item)[0]
-            ws.cell(
-                column=column_counter,
-                row=counter_through_items,
-                value=item.__dict__[param],
-            )
-        column_counter += 1
-    ws.title = "Master Data"
-    dest_filename = output
-    wb.save(filename=dest_filename)
+    """
+    Write the master workbook for financial_quarter to output, a path or a
+    binary file: the key column, then a column per Return ordered by
+    project (see master_pivot). The workbook is write-only, so rows are
+    streamed out as they are added rather than held as openpyxl cells.
+    """
+    pivot = master_pivot(financial_quarter, datamap)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Master Data")
+    for key, row in zip(pivot.keys, pivot.rows):
+        ws.append([key] + row)
+    wb.save(output)
+
+
+def master_filename(financial_quarter: FinancialQuarter) -> str:
+    """
+    The name the master workbook for financial_quarter is downloaded as.
+    """
+    return f"Master_for_Q{financial_quarter.quarter}_{financial_quarter.year}.xlsx"
+
+
+def master_rebuild_delay() -> float:
+    return getattr(settings, "MASTER_REBUILD_DELAY", DEFAULT_MASTER_REBUILD_DELAY)
+
+
+def build_master(financial_quarter: FinancialQuarter, datamap: Datamap) -> str:
+    """
+    Generate the master workbook for financial_quarter against datamap
+    from the current data_version of its MasterArtefact, and return its
+    path. Each version is written to a file of its own, which is recorded
+    on the artefact only if no later version has been built meanwhile; the
+    file it replaces is then removed.
+    """
+    artefact, _ = MasterArtefact.objects.get_or_create(
+        financial_quarter=financial_quarter, datamap=datamap
+    )
+    version = artefact.data_version
+    stem, extension = os.path.splitext(master_filename(financial_quarter))
+    name = f"masters/{datamap.pk}/{stem}_v{version}{extension}"
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a temporary file of its own, so concurrent builds cannot collide
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".partial")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            generate_master(financial_quarter, f, datamap)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    recorded = (
+        MasterArtefact.objects.filter(pk=artefact.pk)
+        .filter(Q(built_version__isnull=True) | Q(built_version__lte=version))
+        .update(built_version=version, built_at=timezone.now(), file_name=name)
+    )
+    if not recorded:
+        # a later version was built while this one was
+        os.remove(path)
+        return MasterArtefact.objects.get(pk=artefact.pk).path
+    if artefact.path and artefact.file_name != name:
+        try:
+            os.remove(artefact.path)
+        except FileNotFoundError:
+            pass
+    logger.info(f"Built {name} in {artefact}")
+    return path
+
+
+def current_master(
+    financial_quarter: FinancialQuarter, datamap: Datamap
+) -> Optional[str]:
+    """
+    The path of the master workbook for financial_quarter against datamap,
+    if one has been built and its Returns have not changed since; else
+    None.
+    """
+    artefact = MasterArtefact.objects.filter(
+        financial_quarter=financial_quarter, datamap=datamap
+    ).first()
+    if artefact is None or artefact.stale:
+        return None
+    return artefact.path
+
+
+def mark_masters_stale(financial_quarter_id: int) -> None:
+    """
+    Record a change to the Returns of a FinancialQuarter against each of
+    its MasterArtefacts, and schedule a rebuild of those which were
+    current. One already stale has a rebuild pending, which waits until
+    the changes stop (see returns.tasks.rebuild_master), so a burst of
+    changes leads to a single rebuild.
+    """
+    artefacts = MasterArtefact.objects.filter(financial_quarter_id=financial_quarter_id)
+    current = list(
+        artefacts.filter(built_version=F("data_version")).values_list("pk", flat=True)
+    )
+    artefacts.update(data_version=F("data_version") + 1, changed_at=timezone.now())
+    for artefact_id in current:
+        transaction.on_commit(lambda pk=artefact_id: schedule_master_rebuild(pk))
+
+
+def schedule_master_rebuild(artefact_id: int, delay: Optional[float] = None) -> None:
+    from returns.tasks import rebuild_master
+
+    if delay is None:
+        delay = master_rebuild_delay()
+    try:
+        rebuild_master.apply_async((artefact_id,), countdown=delay)
+    except Exception:
+        # the master is built when next downloaded instead
+        logger.exception(f"Could not schedule a rebuild of MasterArtefact {artefact_id}")
+
+
+@receiver(post_save, sender=Return)
+@receiver(post_delete, sender=Return)
+def mark_masters_stale_on_return_change(sender, instance, **kwargs):
+    if not instance.staging:
+        mark_masters_stale(instance.financial_quarter_id)
+
+
+# there are no receivers for ReturnItem, which would cost queries for every
+# row written: whatever writes a Return's items sends returns_changed once
+@receiver(returns_changed)
+def mark_masters_stale_on_returns_changed(sender, financial_quarter_id, **kwargs):
+    mark_masters_stale(financial_quarter_id)
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('returns', '0013_auto_20181209_2100'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='return',
+            name='parse_peak_memory',
+            field=models.BigIntegerField(blank=True, help_text='Peak RSS in bytes while parsing the template', null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.1.6 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0008_auto_20181122_1653'),
+        ('datamap', '0008_auto_20181209_2048'),
+        ('returns', '0014_return_parse_peak_memory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('datamap', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingest_batches', to='datamap.Datamap')),
+                ('financial_quarter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingest_batches', to='register.FinancialQuarter')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.CreateModel(
+            name='IngestFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('queued_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('cell_count', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='returns.IngestBatch')),
+                ('return_obj', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ingest_files', to='returns.Return')),
+            ],
+            options={
+                'ordering': ['queued_at', 'pk'],
+            },
+        ),
+    ]
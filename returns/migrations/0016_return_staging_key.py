@@ -0,0 +1,23 @@
+# Generated by Django 2.1.6 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0008_auto_20181122_1653'),
+        ('returns', '0015_ingestbatch_ingestfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='return',
+            name='staging_key',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AlterUniqueTogether(
+            name='return',
+            unique_together={('project', 'financial_quarter', 'staging_key')},
+        ),
+    ]
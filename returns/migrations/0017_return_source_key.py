@@ -0,0 +1,18 @@
+# Generated by Django 2.1.6 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('returns', '0016_return_staging_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='return',
+            name='source_key',
+            field=models.CharField(blank=True, default='', help_text='The hash of the file last ingested and the Datamap version used', max_length=200),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.1.6 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+# in the order ReturnItem.save() checks them
+VALUE_FIELDS = [
+    ("str", "value_str"),
+    ("int", "value_int"),
+    ("float", "value_float"),
+    ("date", "value_date"),
+    ("datetime", "value_datetime"),
+]
+
+
+def set_value_types(apps, schema_editor):
+    ReturnItem = apps.get_model("returns", "ReturnItem")
+    untyped = ReturnItem.objects.filter(value_type="")
+    for value_type, field in VALUE_FIELDS:
+        populated = untyped.filter(**{f"{field}__isnull": False})
+        if field == "value_str":
+            populated = populated.exclude(value_str="")
+        populated.update(value_type=value_type)
+    untyped.update(value_type="empty")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('returns', '0017_return_source_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='returnitem',
+            name='value_type',
+            field=models.CharField(blank=True, choices=[('str', 'Text'), ('int', 'Integer'), ('float', 'Float'), ('date', 'Date'), ('datetime', 'Date and time'), ('empty', 'Empty')], default='', max_length=8),
+        ),
+        migrations.RunPython(set_value_types, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.6 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0008_auto_20181122_1653'),
+        ('datamap', '0008_auto_20181209_2048'),
+        ('returns', '0018_returnitem_value_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MasterArtefact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_version', models.PositiveIntegerField(default=0)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('built_version', models.PositiveIntegerField(blank=True, null=True)),
+                ('built_at', models.DateTimeField(blank=True, null=True)),
+                ('file_name', models.CharField(blank=True, default='', help_text='Relative to MEDIA_ROOT', max_length=255)),
+                ('datamap', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='master_artefacts', to='datamap.Datamap')),
+                ('financial_quarter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='master_artefacts', to='register.FinancialQuarter')),
+            ],
+            options={
+                'unique_together': {('financial_quarter', 'datamap')},
+            },
+        ),
+    ]
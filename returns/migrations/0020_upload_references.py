@@ -0,0 +1,23 @@
+# Generated by Django 2.1.6 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('returns', '0019_masterartefact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestfile',
+            name='stored_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='return',
+            name='upload_name',
+            field=models.CharField(blank=True, default='', help_text='The copy in upload storage of the template last uploaded for it', max_length=255),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('returns', '0020_upload_references'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='return',
+            name='parse_peak_memory',
+            field=models.BigIntegerField(blank=True, help_text='How far RSS rose, in bytes, while parsing the template', null=True),
+        ),
+    ]
@@ -1,13 +1,29 @@
-from typing import Dict, Any
+import datetime
+import os
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
 
 from django.urls import reverse
+from django.utils import timezone
 
-from datamap.models import DatamapLine
+from datamap.models import Datamap, DatamapLine
 from register.models import FinancialQuarter
 from register.models import Project
 
 
+class ReturnManager(models.Manager):
+    """
+    Leaves out staging Returns, which are still being ingested.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(staging_key="")
+
+
 class Return(models.Model):
     project = models.ForeignKey(
         Project, on_delete=models.CASCADE, related_name="return_projects"
@@ -17,9 +33,32 @@ class Return(models.Model):
         on_delete=models.CASCADE,
         related_name="return_financial_quarters",
     )
+    parse_peak_memory = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="How far RSS rose, in bytes, while parsing the template",
+    )
+    source_key = models.CharField(
+        max_length=200,
+        blank=True,
+        default="",
+        help_text="The hash of the file last ingested and the Datamap version used",
+    )
+    upload_name = models.CharField(
+        max_length=255,
+        blank=True,
+        default="",
+        help_text="The copy in upload storage of the template last uploaded for it",
+    )
+    # empty for the live Return; a staging Return being ingested in its place
+    # has a unique key, so there can be several but they never clash with it
+    staging_key = models.CharField(max_length=32, blank=True, default="")
+
+    objects = ReturnManager()
+    all_objects = models.Manager()
 
     class Meta:
-        unique_together = ['project', 'financial_quarter']
+        unique_together = ['project', 'financial_quarter', 'staging_key']
 
     def __str__(self):
         return f"{self.project} - {self.financial_quarter} return"
@@ -27,6 +66,10 @@ class Return(models.Model):
     def get_absolute_url(self):
         return reverse("returns:return_data", args=[self.pk])
 
+    @property
+    def staging(self) -> bool:
+        return bool(self.staging_key)
+
     def data_by_key(self, key) -> Dict[str, Any]:
         """
         Return a dict of data for a single Return.
@@ -38,18 +81,75 @@ class Return(models.Model):
             "value_float": _return_item.value_float,
             "value_date": _return_item.value_date,
             "value_datetime": _return_item.value_datetime,
+            "value_type": _return_item.value_type,
+            "value": _return_item.value,
         }
 
 
 
+class ReturnItemQuerySet(models.QuerySet):
+    def with_value_text(self) -> "ReturnItemQuerySet":
+        """
+        Annotate each ReturnItem with value_text, its value cast to text in
+        the database by a CASE on value_type, "" for an empty cell.
+        """
+        whens = [
+            When(value_type=value_type, then=Cast(field, models.TextField()))
+            for value_type, field in ReturnItem.VALUE_FIELDS.items()
+        ]
+        return self.annotate(
+            value_text=Case(*whens, default=Value(""), output_field=models.TextField())
+        )
+
+    def typed_values(self, *fields: str) -> Iterator[Tuple]:
+        """
+        Yield fields, as values_list would, followed by the value of each
+        ReturnItem, taken from the column its value_type names; "" for an
+        empty cell. The value fields are selected alongside value_type so
+        nothing is looked up per row.
+        """
+        columns = list(ReturnItem.VALUE_FIELDS.values())
+        width = len(fields)
+        position_of = {
+            value_type: width + 1 + columns.index(field)
+            for value_type, field in ReturnItem.VALUE_FIELDS.items()
+        }
+        rows = self.values_list(*fields, "value_type", *columns)
+        for row in rows.iterator():
+            position = position_of.get(row[width])
+            yield row[:width] + (row[position] if position else "",)
+
 
 class ReturnItem(models.Model):
     """
-    A model in which to store parsed template data. The value should
-    be stored as the appropriate type, therefore the form should use
-    a routine to select appropriately.
+    A model in which to store parsed template data. The value is stored
+    in the field suited to its type, which value_type records, so it can
+    be read back as value without checking each field.
     """
 
+    STR = "str"
+    INT = "int"
+    FLOAT = "float"
+    DATE = "date"
+    DATETIME = "datetime"
+    EMPTY = "empty"
+    VALUE_TYPES = (
+        (STR, "Text"),
+        (INT, "Integer"),
+        (FLOAT, "Float"),
+        (DATE, "Date"),
+        (DATETIME, "Date and time"),
+        (EMPTY, "Empty"),
+    )
+    # the field holding the value of each type; an EMPTY item has none
+    VALUE_FIELDS = {
+        STR: "value_str",
+        INT: "value_int",
+        FLOAT: "value_float",
+        DATE: "value_date",
+        DATETIME: "value_datetime",
+    }
+
     parent = models.ForeignKey(Return, on_delete=models.CASCADE, related_name="return_returnitems")
     datamapline = models.ForeignKey(
         DatamapLine,
@@ -64,6 +164,242 @@ class ReturnItem(models.Model):
     )
     value_date = models.DateField(blank=True, null=True)
     value_datetime = models.DateTimeField(blank=True, null=True)
+    value_type = models.CharField(
+        max_length=8, choices=VALUE_TYPES, blank=True, default=""
+    )
+
+    objects = ReturnItemQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.datamapline.key} for {self.parent}"
+
+    @property
+    def value(self) -> Any:
+        field = self.VALUE_FIELDS.get(self.value_type)
+        return getattr(self, field) if field else ""
+
+    def save(self, *args, **kwargs):
+        if not self.value_type:
+            self.value_type = self.EMPTY
+            for value_type, field in self.VALUE_FIELDS.items():
+                if getattr(self, field) not in (None, ""):
+                    self.value_type = value_type
+                    break
+        super().save(*args, **kwargs)
+
+
+# seconds after which a batch that has not finished is taken to be abandoned
+DEFAULT_INGEST_BATCH_TIMEOUT = 60 * 60
+
+
+class IngestBatchQuerySet(models.QuerySet):
+    def active(self) -> "IngestBatchQuerySet":
+        """
+        Batches still being ingested: not finished, and created within
+        INGEST_BATCH_TIMEOUT seconds, as one whose finaliser never ran (its
+        worker was killed, say) is never marked finished.
+        """
+        timeout = getattr(
+            settings, "INGEST_BATCH_TIMEOUT", DEFAULT_INGEST_BATCH_TIMEOUT
+        )
+        return self.filter(
+            finished__isnull=True,
+            created__gte=timezone.now() - datetime.timedelta(seconds=timeout),
+        )
+
+
+class IngestBatch(models.Model):
+    """
+    A batch of populated templates uploaded together for a
+    FinancialQuarter, with an IngestFile for each template.
+    """
+
+    financial_quarter = models.ForeignKey(
+        FinancialQuarter, on_delete=models.CASCADE, related_name="ingest_batches"
+    )
+    datamap = models.ForeignKey(
+        Datamap, on_delete=models.CASCADE, related_name="ingest_batches"
+    )
+    created = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = IngestBatchQuerySet.as_manager()
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"Batch {self.pk} for {self.financial_quarter}"
+
+    def progress(self) -> Dict[str, Any]:
+        """
+        The state of the batch and each of its files, for the polling
+        endpoint. Durations are in seconds.
+        """
+        files = list(self.files.all())
+        counts = {status: 0 for status, _ in IngestFile.STATUSES}
+        for f in files:
+            counts[f.status] += 1
+        waits = [f.queue_wait for f in files if f.queue_wait is not None]
+        times = [f.processing_time for f in files if f.processing_time is not None]
+        cells = sum(f.cell_count or 0 for f in files)
+        started = [f.started_at for f in files if f.started_at]
+        ended = [f.finished_at for f in files if f.finished_at]
+        elapsed = (max(ended) - min(started)).total_seconds() if ended else None
+        return {
+            "id": self.pk,
+            "financial_quarter": str(self.financial_quarter),
+            "datamap": str(self.datamap),
+            "created": self.created.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+            "total": len(files),
+            "counts": counts,
+            "cell_count": cells,
+            "mean_queue_wait": sum(waits) / len(waits) if waits else None,
+            "mean_processing_time": sum(times) / len(times) if times else None,
+            "files_per_second": len(ended) / elapsed if elapsed else None,
+            "cells_per_second": cells / elapsed if elapsed else None,
+            "files": [f.to_dict() for f in files],
+        }
+
+
+class IngestFile(models.Model):
+    """
+    One template in an IngestBatch: when it was queued, started and
+    finished, by which worker, and how it went.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    batch = models.ForeignKey(
+        IngestBatch, on_delete=models.CASCADE, related_name="files"
+    )
+    name = models.CharField(max_length=255)
+    return_obj = models.ForeignKey(
+        Return,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="ingest_files",
+    )
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    queued_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    cell_count = models.IntegerField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    worker = models.CharField(max_length=255, blank=True, default="")
+    # set on the first IngestFile for each upload, which holds the reference to
+    # it in upload storage until the batch is finalised
+    stored_name = models.CharField(max_length=255, blank=True, default="")
+
+    class Meta:
+        ordering = ["queued_at", "pk"]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.queued_at).total_seconds()
+
+    @property
+    def processing_time(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    def start(self, worker: str) -> None:
+        self.status = self.RUNNING
+        self.started_at = timezone.now()
+        self.worker = worker
+        self.save(update_fields=["status", "started_at", "worker"])
+
+    def attach(self, return_obj: Optional[Return]) -> None:
+        """
+        Show this file's progress against return_obj, the Return it is
+        being ingested for, in the list of returns.
+        """
+        if return_obj is None:
+            return
+        self.return_obj = return_obj
+        self.save(update_fields=["return_obj"])
+
+    def finish(self, return_obj: Return, cell_count: int) -> None:
+        self.status = self.DONE
+        self.finished_at = timezone.now()
+        self.return_obj = return_obj
+        self.cell_count = cell_count
+        self.save(update_fields=["status", "finished_at", "return_obj", "cell_count"])
+
+    def fail(self, error: str) -> None:
+        self.status = self.FAILED
+        self.finished_at = timezone.now()
+        self.error = error
+        self.save(update_fields=["status", "finished_at", "error"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.pk,
+            "name": self.name,
+            "status": self.status,
+            "return_id": self.return_obj_id,
+            "queued_at": self.queued_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "queue_wait": self.queue_wait,
+            "processing_time": self.processing_time,
+            "cell_count": self.cell_count,
+            "error": self.error,
+            "worker": self.worker,
+        }
+
+
+class MasterArtefact(models.Model):
+    """
+    The master workbook for a FinancialQuarter against a Datamap, built
+    once and served from MEDIA_ROOT. data_version counts the changes made
+    to the quarter's Returns; the file is current while built_version,
+    the data_version it was built from, matches it.
+    """
+
+    financial_quarter = models.ForeignKey(
+        FinancialQuarter, on_delete=models.CASCADE, related_name="master_artefacts"
+    )
+    datamap = models.ForeignKey(
+        Datamap, on_delete=models.CASCADE, related_name="master_artefacts"
+    )
+    data_version = models.PositiveIntegerField(default=0)
+    changed_at = models.DateTimeField(default=timezone.now)
+    built_version = models.PositiveIntegerField(null=True, blank=True)
+    built_at = models.DateTimeField(null=True, blank=True)
+    file_name = models.CharField(
+        max_length=255, blank=True, default="", help_text="Relative to MEDIA_ROOT"
+    )
+
+    class Meta:
+        unique_together = ["financial_quarter", "datamap"]
+
+    def __str__(self):
+        return f"Master for {self.financial_quarter} ({self.datamap})"
+
+    @property
+    def stale(self) -> bool:
+        return self.built_version != self.data_version
+
+    @property
+    def path(self) -> Optional[str]:
+        if not self.file_name:
+            return None
+        return os.path.join(settings.MEDIA_ROOT, self.file_name)
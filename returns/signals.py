@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# sent once when the ReturnItems of a live Return are written, or a staging
+# Return is promoted; there are no model signals for ReturnItems, which would
+# be sent for every row
+returns_changed = Signal(providing_args=["financial_quarter_id"])
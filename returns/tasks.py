@@ -1,40 +1,183 @@
+import logging
+import socket
 import string
 import os
 
 from celery import shared_task
 from django.conf import settings
+from django.utils import timezone
 from django.http import HttpResponseRedirect
 from django.utils.crypto import get_random_string
 from django.core.files.storage import default_storage
 
+from core.storage import upload_storage
 from register.models import FinancialQuarter, ProjectStage, Project
-from returns.models import Return
+from returns.models import IngestBatch, IngestFile, MasterArtefact, Return
+from excelparser.helpers.extraction_plan import get_extraction_plan
+from excelparser.helpers.instrumentation import (
+    CACHE_HITS,
+    CELLS_READ,
+    Instrumentation,
+    emit_batch,
+)
+from excelparser.helpers.ingest import (
+    UPSERT,
+    extract_for_ingest,
+    ingesting,
+    resolve_reingest_mode,
+    source_key,
+    unchanged_return,
+)
+from excelparser.helpers.parse_cache import hash_file
 from excelparser.helpers.parser import ParsedSpreadsheet
+from excelparser.helpers.uploads import extracted_member
+from excelparser.helpers.validation import validate_extracted
+from returns.helpers import (
+    build_master,
+    master_rebuild_delay,
+    schedule_master_rebuild,
+)
 from datamap.models import Datamap
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def process_batch(fq_id, dm_id, save_path, project_name):
+
+def _worker_name(request) -> str:
+    return f"{request.hostname or socket.gethostname()}:{os.getpid()}"
+
+
+@shared_task(bind=True)
+def process_batch(
+    self, fq_id, dm_id, save_path, project_name, ingest_file_id=None, member=None
+):
+    """
+    Parse one file of a batch: the file at save_path or, if member is
+    given, that member of the .zip archive at save_path. Run as part of a
+    chord, so a file which fails is logged and reported to finalise_batch
+    rather than raised, which would stop the finaliser running for the
+    rest of the batch. Progress is recorded on the IngestFile with
+    ingest_file_id, if given.
+    """
+    file_name = os.path.basename(member or save_path)
+    ingest_file = None
+    try:
+        if ingest_file_id is not None:
+            ingest_file = IngestFile.objects.get(pk=ingest_file_id)
+            ingest_file.start(_worker_name(self.request))
+        if member is None:
+            return_obj, timings = _process_file(
+                fq_id, dm_id, save_path, project_name, ingest_file
+            )
+        else:
+            with extracted_member(save_path, member) as path:
+                return_obj, timings = _process_file(
+                    fq_id, dm_id, path, project_name, ingest_file
+                )
+    except Exception as e:
+        logger.exception(f"Could not process {file_name}")
+        error = f"{type(e).__name__}: {e}"
+        if ingest_file is not None:
+            ingest_file.fail(error)
+        return {"file": file_name, "error": error}
+    if ingest_file is not None:
+        ingest_file.finish(return_obj, timings["counters"].get(CELLS_READ, 0))
+    return timings
+
+
+def _process_file(fq_id, dm_id, save_path, project_name, ingest_file=None):
     fq = FinancialQuarter.objects.get(pk=fq_id)
     datamap = Datamap.objects.get(pk=dm_id)
     project = Project.objects.get(name=project_name)
-    # make idempotent
-    # does this Return exist already?
-    if Return.objects.filter(financial_quarter=fq, project=project).exists():
-        r = Return.objects.get(financial_quarter=fq, project=project)
-        r.delete()
-        return_obj = Return.objects.create(
-            project=project,
-            financial_quarter=fq
+    if ingest_file is not None:
+        # the live Return, if there is one yet, so a failure shows against it
+        ingest_file.attach(
+            Return.objects.filter(project=project, financial_quarter=fq).first()
         )
-    else:
-        return_obj = Return.objects.create(
-            project=project,
-            financial_quarter=fq
+    mode = resolve_reingest_mode()
+    plan = get_extraction_plan(datamap)
+    sha256 = hash_file(save_path)
+    key = source_key(sha256, plan)
+    unchanged = unchanged_return(project, fq, key)
+    if unchanged is not None:
+        logger.info(f"{save_path} is unchanged since it was last ingested")
+        timer = Instrumentation(os.path.basename(save_path))
+        timer.count(CACHE_HITS)
+        return unchanged, timer.emit()
+    # a byte-identical upload for another Return is served from the parse cache
+    extracted = extract_for_ingest(save_path, plan, sha256=sha256)
+    report = validate_extracted(extracted, plan, save_path)
+    for issue in report.issues:
+        logger.warning(f"{report.filename}: {issue.message}")
+    # make idempotent: readers keep seeing the old Return until the new one
+    # is complete
+    with ingesting(project, fq, mode) as return_obj:
+        if ingest_file is not None and not return_obj.staging:
+            ingest_file.attach(return_obj)
+        parsed_spreadsheet = ParsedSpreadsheet(
+            save_path,
+            project,
+            return_obj,
+            datamap,
+            extracted=extracted,
+            upsert=mode == UPSERT,
+            source_key=key,
         )
-    try:
-        parsed_spreadsheet = ParsedSpreadsheet(save_path, project, return_obj, datamap)
-    except ImportError:
-        raise
-    parsed_spreadsheet.process()
+        parsed_spreadsheet.process()
     print(f"{save_path} processed successfully")
+    return parsed_spreadsheet.return_obj, parsed_spreadsheet.timings
+
+
+@shared_task
+def finalise_batch(results, fq_id, dm_id, batch_id=None):
+    """
+    The body of a batch's chord, run once every process_batch task in it
+    has finished: rebuilds the quarter's master workbook, logs the
+    batch's timings and marks the IngestBatch with batch_id, if given,
+    finished, releasing its uploads from storage. results are the return
+    values of process_batch.
+    """
+    fq = FinancialQuarter.objects.get(pk=fq_id)
+    datamap = Datamap.objects.get(pk=dm_id)
+    records = [r for r in results if r and "error" not in r]
+    failed = [r["file"] for r in results if r and "error" in r]
+    master = build_master(fq, datamap)
+    logger.info(f"Rebuilt {master} after a batch of {len(results)} files")
+    if batch_id is not None:
+        IngestBatch.objects.filter(pk=batch_id).update(finished=timezone.now())
+        # every file has been parsed, so the uploads are no longer needed
+        stored_names = (
+            IngestFile.objects.filter(batch_id=batch_id)
+            .exclude(stored_name="")
+            .values_list("stored_name", flat=True)
+        )
+        for name in stored_names:
+            upload_storage.delete(name)
+    return emit_batch(records, failed=len(failed), failed_files=failed)
+
+
+@shared_task
+def rebuild_master(artefact_id):
+    """
+    Rebuild a stale MasterArtefact once the Returns of its quarter have
+    gone unchanged for MASTER_REBUILD_DELAY seconds, putting itself off
+    again until they have. Scheduled by returns.helpers.mark_masters_stale.
+    """
+    artefact = (
+        MasterArtefact.objects.select_related("financial_quarter", "datamap")
+        .filter(pk=artefact_id)
+        .first()
+    )
+    if artefact is None or not artefact.stale:
+        return None
+    delay = master_rebuild_delay()
+    quiet = (timezone.now() - artefact.changed_at).total_seconds()
+    if quiet < delay:
+        schedule_master_rebuild(artefact_id, delay - quiet)
+        return None
+    master = build_master(artefact.financial_quarter, artefact.datamap)
+    logger.info(f"Rebuilt stale {master}")
+    artefact.refresh_from_db()
+    if artefact.stale:
+        # changed while it was being built
+        schedule_master_rebuild(artefact_id)
+    return master
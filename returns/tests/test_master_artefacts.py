@@ -0,0 +1,108 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from datamap.models import DatamapLine
+from factories.datamap_factories import DatamapFactory, ProjectFactory
+from register.models import FinancialQuarter
+from returns.helpers import build_master, generate_master
+from returns.models import MasterArtefact, Return, ReturnItem
+from returns.signals import returns_changed
+from returns.tasks import rebuild_master
+
+
+class TestMasterArtefacts(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        overrides = override_settings(
+            MEDIA_ROOT=self.media_root, MASTER_REBUILD_DELAY=30
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.fq = FinancialQuarter.objects.create(quarter=1, year=2010)
+        self.datamap = DatamapFactory()
+        self.dml = DatamapLine.objects.create(
+            datamap=self.datamap, key="Project Name", sheet="Sheet", cell_ref="A1"
+        )
+        self.return_obj = Return.objects.create(
+            project=ProjectFactory(name="Test Project 1"), financial_quarter=self.fq
+        )
+        ReturnItem.objects.create(
+            parent=self.return_obj, datamapline=self.dml, value_str="Project 1"
+        )
+        # run the callbacks as if the test's transaction had committed
+        on_commit = mock.patch.object(transaction, "on_commit", lambda f: f())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def test_download_is_served_from_the_built_artefact(self):
+        user = get_user_model().objects.create_user(username="u", password="p")
+        self.client.force_login(user)
+        url = reverse("returns:download_master", args=[self.fq.pk])
+        with mock.patch(
+            "returns.helpers.generate_master", wraps=generate_master
+        ) as generate:
+            for _ in range(2):
+                response = self.client.get(url)
+                b"".join(response.streaming_content)
+        self.assertEqual(generate.call_count, 1)
+        self.assertIn(
+            'filename="Master_for_Q1_2010.xlsx"', response["Content-Disposition"]
+        )
+        artefact = MasterArtefact.objects.get(financial_quarter=self.fq)
+        self.assertFalse(artefact.stale)
+        self.assertTrue(os.path.exists(artefact.path))
+
+    def test_changes_mark_artefact_stale_and_schedule_one_rebuild(self):
+        old_path = build_master(self.fq, self.datamap)
+        with mock.patch("returns.tasks.rebuild_master.apply_async") as apply_async:
+            # items alone are not tracked, but their writer sends returns_changed
+            with self.assertNumQueries(1):
+                ReturnItem.objects.create(
+                    parent=self.return_obj, datamapline=self.dml, value_int=1
+                )
+            returns_changed.send(sender=Return, financial_quarter_id=self.fq.pk)
+            Return.objects.create(
+                project=ProjectFactory(name="Test Project 2"), financial_quarter=self.fq
+            )
+        artefact = MasterArtefact.objects.get(financial_quarter=self.fq)
+        self.assertTrue(artefact.stale)
+        self.assertEqual(artefact.data_version, 2)
+        apply_async.assert_called_once_with((artefact.pk,), countdown=30)
+
+        # the debounced task waits for the changes to stop
+        with mock.patch("returns.tasks.rebuild_master.apply_async") as apply_async:
+            self.assertIsNone(rebuild_master(artefact.pk))
+        self.assertTrue(apply_async.called)
+        self.assertLessEqual(apply_async.call_args[1]["countdown"], 30)
+
+        MasterArtefact.objects.filter(pk=artefact.pk).update(
+            changed_at=timezone.now() - datetime.timedelta(minutes=1)
+        )
+        path = rebuild_master(artefact.pk)
+        artefact.refresh_from_db()
+        self.assertFalse(artefact.stale)
+        self.assertEqual(path, artefact.path)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertIsNone(rebuild_master(artefact.pk))
+
+    def test_staging_returns_do_not_mark_artefact_stale(self):
+        build_master(self.fq, self.datamap)
+        with mock.patch("returns.tasks.rebuild_master.apply_async") as apply_async:
+            Return.all_objects.create(
+                project=self.return_obj.project,
+                financial_quarter=self.fq,
+                staging_key="staged",
+            )
+        self.assertFalse(MasterArtefact.objects.get(financial_quarter=self.fq).stale)
+        apply_async.assert_not_called()
@@ -1,13 +1,22 @@
+import csv
 import datetime
+import io
+import json
 import os
+import shutil
+import tempfile
+import unittest
 
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
 
 from datamap.models import DatamapLine
 from factories.datamap_factories import DatamapFactory, ProjectFactory
 from register.models import FinancialQuarter
 from returns.models import Return, ReturnItem
-from returns.helpers import generate_master
+from returns.exports import pyarrow
+from returns.helpers import generate_master, master_pivot
 
 from openpyxl import load_workbook
 from openpyxl import utils
@@ -113,3 +122,172 @@ class TestMasterExport(TestCase):
         self.assertEqual(ws["B3"].value, datetime.datetime(2010, 10, 10, 0, 0))
         self.assertEqual(ws["C3"].value, datetime.datetime(2011, 7, 12, 0, 0))
         os.remove(self.output_file)
+
+    def test_master_to_file_object(self):
+        output = io.BytesIO()
+        generate_master(self.fq, output, self.datamap)
+        output.seek(0)
+        ws = load_workbook(output, read_only=True)["Master Data"]
+        self.assertEqual(
+            [[cell.value for cell in row] for row in ws.iter_rows()][0],
+            [
+                "Test dml key1_str",
+                "Test dml return_ob1 str value1",
+                "Test dml return_ob2 str value1",
+            ],
+        )
+
+    def test_download_master_is_streamed(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        user = get_user_model().objects.create_user(username="u", password="p")
+        self.client.force_login(user)
+        with override_settings(MEDIA_ROOT=media_root):
+            response = self.client.get(
+                reverse("returns:download_master", args=[self.fq.pk])
+            )
+            content = b"".join(response.streaming_content)
+        self.assertTrue(response.streaming)
+        self.assertIn(
+            'filename="Master_for_Q1_2010.xlsx"', response["Content-Disposition"]
+        )
+        ws = load_workbook(io.BytesIO(content))["Master Data"]
+        self.assertEqual(ws["C2"].value, "Test dml return_ob2 str value2")
+
+    def test_master_pivot(self):
+        # a sparse return: its other values must stay against their keys
+        self.ri5.delete()
+        with self.assertNumQueries(3):
+            pivot = master_pivot(self.fq, self.datamap)
+        self.assertEqual(
+            pivot.keys, ["Test dml key1_str", "Test dml key2_str", "Test dml key3_date"]
+        )
+        self.assertEqual(pivot.projects, ["Test Project 1", "Test Project 2"])
+        self.assertEqual(
+            pivot.rows,
+            [
+                ["Test dml return_ob1 str value1", "Test dml return_ob2 str value1"],
+                ["Test dml return_ob1 str value2", None],
+                [datetime.date(2010, 10, 10), datetime.date(2011, 7, 12)],
+            ],
+        )
+
+    def test_value_type(self):
+        self.assertEqual(self.ri1.value_type, ReturnItem.STR)
+        self.assertEqual(self.ri3.value_type, ReturnItem.DATE)
+        self.assertEqual(self.ri3.value, datetime.date(2010, 10, 10))
+        empty = ReturnItem.objects.create(parent=self.return_obj1, value_str=None)
+        self.assertEqual(empty.value_type, ReturnItem.EMPTY)
+        self.assertEqual(empty.value, "")
+        items = ReturnItem.objects.filter(parent=self.return_obj1).order_by("pk")
+        self.assertEqual(
+            list(items.with_value_text().values_list("value_text", flat=True)),
+            [
+                "Test dml return_ob1 str value1",
+                "Test dml return_ob1 str value2",
+                "2010-10-10",
+                "",
+            ],
+        )
+        self.assertEqual(
+            list(items.typed_values("datamapline_id"))[2:],
+            [(self.dml3.pk, datetime.date(2010, 10, 10)), (None, "")],
+        )
+
+    def _export(self, fmt):
+        user, _ = get_user_model().objects.get_or_create(username="u")
+        self.client.force_login(user)
+        return self.client.get(reverse("returns:export_master", args=[self.fq.pk, fmt]))
+
+    def test_export_csv(self):
+        self.ri5.delete()
+        response = self._export("csv")
+        self.assertTrue(response.streaming)
+        self.assertIn(
+            'filename="Master_for_Q1_2010.csv"', response["Content-Disposition"]
+        )
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(
+            list(csv.reader(io.StringIO(content))),
+            [
+                [
+                    "Project",
+                    "Test dml key1_str",
+                    "Test dml key2_str",
+                    "Test dml key3_date",
+                ],
+                [
+                    "Test Project 1",
+                    "Test dml return_ob1 str value1",
+                    "Test dml return_ob1 str value2",
+                    "2010-10-10",
+                ],
+                [
+                    "Test Project 2",
+                    "Test dml return_ob2 str value1",
+                    "",
+                    "2011-07-12",
+                ],
+            ],
+        )
+
+    def test_export_ndjson(self):
+        self.ri5.delete()
+        response = self._export("ndjson")
+        content = b"".join(response.streaming_content).decode()
+        records = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(
+            records[1],
+            {
+                "Project": "Test Project 2",
+                "Test dml key1_str": "Test dml return_ob2 str value1",
+                "Test dml key2_str": None,
+                "Test dml key3_date": "2011-07-12",
+            },
+        )
+        self.assertEqual(self._export("xml").status_code, 404)
+
+    def test_export_names_duplicate_keys_apart(self):
+        for sheet, cell_ref in [("Test Sheet 2", "A1"), ("Test Sheet 2", "B1")]:
+            dml = DatamapLine.objects.create(
+                datamap=self.datamap,
+                key="Test dml key1_str",
+                sheet=sheet,
+                cell_ref=cell_ref,
+            )
+            ReturnItem.objects.create(
+                parent=self.return_obj1, datamapline=dml, value_str=cell_ref
+            )
+        columns = [
+            "Project",
+            "Test dml key1_str (Test Sheet 1)",
+            "Test dml key2_str",
+            "Test dml key3_date",
+            "Test dml key1_str (Test Sheet 2!A1)",
+            "Test dml key1_str (Test Sheet 2!B1)",
+        ]
+        content = b"".join(self._export("csv").streaming_content).decode()
+        self.assertEqual(next(csv.reader(io.StringIO(content))), columns)
+        content = b"".join(self._export("ndjson").streaming_content).decode()
+        record = json.loads(content.splitlines()[0])
+        self.assertEqual(list(record), columns)
+        self.assertEqual(record["Test dml key1_str (Test Sheet 2!B1)"], "B1")
+        if pyarrow is not None:
+            parquet = self._export("parquet")
+            table = pyarrow.parquet.read_table(io.BytesIO(parquet.content))
+            self.assertEqual(table.column_names, columns)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_parquet_and_arrow(self):
+        parquet = self._export("parquet")
+        table = pyarrow.parquet.read_table(io.BytesIO(parquet.content))
+        self.assertEqual(table.column_names[0], "Project")
+        self.assertEqual(
+            table.column("Test dml key3_date").to_pylist(),
+            [datetime.date(2010, 10, 10), datetime.date(2011, 7, 12)],
+        )
+        arrow = self._export("arrow")
+        self.assertTrue(
+            pyarrow.ipc.open_file(io.BytesIO(arrow.content)).read_all().equals(table)
+        )
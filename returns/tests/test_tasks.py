@@ -0,0 +1,195 @@
+import datetime
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from core.models import StoredBlob
+from core.storage import collect_garbage, upload_storage
+from datamap.models import DatamapLine
+from factories.datamap_factories import DatamapFactory, ProjectFactory
+from register.models import FinancialQuarter
+from returns.models import IngestBatch, IngestFile, MasterArtefact, Return
+from returns.tasks import finalise_batch, process_batch
+
+POPULATED = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    "excelparser",
+    "tests",
+    "populated.xlsm",
+)
+
+
+class TestBatchChord(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        overrides = override_settings(MEDIA_ROOT=self.media_root, PARSE_CACHE_DIR=None)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.fq = FinancialQuarter.objects.create(quarter=4, year=2018)
+        self.project = ProjectFactory(name="populated")
+        self.datamap = DatamapFactory()
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Project Name", sheet="Test Sheet 1", cell_ref="B1"
+        )
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="Total Cost", sheet="Test Sheet 1", cell_ref="B2"
+        )
+
+    def test_failed_file_is_reported_not_raised(self):
+        result = process_batch(self.fq.id, self.datamap.id, "missing.xlsm", "populated")
+        self.assertEqual(result["file"], "missing.xlsm")
+        self.assertIn("error", result)
+
+    def test_missing_ingest_file_is_reported_not_raised(self):
+        result = process_batch(
+            self.fq.id, self.datamap.id, POPULATED, "populated", ingest_file_id=0
+        )
+        self.assertEqual(result["file"], "populated.xlsm")
+        self.assertIn("DoesNotExist", result["error"])
+
+    def test_finaliser_builds_master_once_for_batch(self):
+        results = [
+            process_batch(self.fq.id, self.datamap.id, POPULATED, "populated"),
+            process_batch(self.fq.id, self.datamap.id, "missing.xlsm", "populated"),
+        ]
+        summary = finalise_batch(results, self.fq.id, self.datamap.id)
+        self.assertEqual(summary["files"], 1)
+        self.assertEqual(summary["failed_files"], ["missing.xlsm"])
+        self.assertEqual(Return.objects.filter(financial_quarter=self.fq).count(), 1)
+        artefact = MasterArtefact.objects.get(financial_quarter=self.fq)
+        self.assertFalse(artefact.stale)
+        ws = load_workbook(artefact.path)["Master Data"]
+        self.assertEqual(ws["A1"].value, "Project Name")
+        self.assertEqual(ws["B1"].value, "Testable Project")
+
+    def test_ingest_progress_recorded(self):
+        batch = IngestBatch.objects.create(
+            financial_quarter=self.fq, datamap=self.datamap
+        )
+        good = IngestFile.objects.create(batch=batch, name="populated.xlsm")
+        bad = IngestFile.objects.create(batch=batch, name="missing.xlsm")
+        results = [
+            process_batch(self.fq.id, self.datamap.id, POPULATED, "populated", good.id),
+            process_batch(
+                self.fq.id, self.datamap.id, "missing.xlsm", "populated", bad.id
+            ),
+        ]
+        finalise_batch(results, self.fq.id, self.datamap.id, batch.id)
+        good.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual(good.status, IngestFile.DONE)
+        self.assertEqual(good.cell_count, 2)
+        self.assertEqual(good.return_obj.project, self.project)
+        self.assertTrue(good.worker)
+        self.assertGreaterEqual(good.queue_wait, 0)
+        self.assertGreaterEqual(good.processing_time, 0)
+        self.assertEqual(bad.status, IngestFile.FAILED)
+        self.assertIn("missing.xlsm", bad.error)
+
+        user = get_user_model().objects.create_user(username="u", password="p")
+        self.client.force_login(user)
+        response = self.client.get(
+            reverse("returns:ingest_batch_progress", args=[batch.pk])
+        )
+        progress = response.json()
+        self.assertIsNotNone(progress["finished"])
+        self.assertEqual(progress["total"], 2)
+        self.assertEqual(progress["counts"]["done"], 1)
+        self.assertEqual(progress["counts"]["failed"], 1)
+        self.assertEqual(progress["cell_count"], 2)
+        self.assertEqual(
+            [f["name"] for f in progress["files"]], ["populated.xlsm", "missing.xlsm"]
+        )
+        response = self.client.get(reverse("returns:returns_list"))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "ingest-batch")
+
+    def test_failed_ingest_is_shown_against_its_return(self):
+        Return.objects.create(project=self.project, financial_quarter=self.fq)
+        batch = IngestBatch.objects.create(
+            financial_quarter=self.fq, datamap=self.datamap
+        )
+        bad = IngestFile.objects.create(batch=batch, name="missing.xlsm")
+        process_batch(self.fq.id, self.datamap.id, "missing.xlsm", "populated", bad.id)
+        bad.refresh_from_db()
+        self.assertEqual(bad.status, IngestFile.FAILED)
+        self.assertEqual(bad.return_obj.project, self.project)
+
+        user = get_user_model().objects.create_user(username="u", password="p")
+        self.client.force_login(user)
+        response = self.client.get(reverse("returns:returns_list"))
+        self.assertContains(response, "Failed")
+        self.assertContains(response, "missing.xlsm")
+
+    def test_abandoned_batch_is_not_active(self):
+        batch = IngestBatch.objects.create(
+            financial_quarter=self.fq, datamap=self.datamap
+        )
+        self.assertEqual(list(IngestBatch.objects.active()), [batch])
+        IngestBatch.objects.filter(pk=batch.pk).update(
+            created=timezone.now() - datetime.timedelta(days=1)
+        )
+        self.assertEqual(list(IngestBatch.objects.active()), [])
+
+    def test_zip_upload_queues_a_task_per_member(self):
+        buffer = os.path.join(self.media_root, "batch.zip")
+        with zipfile.ZipFile(buffer, "w") as zf:
+            zf.write(POPULATED, "returns/populated.xlsm")
+        with open(buffer, "rb") as f:
+            upload = SimpleUploadedFile("batch.zip", f.read())
+        user = get_user_model().objects.create_user(username="u", password="p")
+        self.client.force_login(user)
+        with mock.patch("returns.views.chord") as chord:
+            self.client.post(
+                reverse("returns:return_batch_create"),
+                {
+                    "financial_quarter": self.fq.id,
+                    "datamap": self.datamap.id,
+                    "source_files": [upload],
+                },
+            )
+        (parse_task,), = chord.call_args[0]
+        fq_id, dm_id, save_path, project_name, ingest_file_id, member = (
+            parse_task.args
+        )
+        self.assertEqual(project_name, "populated")
+        self.assertEqual(member, "returns/populated.xlsm")
+        self.assertEqual(IngestFile.objects.get(pk=ingest_file_id).name, "populated.xlsm")
+        timings = process_batch(*parse_task.args)
+        self.assertEqual(timings["file"], "populated.xlsm")
+        self.assertEqual(
+            Return.objects.get(project=self.project).return_returnitems.count(), 2
+        )
+        # the upload is released once the batch is finalised
+        blob = StoredBlob.objects.get()
+        self.assertEqual(blob.refcount, 1)
+        batch = IngestFile.objects.get(pk=ingest_file_id).batch
+        finalise_batch([timings], self.fq.id, self.datamap.id, batch.id)
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 0)
+        self.assertEqual(collect_garbage(upload_storage, grace=0), 1)
+        self.assertFalse(os.path.exists(save_path))
+
+    def test_unchanged_file_is_not_ingested_again(self):
+        process_batch(self.fq.id, self.datamap.id, POPULATED, "populated")
+        return_obj = Return.objects.get(project=self.project)
+        self.assertTrue(return_obj.source_key)
+        with mock.patch("returns.tasks.extract_for_ingest") as extract:
+            timings = process_batch(self.fq.id, self.datamap.id, POPULATED, "populated")
+        extract.assert_not_called()
+        self.assertEqual(timings["counters"], {"cache_hits": 1})
+        DatamapLine.objects.create(
+            datamap=self.datamap, key="SRO", sheet="Test Sheet 1", cell_ref="B3"
+        )
+        timings = process_batch(self.fq.id, self.datamap.id, POPULATED, "populated")
+        self.assertEqual(timings["counters"]["rows_written"], 1)
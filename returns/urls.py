@@ -8,7 +8,7 @@ from returns.views import ReturnBatchCreate
 from returns.views import ReturnDetail
 from returns.views import DeleteReturn
 from returns.views import ReturnLines
-from . views import ReturnsList, download_master
+from . views import ReturnsList, download_master, export_master, ingest_batch_progress
 
 app_name = "returns"
 
@@ -21,5 +21,7 @@ urlpatterns = [
     path("batch-create/", ReturnBatchCreate.as_view(), name="return_batch_create"),
     path("financial-quarters/", FinancialQuartersList.as_view(), name="financial_quarters"),
     path("download-master/<int:fqid>", download_master, name="download_master"),
+    path("export-master/<int:fqid>/<str:fmt>/", export_master, name="export_master"),
+    path("ingest-batch/<int:pk>/progress/", ingest_batch_progress, name="ingest_batch_progress"),
     path("<int:pk>/", ReturnDetail.as_view(), name="returns_detail"),
 ]
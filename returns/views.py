@@ -1,25 +1,43 @@
 import os
 import logging
+import zipfile
 
-from typing import List
+from typing import List, Optional, Tuple
 
+from celery import chord
 from django.conf import settings
 from django.http import HttpResponseRedirect
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.files.storage import default_storage
-from django.http import HttpResponse
+from django.core.files.uploadedfile import UploadedFile
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.urls import reverse_lazy
 from django.views.generic import CreateView, DetailView, FormView, ListView, DeleteView
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
 from django.contrib import messages
 
+from core.storage import upload_storage
+from datamap.models import Datamap
 from excelparser.helpers.parser import ParsedSpreadsheet
+from excelparser.helpers.uploads import archive_members, archive_path, is_zip_upload
 from register.models import FinancialQuarter, Project
 from returns.forms import ReturnBatchCreateForm, ReturnCreateForm
-from returns.helpers import generate_master
-from returns.models import Return, ReturnItem
+from returns.exports import EXPORT_FORMATS, available_formats, export_bytes
+from returns.helpers import (
+    build_master,
+    current_master,
+    master_filename,
+    master_pivot,
+)
+from returns.models import IngestBatch, IngestFile, Return, ReturnItem
 
-from returns.tasks import process_batch as process
+from returns.tasks import finalise_batch, process_batch as process
 
 
 logger = logging.getLogger(__name__)
@@ -54,12 +72,33 @@ class ReturnBatchCreate(LoginRequiredMixin, FormView):
         context["projects"] = projects
         return context
 
+    @staticmethod
+    def _templates(files) -> List[Tuple[UploadedFile, Optional[str]]]:
+        """
+        Each template uploaded, as the uploaded file and, for a template in
+        a .zip archive, the name of its member.
+        """
+        templates: List[Tuple[UploadedFile, Optional[str]]] = []
+        for f in files:
+            if is_zip_upload(f):
+                templates.extend((f, member) for member in archive_members(f))
+            else:
+                templates.append((f, None))
+        return templates
+
     def form_valid(self, form):
         files = self.request.FILES.getlist("source_files")
         logger.info(f"files is: {files}")
+        try:
+            templates = self._templates(files)
+        except zipfile.BadZipFile:
+            messages.add_message(
+                self.request, messages.ERROR, "That is not a valid .zip archive."
+            )
+            return redirect("returns:returns_list")
         # test if we have erroneous files
-        for uploaded_file in files:
-            uploaded_file = uploaded_file.name.split(".")[0]
+        for uploaded_file, member in templates:
+            uploaded_file = os.path.basename(member or uploaded_file.name).split(".")[0]
             logger.info(f"Uploaded file is {uploaded_file}")
             if uploaded_file not in self.valid_project_names:
                 logger.info(f"Split file name is {uploaded_file}")
@@ -71,13 +110,40 @@ class ReturnBatchCreate(LoginRequiredMixin, FormView):
                 return redirect("returns:returns_list")
         fq_id = form.cleaned_data["financial_quarter"].id
         dm_id = form.cleaned_data["datamap"].id
-        for f in files:
-            project_name = f.name.split(".")[0]
-            save_path = os.path.join(settings.MEDIA_ROOT, "uploads", str(f))
-            save_path = default_storage.save(save_path, f)
-            process.delay(fq_id, dm_id, save_path, project_name)
+        batch = IngestBatch.objects.create(
+            financial_quarter_id=fq_id, datamap_id=dm_id
+        )
+        parse_tasks = []
+        save_paths = {}
+        for f, member in templates:
+            name = os.path.basename(member or f.name)
+            project_name = name.split(".")[0]
+            # the Celery worker reads the file from storage, so unlike a
+            # single upload it has to be saved before the task is queued. An
+            # archive is saved once, and each worker streams its own member
+            # out of it. Storage keeps one copy of each distinct file, and
+            # finalise_batch releases the reference taken here.
+            stored_name = ""
+            if f not in save_paths:
+                stored_name = upload_storage.save(archive_path(f), f)
+                save_paths[f] = upload_storage.path(stored_name)
+            ingest_file = IngestFile.objects.create(
+                batch=batch, name=name, stored_name=stored_name
+            )
+            parse_tasks.append(
+                process.si(
+                    fq_id,
+                    dm_id,
+                    save_paths[f],
+                    project_name,
+                    ingest_file.id,
+                    member,
+                )
+            )
+        # the master is rebuilt once, after every file in the batch is parsed
+        chord(parse_tasks)(finalise_batch.s(fq_id, dm_id, batch.id))
         messages.success(
-            self.request, "Processing uploads - please refresh page later..."
+            self.request, "Processing uploads - progress is shown below."
         )
         return redirect("returns:returns_list")
 
@@ -99,8 +165,7 @@ class ReturnBatchCreate(LoginRequiredMixin, FormView):
     #     return HttpResponseRedirect(self.get_success_url())
 
 
-def download_master(request, fqid: int):
-    fq = FinancialQuarter.objects.get(pk=fqid)
+def _master_datamap(fq: FinancialQuarter) -> Datamap:
     # TODO - for now we assume the datamap is the same
     # for all returns, but as long as we allow uploading
     # of seperate returns, the datamap could be different
@@ -109,14 +174,64 @@ def download_master(request, fqid: int):
     # when making returns.
     return_obj_sample = fq.return_financial_quarters.first()
     first_return_obj_item = return_obj_sample.return_returnitems.first()
-    datamap = first_return_obj_item.datamapline.datamap
-    file_name = f"Master_for_Q{fq.quarter}_{fq.year}.xlsx"
-    generate_master(fq, file_name, datamap)
-    with open(file_name, "rb") as excel:
-        data = excel.read()
-        response = HttpResponse(data, content_type="application/vnd.ms-excel")
-        response["Content-Disposition"] = f"attachment; filename={file_name}"
-        return response
+    return first_return_obj_item.datamapline.datamap
+
+
+def download_master(request, fqid: int):
+    fq = FinancialQuarter.objects.get(pk=fqid)
+    datamap = _master_datamap(fq)
+    excel = None
+    path = current_master(fq, datamap)
+    if path is not None:
+        try:
+            excel = open(path, "rb")
+        except FileNotFoundError:
+            # replaced by a newer build since
+            pass
+    if excel is None:
+        # not built yet, or its returns have changed and the rebuild is pending
+        excel = open(build_master(fq, datamap), "rb")
+    # streamed from the open file, which a rebuild replacing it cannot change
+    return FileResponse(
+        excel,
+        as_attachment=True,
+        filename=master_filename(fq),
+        content_type="application/vnd.ms-excel",
+    )
+
+
+@login_required
+def export_master(request, fqid: int, fmt: str):
+    """
+    The master for a FinancialQuarter as CSV, NDJSON or, when pyarrow is
+    installed, Parquet or Arrow IPC (see returns.exports), made from the
+    pivot of its ReturnItems. CSV and NDJSON are streamed.
+    """
+    if fmt not in available_formats():
+        raise Http404(f"The master cannot be exported as {fmt}")
+    fq = get_object_or_404(FinancialQuarter, pk=fqid)
+    pivot = master_pivot(fq, _master_datamap(fq))
+    export_format = EXPORT_FORMATS[fmt]
+    if export_format.stream is not None:
+        response = StreamingHttpResponse(
+            export_format.stream(pivot), content_type=export_format.content_type
+        )
+    else:
+        response = HttpResponse(
+            export_bytes(pivot, fmt), content_type=export_format.content_type
+        )
+    stem = os.path.splitext(master_filename(fq))[0]
+    response["Content-Disposition"] = f'attachment; filename="{stem}.{fmt}"'
+    return response
+
+
+@login_required
+def ingest_batch_progress(request, pk: int):
+    """
+    The progress of an IngestBatch as JSON, polled by the returns list.
+    """
+    batch = get_object_or_404(IngestBatch, pk=pk)
+    return JsonResponse(batch.progress())
 
 
 class ReturnsList(LoginRequiredMixin, ListView):
@@ -126,9 +241,18 @@ class ReturnsList(LoginRequiredMixin, ListView):
     def get_context_data(self, **kwargs):
         """
         We want to add in a list of FinancialYear objects that contain
-        Return items.
+        Return items, the batches still being ingested and the latest
+        ingest of each Return.
         """
         context = super().get_context_data(**kwargs)
+        context["active_batches"] = IngestBatch.objects.active()
+        context["export_formats"] = available_formats()
+        last_ingests = {
+            f.return_obj_id: f
+            for f in IngestFile.objects.filter(return_obj__in=context["object_list"])
+        }
+        for r in context["object_list"]:
+            r.last_ingest = last_ingests.get(r.pk)
         valid_fqs: List[FinancialQuarter] = []
         for fq in FinancialQuarter.objects.all():
             if len(fq.return_financial_quarters.all()) > 0:
@@ -0,0 +1,19 @@
+# Generated by Django 2.1.6 on 2026-10-18 11:20
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('templates', '0004_auto_20190224_2006'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='template',
+            name='source_file',
+            field=models.FileField(storage=core.storage.ContentAddressedStorage(), upload_to='uploads/'),
+        ),
+    ]
@@ -3,12 +3,14 @@ from django.urls import reverse
 
 from django_extensions.db.fields import AutoSlugField
 
+from core.storage import upload_storage
+
 
 class Template(models.Model):
     """A template used to collect data from a user."""
     name = models.CharField(max_length=50)
     description = models.TextField(max_length=200)
-    source_file = models.FileField(upload_to="uploads/")
+    source_file = models.FileField(upload_to="uploads/", storage=upload_storage)
     slug = AutoSlugField(populate_from=['name'])
 
     def get_absolute_url(self):
@@ -1,5 +1,3 @@
-import os
-
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -31,12 +29,11 @@ class TemplateDelete(LoginRequiredMixin, DeleteView):
     model = Template
     success_url = reverse_lazy("templates:list")
 
-    def get(self, request, *args, **kwargs):
-        source_file = Template.objects.get(slug=kwargs['slug']).source_file.url
-        os.remove(source_file)
-        self.object = self.get_object()
-        context = self.get_context_data(object=self.object)
-        return self.render_to_response(context)
+    def delete(self, request, *args, **kwargs):
+        # drops this Template's reference to the stored file, which other
+        # Templates with the same content may share
+        self.get_object().source_file.delete(save=False)
+        return super().delete(request, *args, **kwargs)
 
 
 class TemplateUpdate(LoginRequiredMixin, UpdateView):